@@ -45,12 +45,11 @@ def get_deployed_branches(deployment_directory, branch_prefix):
         full_name = "/".join((branch_prefix, b))
         deployed_revisions = listdir_nolinks(path.join(deployment_directory, branch_prefix, b))
 
-        assert len(deployed_revisions) == 1
-        deployed_revision = deployed_revisions[0]
+        # Multiple revisions are retained per branch until expired by deploy_build.py gc
+        for deployed_revision in deployed_revisions:
+            deployed_date = datetime.datetime.fromtimestamp(path.getmtime(path.join(deployment_directory, branch_prefix, b, deployed_revision)))
 
-        deployed_date = datetime.datetime.fromtimestamp(path.getmtime(path.join(deployment_directory, branch_prefix, b, deployed_revision)))
-
-        deployed_branches.append(BranchInfo(full_name, deployed_date, deployed_revision))
+            deployed_branches.append(BranchInfo(full_name, deployed_date, deployed_revision))
 
     logging.info("Deployed branches:\n%s", "\n".join(str(b) for b in deployed_branches))
     return deployed_branches
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Execute dependent build stages concurrently, splitting a core budget between stages.
+
+Stages are given as a json list of stage definitions:
+
+    name - Stage name, output is written to <log_dir>/<name>.log.
+    command - Command list, "{jobs}" is replaced by the stage core budget.
+    workdir - Stage working directory.
+    depends - Names of stages which must complete before the stage starts.
+    core_share - Fraction of total cores allotted to the stage.
+    halt_on_failure - Skip dependent stages if the stage fails, skipped stages also skip their dependents.
+    timeout - Kill stage after timeout seconds without output.
+"""
+import os
+from os import path
+import sys
+import time
+import json
+import errno
+import signal
+import subprocess
+
+import logging
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+summary_start = "Pipeline summary"
+summary_end = "End of Pipeline summary"
+
+def stage_jobs(stage, cores):
+    """Core budget of stage, at least one core."""
+    return max(1, int(round(cores * stage.get("core_share", 1.0))))
+
+def stage_command(stage, cores):
+    """Resolve stage command, substituting core budget and dropping empty arguments of unset properties."""
+    jobs = str(stage_jobs(stage, cores))
+    return [c.replace("{jobs}", jobs) for c in stage["command"] if c]
+
+def validate_stages(stages):
+    names = [s["name"] for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate stage names: %s" % names)
+
+    for s in stages:
+        missing = set(s.get("depends", [])) - set(names)
+        if missing:
+            raise ValueError("Stage %s has undefined dependencies: %s" % (s["name"], sorted(missing)))
+
+    # Resolve stage order, failing on cyclic dependencies
+    resolved = set()
+    while len(resolved) < len(stages):
+        ready = [s["name"] for s in stages if s["name"] not in resolved and set(s.get("depends", [])) <= resolved]
+        if not ready:
+            raise ValueError("Cyclic stage dependencies: %s" % sorted(set(names) - resolved))
+        resolved.update(ready)
+
+def terminate_pipeline(signum, frame):
+    """Signal handler raising SystemExit, running stages are killed as run_pipeline exits."""
+    logging.error("Terminating pipeline on signal: %s", signum)
+    raise SystemExit(128 + signum)
+
+def kill_stages(running):
+    """Kill process groups of running stages."""
+    for name, (stage, stage_process, log_file, log_path, start_time, last_output) in list(running.items()):
+        logging.warning("Killing stage: %s", name)
+        try:
+            os.killpg(stage_process.pid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+        stage_process.wait()
+        log_file.close()
+        del running[name]
+
+def run_pipeline(stages, cores, log_dir, poll_interval = 1, heartbeat_interval = 60):
+    """Run stages as dependencies complete, returning {name : stage result}.
+
+    Stage status is one of "success", "failure", "timeout" or "skipped".
+    Stages run in independent process groups, running stages are killed if
+    the pipeline is interrupted, see terminate_pipeline.
+    """
+    validate_stages(stages)
+
+    try:
+        os.makedirs(log_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    results = {}
+    running = {}
+    pending = list(stages)
+    last_heartbeat = time.time()
+
+    try:
+        while pending or running:
+            for stage in list(pending):
+                depends = stage.get("depends", [])
+                if not all(d in results for d in depends):
+                    continue
+
+                pending.remove(stage)
+
+                halted = [
+                        d for d in depends
+                        if results[d]["status"] == "skipped" or (results[d]["status"] != "success" and results[d]["halt_on_failure"])]
+                if halted:
+                    logging.warning("Skipping stage: %s failed dependencies: %s", stage["name"], halted)
+                    results[stage["name"]] = {"status" : "skipped", "halt_on_failure" : stage.get("halt_on_failure", False), "failed_depends" : halted}
+                    continue
+
+                command = stage_command(stage, cores)
+                log_path = path.join(log_dir, stage["name"] + ".log")
+                if path.exists(log_path):
+                    os.remove(log_path)
+
+                logging.info("Starting stage: %s jobs: %s command: %s", stage["name"], stage_jobs(stage, cores), command)
+                log_file = open(log_path, "w")
+                stage_process = subprocess.Popen(
+                        command, cwd=stage.get("workdir"), stdout=log_file, stderr=subprocess.STDOUT,
+                        preexec_fn=os.setsid)
+
+                running[stage["name"]] = (stage, stage_process, log_file, log_path, time.time(), [0, time.time()])
+
+            for name, (stage, stage_process, log_file, log_path, start_time, last_output) in list(running.items()):
+                returncode = stage_process.poll()
+
+                if returncode is not None:
+                    status = "success" if returncode == 0 else "failure"
+                else:
+                    output_size = path.getsize(log_path)
+                    if output_size != last_output[0]:
+                        last_output[:] = [output_size, time.time()]
+                        continue
+
+                    if not (stage.get("timeout") and time.time() - last_output[1] > stage["timeout"]):
+                        continue
+
+                    logging.error("Stage timed out without output: %s timeout: %s", name, stage["timeout"])
+                    os.killpg(stage_process.pid, signal.SIGKILL)
+                    returncode = stage_process.wait()
+                    status = "timeout"
+
+                log_file.close()
+                del running[name]
+
+                results[name] = {
+                        "status" : status,
+                        "returncode" : returncode,
+                        "jobs" : stage_jobs(stage, cores),
+                        "start_time" : start_time,
+                        "wall_time" : time.time() - start_time,
+                        "halt_on_failure" : stage.get("halt_on_failure", False),
+                        }
+                logging.info("Completed stage: %s status: %s returncode: %s wall_time: %.1fs", name, status, returncode, results[name]["wall_time"])
+
+            if running and time.time() - last_heartbeat > heartbeat_interval:
+                logging.info("Running stages: %s", sorted(running))
+                last_heartbeat = time.time()
+
+            if running:
+                time.sleep(poll_interval)
+
+    finally:
+        kill_stages(running)
+
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Execute dependent build stages concurrently.")
+    parser.add_argument("--cores", type=int, default=1, help="Total core budget split between stages.")
+    parser.add_argument("--log_dir", default="pipeline_logs", help="Stage log directory.")
+    parser.add_argument("stages", help="Json stage definitions.")
+
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, terminate_pipeline)
+    signal.signal(signal.SIGINT, terminate_pipeline)
+
+    results = run_pipeline(json.loads(args.stages), args.cores, args.log_dir)
+
+    sys.stdout.write("%s\n%s\n%s\n" % (summary_start, json.dumps(results, indent=2, sort_keys=True), summary_end))
+    sys.stdout.flush()
+
+    sys.exit(0 if all(r["status"] == "success" for r in results.values()) else 1)
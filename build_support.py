@@ -1,4 +1,5 @@
 from buildbot.steps.shell import Compile, ShellCommand
+from buildbot.process.buildstep import BuildStep
 from buildbot.status.results import SUCCESS, FAILURE
 from buildbot.process.properties import Interpolate, Property, renderer
 from buildbot.interfaces import IRenderable
@@ -8,6 +9,25 @@ from zope.interface import implements
 from twisted.internet import defer
 from twisted.python.reflect import accumulateClassList
 
+import re
+import json
+
+class SetProperty(BuildStep):
+    """Set build property to rendered value on the master."""
+
+    name = "setproperty"
+    renderables = ["value"]
+
+    def __init__(self, property, value, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.property = property
+        self.value = value
+
+    def start(self):
+        self.setProperty(self.property, self.value, "SetProperty Step")
+        self.step_status.setText(["set", self.property])
+        self.finished(SUCCESS)
+
 class DeployBuild(ShellCommand):
     """Execute build deploy command."""
     def __init__(
@@ -19,7 +39,16 @@ class DeployBuild(ShellCommand):
             build_mode = Interpolate("%(prop:build_mode)s"),
             build_extras = Interpolate("%(prop:build_extras)s"),
             link_current_build = Property("link_current_build", default=False),
+            object_store = False,
+            jobs = Interpolate("%(prop:slave_build_cores)s"),
+            variants = None,
             **kwargs):
+        """Deploy build drop.
+
+        object_store - Archive drop via content-addressed object store, drops share read-only files with other drops.
+        variants - List of "<mode>:<extras>:<targets>" variants deployed concurrently in place of
+            build_mode, build_extras and build_targets if provided.
+        """
 
         ShellCommand.__init__(
             self,
@@ -30,15 +59,42 @@ class DeployBuild(ShellCommand):
                build_targets,
                build_mode,
                build_extras,
-               link_current_build
+               link_current_build,
+               object_store,
+               jobs,
+               variants
             ),
             **kwargs)
 
+        self.deploy_timing = ""
+
+    def commandComplete(self, cmd):
+
+        #Extract deploy timing report
+        deploy_timing = []
+        report = False
+
+        for l in self.getLog("stdio").readlines():
+            if l.find("End of Deploy timing report") >= 0:
+                break
+
+            if report:
+                deploy_timing.append(l)
+
+            if l.find("Deploy timing report") >= 0:
+                report = True
+
+        self.deploy_timing = "".join(deploy_timing)
+
+    def createSummary(self, log):
+        if self.deploy_timing:
+            self.addCompleteLog("deploy_timing", self.deploy_timing)
+
 class BuildCommandRenderer:
     implements(IRenderable)
-    renderables = ["build_targets", "build_mode", "build_extras", "force", "target_directory", "link_current_build"]
+    renderables = ["build_targets", "build_mode", "build_extras", "force", "target_directory", "link_current_build", "object_store", "jobs", "variants"]
 
-    def __init__(self, target_directory, force, build_name, build_targets, build_mode, build_extras, link_current_build):
+    def __init__(self, target_directory, force, build_name, build_targets, build_mode, build_extras, link_current_build, object_store, jobs, variants = None):
         self.target_directory = target_directory
         self.force = force
         self.build_name = build_name
@@ -46,15 +102,22 @@ class BuildCommandRenderer:
         self.build_mode = build_mode
         self.build_extras = build_extras
         self.link_current_build = link_current_build
+        self.object_store = object_store
+        self.jobs = jobs
+        self.variants = variants
 
     def make_command(self, _):
-        command = ["python", "deploy_build.py"]
+        command = ["python", "deploy_build.py", "deploy"]
 
-        if self.build_mode:
-            command.extend(["--mode", self.build_mode])
+        if self.variants:
+            for v in self.variants:
+                command.extend(["--variant", v])
+        else:
+            if self.build_mode:
+                command.extend(["--mode", self.build_mode])
 
-        if self.build_extras:
-            command.extend(["--extras", self.build_extras])
+            if self.build_extras:
+                command.extend(["--extras", self.build_extras])
 
         if self.force:
             command.append("--force")
@@ -62,7 +125,13 @@ class BuildCommandRenderer:
         if self.link_current_build:
             command.extend(["--link_current"])
 
-        if self.build_name:
+        if self.object_store:
+            command.append("--object_store")
+
+        if self.jobs:
+            command.extend(["--jobs", self.jobs])
+
+        if self.build_name and not self.variants:
             command.extend(["--build_name", self.build_name])
         command.append(self.target_directory)
 
@@ -72,7 +141,7 @@ class BuildCommandRenderer:
             else:
                 return t
 
-        if self.build_targets:
+        if self.build_targets and not self.variants:
             command.extend(split_targets(self.build_targets))
 
         return command
@@ -94,7 +163,80 @@ class BuildCommandRenderer:
         dl.addCallback(self.make_command)
         return dl
 
+def compiler_cache_enabled(step):
+    """Compiler cache is enabled if slave defines compiler_cache_dir property."""
+    return bool(step.build.getProperty("compiler_cache_dir"))
+
+@renderer
+def compiler_cache_environment(props):
+    """Build environment placing ccache compiler wrappers on PATH if compiler_cache_dir is defined.
+
+    The cache directory is shared by all builders on the slave, paths are
+    rewritten relative to the builder directory so translation units hit
+    across builders. CCACHE_ variables are forwarded to compilers run by scons
+    via the scons ENV in site.settings.
+    """
+    cache_dir = props.getProperty("compiler_cache_dir")
+    if not cache_dir:
+        return {}
+
+    return {
+        "PATH" : [props.getProperty("compiler_cache_wrapper_path", "/usr/lib/ccache"), "${PATH}"],
+        "CCACHE_DIR" : cache_dir,
+        "CCACHE_BASEDIR" : props.getProperty("builddir"),
+        "CCACHE_NOHASHDIR" : "1",
+    }
+
+class CompilerCacheStats(ShellCommand):
+    """Report compiler cache statistics since stats were last zeroed."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("env", compiler_cache_environment)
+        kwargs.setdefault("doStepIf", compiler_cache_enabled)
+
+        ShellCommand.__init__(self, command=["ccache", "--show-stats"], **kwargs)
+
+        self.cache_stats = ""
+        self.cache_hit_rate = None
+
+    def commandComplete(self, cmd):
+        cache_stats = self.getLog("stdio").readlines()
+
+        # ccache 3 reports per-type "cache hit (...)" and "cache miss" counts, ccache 4 "Hits:" and "Misses:" totals.
+        hits = 0
+        misses = 0
+        for l in cache_stats:
+            if re.match("\s*(cache hit \(.*\)|Hits:)\s+(\d+)", l):
+                hits += int(re.match("\s*(cache hit \(.*\)|Hits:)\s+(\d+)", l).groups()[1])
+            elif re.match("\s*(cache miss|Misses:)\s+(\d+)", l):
+                misses += int(re.match("\s*(cache miss|Misses:)\s+(\d+)", l).groups()[1])
+
+        self.cache_stats = "".join(cache_stats)
+        if hits + misses:
+            self.cache_hit_rate = float(hits) / (hits + misses)
+            self.setProperty("compiler_cache_hit_rate", self.cache_hit_rate, "CompilerCacheStats")
+
+    def createSummary(self, log):
+        self.addCompleteLog("compiler_cache_stats", self.cache_stats)
+
+        if self.cache_hit_rate is not None:
+            description = self.descriptionDone or self.description
+            if isinstance(description, basestring):
+                description = [description]
+            self.descriptionDone = list(description) + ["%.0f%% hit" % (self.cache_hit_rate * 100)]
+
 class SconsCompile(Compile):
+    """Execute scons build, reporting per-category compile and failure counts.
+
+    build_cat - Build category or list of categories built in a single invocation.
+    build_targets - Target or list of targets, space-separated targets are split.
+    keep_going - Continue building other targets after a failure, so status is reported for all categories.
+    """
+
+    # Object output and failed target paths of form build/<category>/...
+    compiled_category_pattern = re.compile("\s-o\s+build/(\w+)/")
+    failed_target_pattern = re.compile("scons: \*\*\* \[(?:build/)?(\w+)")
+
     def __init__(
             self,
             build_targets = Interpolate("%(prop:build_targets)s"),
@@ -102,8 +244,12 @@ class SconsCompile(Compile):
             build_cat = Interpolate("%(prop:build_cat)s"),
             build_extras = Interpolate("%(prop:build_extras)s"),
             jobs = None,
+            keep_going = False,
             **kwargs):
 
+        # Compile via shared compiler cache if configured for slave
+        kwargs.setdefault("env", compiler_cache_environment)
+
         Compile.__init__(
             self,
             command=SconsCommandRenderer(
@@ -111,20 +257,46 @@ class SconsCompile(Compile):
                build_mode,
                build_cat,
                build_extras,
-               jobs),
+               jobs,
+               keep_going),
             **kwargs)
 
+        self.category_status = ""
+
+    def createSummary(self, log):
+        Compile.createSummary(self, log)
+
+        compiled = {}
+        failed = {}
+        for l in log.readlines():
+            if self.compiled_category_pattern.search(l):
+                category = self.compiled_category_pattern.search(l).groups()[0]
+                compiled[category] = compiled.get(category, 0) + 1
+            elif self.failed_target_pattern.match(l):
+                category = self.failed_target_pattern.match(l).groups()[0]
+                failed[category] = failed.get(category, 0) + 1
+
+        categories = sorted(set(compiled) | set(failed))
+        self.category_status = "".join(
+                "%s: %s compiled %s failed %s\n" % (c, "FAILED" if failed.get(c) else "OK", compiled.get(c, 0), failed.get(c, 0))
+                for c in categories)
+
+        if categories:
+            self.addCompleteLog("category_status", self.category_status)
+            self.setProperty("build_failed_categories", sorted(failed), "SconsCompile")
+
 class SconsCommandRenderer:
     implements(IRenderable)
 
     renderables = ["build_targets", "build_mode", "build_cat", "build_extras", "build_jobs"]
 
-    def __init__(self, build_targets, build_mode, build_cat, build_extras, build_jobs):
+    def __init__(self, build_targets, build_mode, build_cat, build_extras, build_jobs, keep_going = False):
         self.build_targets = build_targets
         self.build_mode = build_mode
         self.build_cat = build_cat
         self.build_extras = build_extras
         self.build_jobs = build_jobs
+        self.keep_going = keep_going
 
     def make_command(self, _):
         command = ["scons"]
@@ -133,7 +305,10 @@ class SconsCommandRenderer:
             command.append("mode=%s" % self.build_mode)
 
         if self.build_cat:
-            command.append("cat=%s" % self.build_cat)
+            if isinstance(self.build_cat, basestring):
+                command.append("cat=%s" % self.build_cat)
+            else:
+                command.append("cat=%s" % ",".join(c for c in self.build_cat if c))
 
         if self.build_extras:
             command.append("extras=%s" % self.build_extras)
@@ -141,11 +316,14 @@ class SconsCommandRenderer:
         if self.build_jobs:
             command.extend(["-j", self.build_jobs])
 
+        if self.keep_going:
+            command.append("-k")
+
         def split_targets(t):
             if isinstance(t, basestring):
-                return t.split(" ")
+                return [s for s in t.split(" ") if s]
             else:
-                return t
+                return sum((split_targets(s) for s in t), [])
 
         if self.build_targets:
             command.extend(split_targets(self.build_targets))
@@ -168,3 +346,143 @@ class SconsCommandRenderer:
 
         dl.addCallback(self.make_command)
         return dl
+
+class PipelineStage(object):
+    """Stage of a BuildPipeline step.
+
+    name - Stage name, stage output is attached as a step log of the same name.
+    command - Command list, may contain renderables, "{jobs}" is replaced by the stage core budget.
+    workdir - Stage working directory, relative to the pipeline step workdir.
+    depends - Names of stages which must complete before the stage starts.
+    core_share - Fraction of pipeline cores allotted to the stage.
+    halt_on_failure - Skip dependent stages and halt build if stage fails.
+    timeout - Kill stage after timeout seconds without output.
+    evaluate - Function of stage output lines returning (result, summary), stage result is taken from exit status if None.
+    """
+
+    def __init__(self, name, command, workdir = ".", depends = None, core_share = 1.0, halt_on_failure = False, timeout = 20 * 60, evaluate = None):
+        self.name = name
+        self.command = command
+        self.workdir = workdir
+        self.depends = depends or []
+        self.core_share = core_share
+        self.halt_on_failure = halt_on_failure
+        self.timeout = timeout
+        self.evaluate = evaluate
+
+class BuildPipeline(ShellCommand):
+    """Execute dependent stages concurrently on the slave via build_pipeline.py, splitting cores between stages.
+
+    Stage output is attached as a step log per stage. The step fails if any
+    stage fails, and halts the build if a halt_on_failure stage fails. The
+    pipeline is interrupted with SIGTERM by default, killing running stages.
+    """
+
+    def __init__(self, stages, cores = Interpolate("%(prop:slave_build_cores)s"), log_dir = "pipeline_logs", **kwargs):
+        logfiles = dict((s.name, "%s/%s.log" % (log_dir, s.name)) for s in stages)
+        logfiles.update(kwargs.pop("logfiles", {}))
+        kwargs.setdefault("interruptSignal", "TERM")
+
+        ShellCommand.__init__(
+            self,
+            command=PipelineCommandRenderer(stages, cores, log_dir),
+            logfiles=logfiles,
+            **kwargs)
+
+        self.stages = stages
+        self.stage_results = {}
+        self.stage_summaries = {}
+
+    def commandComplete(self, cmd):
+
+        #Extract pipeline summary
+        pipeline_summary = []
+        summary = False
+
+        for l in self.getLog("stdio").readlines():
+            if l.find("End of Pipeline summary") >= 0:
+                break
+
+            if summary:
+                pipeline_summary.append(l)
+
+            if l.find("Pipeline summary") >= 0:
+                summary = True
+
+        self.stage_results = json.loads("".join(pipeline_summary)) if pipeline_summary else {}
+
+        for stage in self.stages:
+            stage_result = self.stage_results.get(stage.name)
+            if not stage.evaluate or not stage_result or stage_result["status"] == "skipped":
+                continue
+
+            try:
+                stage_lines = self.getLog(stage.name).readlines()
+            except KeyError:
+                stage_lines = []
+
+            result, self.stage_summaries[stage.name] = stage.evaluate(stage_lines)
+            if result != SUCCESS and stage_result["status"] == "success":
+                stage_result["status"] = "failure"
+
+    def evaluateCommand(self, cmd):
+        failed_stages = [s for s in self.stages if self.stage_results.get(s.name, {}).get("status") != "success"]
+
+        if any(s.halt_on_failure for s in failed_stages):
+            self.haltOnFailure = True
+
+        if cmd.didFail() or failed_stages:
+            return FAILURE
+        else:
+            return SUCCESS
+
+    def createSummary(self, log):
+        self.addCompleteLog("pipeline_summary", "".join(
+            "%s: %s jobs: %s wall_time: %s\n" % (
+                s.name,
+                self.stage_results.get(s.name, {}).get("status", "not run"),
+                self.stage_results.get(s.name, {}).get("jobs"),
+                self.stage_results.get(s.name, {}).get("wall_time"))
+            for s in self.stages))
+
+        for name, stage_summary in sorted(self.stage_summaries.items()):
+            self.addCompleteLog("%s_summary" % name, stage_summary)
+
+class PipelineCommandRenderer:
+    implements(IRenderable)
+
+    def __init__(self, stages, cores, log_dir):
+        self.stages = stages
+        self.cores = cores
+        self.log_dir = log_dir
+
+    def make_command(self, rendered):
+        stage_commands, cores = rendered[:-1], rendered[-1]
+
+        def flatten_command(command):
+            flattened = []
+            for c in command:
+                if isinstance(c, (list, tuple)):
+                    flattened.extend(flatten_command(c))
+                else:
+                    flattened.append(str(c))
+            return flattened
+
+        stages = [{
+            "name" : s.name,
+            "command" : flatten_command(command),
+            "workdir" : s.workdir,
+            "depends" : s.depends,
+            "core_share" : s.core_share,
+            "halt_on_failure" : s.halt_on_failure,
+            "timeout" : s.timeout,
+            } for s, command in zip(self.stages, stage_commands)]
+
+        return ["python", "build_pipeline.py", "--cores", str(cores), "--log_dir", self.log_dir, json.dumps(stages)]
+
+    def getRenderingFor(self, props):
+        dl = [props.render(s.command) for s in self.stages] + [props.render(self.cores)]
+        dl = defer.gatherResults(dl)
+
+        dl.addCallback(self.make_command)
+        return dl
@@ -2,101 +2,160 @@
 from buildbot.process.factory import BuildFactory
 from buildbot.steps.source.git import Git
 from buildbot.steps.shell import ShellCommand
-from buildbot.steps.transfer import FileDownload
+from buildbot.steps.shell import SetProperty as SetPropertyFromCommand
+from buildbot.steps.trigger import Trigger
+from buildbot.steps.transfer import FileDownload, FileUpload
 from buildbot.process.properties import WithProperties
 from buildbot.process.properties import Interpolate, Property, renderer
 
-from test_support import UnitTest, IntegrationTest
-from build_support import SconsCompile, DeployBuild
+from test_support import unit_test_command, integration_test_command, evaluate_unit_test_log
+from test_support import integration_full_run, integration_results_complete, build_changed_files
+from test_support import UnitTest, IntegrationTest, RecordShardResult, MergeShardResults, RemoveShardResults
+from test_support import shard_integration_archive, shard_integration_download, shard_integration_recorded
+from test_support import integration_test_list, test_shard_assignment, shard_integration_tests, shard_runs_unit_tests, shard_runs_integration_tests
+from build_support import SconsCompile, DeployBuild, CompilerCacheStats, compiler_cache_enabled, compiler_cache_environment
+from build_support import BuildPipeline, PipelineStage, SetProperty
 
 # Updates scons configuration.
 update_scons_steps = [
     FileDownload(mastersrc="site.settings", slavedest="source/tools/build/site.settings", workdir="main"),
     ShellCommand(
-      command='echo "SetOption(\'implicit_cache\', 1);Decider(\'MD5-timestamp\')" >> SConscript',
+      # default_targets alias allows default targets to be built alongside explicit targets in one invocation
+      command='echo "SetOption(\'implicit_cache\', 1);Decider(\'MD5-timestamp\');Alias(\'default_targets\', DEFAULT_TARGETS)" >> SConscript',
       workdir="main/source",
       haltOnFailure=True,
       description="configure", descriptionSuffix="SConscript")]
 
+# Apply slave compiler cache size limit, evicting old objects, and reset cache statistics.
+compiler_cache_setup_steps = [
+    ShellCommand(
+      command=["sh", "-c", Interpolate("ccache --max-size=%(prop:compiler_cache_size:-20G)s && ccache --zero-stats")],
+      env=compiler_cache_environment,
+      doStepIf=compiler_cache_enabled,
+      warnOnFailure=True,
+      description="configure", descriptionSuffix="compiler cache")]
+
+compiler_cache_stats_steps = [
+    CompilerCacheStats(
+      warnOnFailure=True,
+      description="stats", descriptionSuffix="compiler cache")]
+
 #Steps to perform a full build
-full_build_steps = update_scons_steps + [
-    # build for unit tests
-    SconsCompile(
-      build_targets=None, # Set blank build targets, otherwise default targets pulled from env.
-      jobs=Interpolate("%(prop:slave_build_cores)s"),
-      workdir="main/source",
-      haltOnFailure=True,
-      description="compiling"),
-    SconsCompile(
-      build_cat="test",
-      build_targets=None, # Set blank build targets, otherwise default targets pulled from env.
-      jobs=Interpolate("%(prop:slave_build_cores)s"),
-      workdir="main/source",
-      haltOnFailure=True,
-      description="compiling", descriptionSuffix="tests"),
+# Library, test and target builds share one scons invocation, single dependency scan and job pool.
+full_build_steps = update_scons_steps + compiler_cache_setup_steps + [
     SconsCompile(
-      build_targets = Interpolate("%(prop:build_targets)s"),
+      build_cat=["src", "external", "test"],
+      build_targets=["default_targets", Interpolate("%(prop:build_targets)s")],
       jobs=Interpolate("%(prop:slave_build_cores)s"),
+      keep_going=True,
       workdir="main/source",
       haltOnFailure=True,
-      description="compiling", descriptionSuffix="targets")
-]
-
-#Steps for unittesting
-unittest_steps = [
-    UnitTest(
-      verbose=True,
-      jobs=Interpolate("%(prop:slave_build_cores)s"),
-      workdir="main/source",
-      flunkOnFailure=True,
-      description="testing", descriptionSuffix="unit"),
-    ShellCommand(
-        command=["python", "setup.py", "nosetests"],
-        workdir = "main/pyrosetta",
-        flunkOnFailure=True,
-        description="testing", descriptionSuffix="bindings"),
-]
-
-#Steps for integration testing
-integration_steps = [
-    ShellCommand(
-      command=["rm", "-rf", "ref", "new"],
-      workdir="main/tests/integration",
-      description="clean", descriptionSuffix="integration"),
-    IntegrationTest(
-      jobs=Interpolate("%(prop:slave_build_cores)s"),
-      workdir="main/tests/integration",
-      flunkOnFailure=True,
-      description="run", descriptionSuffix="integration"),
-    ShellCommand(
-      command=["./integration_archive.py", "save", "--force", Interpolate("%(prop:integration_result_dir)s/%(prop:build_mode)s"), "ref", Interpolate("%(src::branch)s"), Interpolate("%(src::revision)s")],
-      workdir="main/tests/integration",
-      description="save", descriptionSuffix="integration")
-]
+      description="compiling", descriptionSuffix="all")
+] + compiler_cache_stats_steps
 
-binding_build_steps = [
-    ShellCommand(
-      command=[
+def binding_build_command(jobs_option):
+    return [
         'source/src/python/packaged_bindings/BuildPackagedBindings.py',
         '--python_lib=python2.7',
         '--boost_lib=boost_python',
         Interpolate('--boost_path=%(prop:binding_boost_path)s'),
         Interpolate('--python_path=%(prop:binding_python_path)s'),
         '--compiler=gcc',
-        Interpolate("--jobs=%(prop:slave_build_cores)s"),
+        jobs_option,
         '--update',
-        '--package_path=pyrosetta'],
+        '--package_path=pyrosetta']
+
+binding_build_steps = [
+    ShellCommand(
+      command=binding_build_command(Interpolate("--jobs=%(prop:slave_build_cores)s")),
       workdir="main",
       haltOnFailure=True,
       timeout=60*60,
       description="build", descriptionSuffix="bindings")
     ]
 
+def test_pipeline_stages(build_bindings):
+    """Unit test, integration test and optional bindings stages executed concurrently after the build.
+
+    With bindings, unit tests share cores with the bindings build and
+    integration tests follow unit tests, overlapping the bindings build.
+    Without bindings, unit and integration tests share cores.
+    """
+    stages = [
+        PipelineStage(
+          "unit",
+          unit_test_command(jobs="{jobs}", verbose=True),
+          workdir="source",
+          core_share=.5,
+          evaluate=evaluate_unit_test_log),
+        PipelineStage(
+          "integration_clean",
+          ["rm", "-rf", "ref", "new"],
+          workdir="tests/integration"),
+        PipelineStage(
+          "integration",
+          integration_test_command(jobs="{jobs}", impact_selection=True),
+          workdir="tests/integration",
+          depends=["integration_clean", "unit"] if build_bindings else ["integration_clean"],
+          core_share=.5),
+    ]
+
+    if build_bindings:
+        stages.extend([
+          PipelineStage(
+            "bindings_build",
+            binding_build_command("--jobs={jobs}"),
+            core_share=.5,
+            halt_on_failure=True,
+            timeout=60*60),
+          PipelineStage(
+            "bindings_test",
+            ["python", "setup.py", "nosetests"],
+            workdir="pyrosetta",
+            depends=["bindings_build"]),
+        ])
+
+    return stages
+
+def test_pipeline_steps(build_bindings):
+    return [
+      # Integration tests are limited to tests affected by the build's changes unless a full run is due.
+      SetProperty(property="integration_full_run", value=integration_full_run),
+      FileDownload(mastersrc="integration_test_impact.py", slavedest="integration_test_impact.py", workdir="main"),
+      FileDownload(mastersrc="scons_support.py", slavedest="scons_support.py", workdir="main"),
+      FileDownload(mastersrc="build_pipeline.py", slavedest="build_pipeline.py", workdir="main"),
+      BuildPipeline(
+        test_pipeline_stages(build_bindings),
+        workdir="main",
+        flunkOnFailure=True,
+        description="testing", descriptionSuffix="pipeline")]
+
+#Steps for integration test result storage, only complete results of full runs are stored as reference results.
+integration_steps = [
+    FileDownload(mastersrc="integration_test_support.py", slavedest="integration_test_support.py", workdir="main"),
+    FileDownload(mastersrc="integration_result_manifest.py", slavedest="integration_result_manifest.py", workdir="main"),
+    # Store filtered result digests with saved results, later analysis only reads changed files.
+    ShellCommand(
+      command=["python", "../../integration_result_manifest.py", "-j", Interpolate("%(prop:slave_build_cores)s"), "ref"],
+      workdir="main/tests/integration",
+      warnOnFailure=True,
+      doStepIf=integration_results_complete,
+      description="digest", descriptionSuffix="integration"),
+    ShellCommand(
+      command=["./integration_archive.py", "save", "--force", Interpolate("%(prop:integration_result_dir)s/%(prop:build_mode)s"), "ref", Interpolate("%(src::branch)s"), Interpolate("%(src::revision)s")],
+      workdir="main/tests/integration",
+      doStepIf=integration_results_complete,
+      description="save", descriptionSuffix="integration")
+]
+
 # Binary deployment steps
-binary_deploy_steps = [
-  FileDownload(mastersrc="deploy_build.py", slavedest="deploy_build.py", workdir="main"),
-  DeployBuild(workdir="main")
-  ]
+def binary_deploy_steps(object_store = False, variants = None):
+    """Deploy build drop, or drops of "<mode>:<extras>:<targets>" variants concurrently if provided."""
+    return [
+      FileDownload(mastersrc="deploy_build.py", slavedest="deploy_build.py", workdir="main"),
+      FileDownload(mastersrc="scons_support.py", slavedest="scons_support.py", workdir="main"),
+      DeployBuild(object_store=object_store, variants=variants, workdir="main")
+      ]
 
 binding_deploy_steps = [
     ShellCommand(
@@ -118,37 +177,171 @@ complete_full_factory = BuildFactory(
     # check out the source
     [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step ] +
     full_build_steps +
-    binding_build_steps +
-    unittest_steps +
+    test_pipeline_steps(build_bindings=True) +
     integration_steps)
 
 complete_without_bindings_factory = BuildFactory(
     # check out the source
     [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step ] +
     full_build_steps +
-    unittest_steps +
+    test_pipeline_steps(build_bindings=False) +
     integration_steps)
 
 build_and_deploy_full_factory = BuildFactory(
     # check out the source
-    [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step] + update_scons_steps +
+    [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step] + update_scons_steps + compiler_cache_setup_steps +
     [ SconsCompile(
       jobs=Interpolate("%(prop:slave_build_cores)s"),
       workdir="main/source",
       haltOnFailure=True,
       description="compiling", descriptionSuffix="bin")] +
+    compiler_cache_stats_steps +
     binding_build_steps +
-    binary_deploy_steps +
+    binary_deploy_steps() +
     binding_deploy_steps)
 
 
 build_and_deploy_without_bindings_factory = BuildFactory(
     # check out the source
-    [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step] +  update_scons_steps +
+    [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step] +  update_scons_steps + compiler_cache_setup_steps +
     [SconsCompile(
       jobs=Interpolate("%(prop:slave_build_cores)s"),
       workdir="main/source",
       haltOnFailure=True,
       description="compiling", descriptionSuffix="bin")] +
-    binary_deploy_steps
+    compiler_cache_stats_steps +
+    # Release deploys of every release change share unchanged files through the object store
+    binary_deploy_steps(object_store=True)
 )
+
+def build_and_deploy_variants_factory(deploy_variants):
+    """Build each "<mode>:<extras>:<targets>" deploy variant, then deploy variant drops concurrently.
+
+    Variant drops share database and unchanged files through the object store.
+    """
+    variant_compile_steps = []
+    for variant in deploy_variants:
+        mode, extras, targets = variant.split(":")
+        variant_compile_steps.append(SconsCompile(
+          build_mode=mode,
+          build_extras=extras,
+          build_targets=targets.split(","),
+          jobs=Interpolate("%(prop:slave_build_cores)s"),
+          workdir="main/source",
+          haltOnFailure=True,
+          description="compiling", descriptionSuffix=variant))
+
+    return BuildFactory(
+        # check out the source
+        [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step] + update_scons_steps + compiler_cache_setup_steps +
+        variant_compile_steps +
+        compiler_cache_stats_steps +
+        binary_deploy_steps(object_store=True, variants=list(deploy_variants)))
+
+# Sharded testing
+# The triggering build partitions tests between shard builds, each shard build runs on
+# a free shard slave of the environment, builds and runs its assigned tests. Shard results are merged into
+# the triggering build's test summary. Shard integration results are gathered via the master and
+# stored by the triggering build, which also builds and tests bindings.
+def sharded_test_factory(shard_schedulers, build_bindings):
+    """Trigger test shard builds via shard_schedulers, merge shard results and store integration results."""
+    shard_gather_steps = sum([
+      [ FileDownload(
+          mastersrc=shard_integration_download(shard_index),
+          slavedest="integration_shard_%s.tar.gz" % shard_index,
+          workdir="main",
+          doStepIf=shard_integration_recorded(shard_index),
+          haltOnFailure=True),
+        ShellCommand(
+          command=["tar", "-xzf", "../../integration_shard_%s.tar.gz" % shard_index],
+          workdir="main/tests/integration",
+          doStepIf=shard_integration_recorded(shard_index),
+          haltOnFailure=True,
+          description="extract", descriptionSuffix="shard %s integration" % shard_index) ]
+      for shard_index in range(len(shard_schedulers))], [])
+
+    bindings_steps = []
+    if build_bindings:
+        bindings_steps = binding_build_steps + [
+          ShellCommand(
+            command=["python", "setup.py", "nosetests"],
+            workdir="main/pyrosetta",
+            flunkOnFailure=True,
+            description="test", descriptionSuffix="bindings")]
+
+    return BuildFactory(
+      [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"),
+        ShellCommand(
+          command=["rm", "-rf", "ref", "new"],
+          workdir="main/tests/integration",
+          haltOnFailure=True,
+          description="clean", descriptionSuffix="integration"),
+        SetPropertyFromCommand(
+          command=["sh", "-c", "for t in tests/*/command; do basename `dirname $t`; done"],
+          workdir="main/tests/integration",
+          extract_fn=integration_test_list,
+          haltOnFailure=True,
+          description="list", descriptionSuffix="integration"),
+        # Impact selection is resolved for the triggering build's changes and applied by shards to their tests.
+        SetProperty(property="integration_full_run", value=integration_full_run),
+        SetProperty(property="integration_changed_files", value=build_changed_files),
+        SetProperty(property="test_shard_assignment", value=test_shard_assignment),
+        Trigger(
+          schedulerNames=shard_schedulers,
+          waitForFinish=True,
+          updateSourceStamp=True,
+          copy_properties=[
+            "build_mode", "build_extras", "build_targets", "force_build_clean", "test_shard_assignment",
+            "integration_full_run", "integration_changed_files"],
+          set_properties={"parent_buildername" : Property("buildername"), "parent_buildnumber" : Property("buildnumber")}),
+        MergeShardResults(alwaysRun=True) ] +
+      bindings_steps +
+      # Incomplete shard integration results halt the build before results are stored
+      shard_gather_steps +
+      integration_steps +
+      [ RemoveShardResults(alwaysRun=True) ])
+
+test_shard_factory = BuildFactory(
+    # check out the source
+    [ Git(repourl=Property("slave_repo_url"), mode='incremental', workdir="main"), clean_build_step ] +
+    full_build_steps +
+    [ UnitTest(
+        verbose=True,
+        jobs=Interpolate("%(prop:slave_build_cores)s"),
+        workdir="main/source",
+        flunkOnFailure=True,
+        doStepIf=shard_runs_unit_tests,
+        name="unit_test",
+        description="testing", descriptionSuffix="unit"),
+      ShellCommand(
+        command=["rm", "-rf", "ref", "new"],
+        workdir="main/tests/integration",
+        doStepIf=shard_runs_integration_tests,
+        description="clean", descriptionSuffix="integration"),
+      FileDownload(
+        mastersrc="integration_test_impact.py", slavedest="integration_test_impact.py", workdir="main",
+        doStepIf=shard_runs_integration_tests),
+      FileDownload(
+        mastersrc="scons_support.py", slavedest="scons_support.py", workdir="main",
+        doStepIf=shard_runs_integration_tests),
+      IntegrationTest(
+        jobs=Interpolate("%(prop:slave_build_cores)s"),
+        impact_selection=True,
+        tests=shard_integration_tests,
+        workdir="main/tests/integration",
+        flunkOnFailure=True,
+        doStepIf=shard_runs_integration_tests,
+        name="integration_test",
+        description="run", descriptionSuffix="integration"),
+      # Integration results are stored by the triggering build
+      ShellCommand(
+        command=["sh", "-c", "mkdir -p ref && tar -czf ../../integration_shard.tar.gz ref"],
+        workdir="main/tests/integration",
+        doStepIf=shard_runs_integration_tests,
+        description="archive", descriptionSuffix="integration"),
+      FileUpload(
+        slavesrc="integration_shard.tar.gz",
+        masterdest=shard_integration_archive,
+        workdir="main",
+        doStepIf=shard_runs_integration_tests),
+      RecordShardResult(alwaysRun=True)])
@@ -12,6 +12,9 @@ slave_list = \
             "max_builds" : 1,
             "properties" : {
                 "slave_build_cores" : 12,
+                # Compiler cache shared by all builders on the slave, size limited with lru eviction.
+                "compiler_cache_dir"  : "/gscratch/baker/buildbot/ccache",
+                "compiler_cache_size" : "50G",
                 # Source prefixs by the python library and boost libraries used during build.
                 "binding_python_path" : "/gscratch/baker/buildbot/opt",
                 "binding_boost_path"  : "/gscratch/baker/buildbot/opt",
@@ -25,6 +28,9 @@ slave_list = \
             "max_builds" : 1,
             "properties" : {
                 "slave_build_cores" : 6,
+                # Compiler cache shared by all builders on the slave, size limited with lru eviction.
+                "compiler_cache_dir"  : "/work/buildbot/ccache",
+                "compiler_cache_size" : "20G",
                 # Source prefixs by the python library and boost libraries used during build.
                 "binding_python_path" : "/usr/local",
                 "binding_boost_path" : "/work/buildbot/opt",
@@ -59,6 +65,17 @@ build_environments = {
 
         # Build python bindings
         "build_bindings" : True,
+
+        # Run integration tests affected by changed files, with a full run every integration_full_run_interval builds
+        "integration_impact_selection" : True,
+
+        # Partition unit and integration tests of branch builds between test_shards shard builds
+        # run on target slaves other than the first, 0 runs tests in the branch build.
+        "test_shards" : 0,
+
+        # Release deployments build and concurrently deploy "<mode>:<extras>:<targets>" variants,
+        # e.g. ["release::bin", "release:mpi:bin"], empty deploys the release bin drop.
+        "deploy_variants" : [],
     },
 
     "hyak" : {
@@ -2,13 +2,36 @@
 import os
 from os import path
 import shutil
+import stat
+import errno
+import hashlib
+import time
+import json
+import glob
 
 import re
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
 import subprocess
+import sys
 import tempfile
+import contextlib
+import tarfile
+import zlib
+import StringIO
+import threading
+import Queue
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from collections import namedtuple
+
+from scons_support import perform_test_build, extract_build_products, extract_build_dependencies, get_bin_name, get_lib_name
 
 def resolve_build_drop_parameters(branch = None, revision = None, mode = None, extras = None, force_build_name=None):
     """Generate build drop directory components, resolving source and build parameters as needed."""
@@ -49,206 +72,1476 @@ def setup_drop_links( link_name, target_directory, branch, revision, type_name):
         path_suffix = path.join(*(branch_path_elements[i + 1:] + [revision]) )
         link_path = path.join(path_prefix, link_name)
 
-        if path.islink(link_path) and path.lexists(link_path):
-            logging.info("Removing existing link: %s", link_path)
-            os.remove(link_path)
-        elif path.lexists(link_path):
+        if path.lexists(link_path) and not path.islink(link_path):
             logging.warning("Skipping existing non-link file: %s", link_path)
             continue
 
+        # Create link under temporary name and rename over any existing link, link is always resolvable.
         logging.info("Creating drop link. name: %s target: %s", link_path, path_suffix)
-        os.symlink(path_suffix, link_path)
+        temp_link_path = "%s.tmp.%s" % (link_path, os.getpid())
+        if path.lexists(temp_link_path):
+            os.remove(temp_link_path)
+        os.symlink(path_suffix, temp_link_path)
+        os.rename(temp_link_path, link_path)
+
+def exchange_paths(first, second):
+    """Atomically exchange two existing paths via renameat2 RENAME_EXCHANGE, False if unsupported."""
+    import ctypes
+    import ctypes.util
 
-def perform_test_build(rosetta_root, targets = None, mode = None, extras = None):
-    """Perform no-op scons build of the given build targets, generating a tree of build dependencies."""
-    command = ["scons", "--tree=prune,derived", "-n"]
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "renameat2"):
+        return False
 
-    if mode:
-        command.append("mode=%s" % mode)
-    if extras:
-        command.append("extras=%s" % extras)
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 2
 
-    command.extend(targets)
+    if libc.renameat2(AT_FDCWD, first, AT_FDCWD, second, RENAME_EXCHANGE) != 0:
+        error = ctypes.get_errno()
+        if error in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            return False
+        raise OSError(error, os.strerror(error), second)
 
-    logging.info("Beginning archive test build: %s", " ".join(command))
-    build_result = subprocess.check_output(command, cwd=path.join(rosetta_root, "source"), universal_newlines=True)
+    return True
 
-    logging.debug("Build result:\n%s", build_result)
+def move_to_trash(target_directory, trash_path):
+    """Move path into target_directory/.trash for later removal by cleanup_deploy_directories."""
+    trash_root = path.join(target_directory, ".trash")
+    if not path.exists(trash_root):
+        os.makedirs(trash_root)
 
-    for t in targets:
-        if not re.search("`%s' is up to date." % t, build_result):
-            logging.error("Target not up to date in scons test build: %s", t)
+    # Rename over an empty placeholder, trash entries are prefixed by trash time.
+    trash_entry = tempfile.mkdtemp(dir=trash_root, prefix="%i.%s." % (time.time(), path.basename(trash_path)))
+    logging.info("Moving to trash: %s %s", trash_path, trash_entry)
+    os.rename(trash_path, trash_entry)
 
-    return build_result
+    return trash_entry
 
-def extract_build_products(scons_tree_lines):
-    """Process tree of build dependencies to extract all binary and library targets."""
-    build_product_pattern=re.compile("(?<=\+-)build.*")
-    object_file_pattern=re.compile("\.(os|o)$")
-    library_file_pattern=re.compile("\.so$")
+def publish_drop(target_directory, staging_directory, drop_directory):
+    """Rename completed staging directory into drop directory, replacing and trashing any existing drop.
 
-    library_files = set()
-    binary_files = set()
+    An existing drop is atomically exchanged with the staging directory where the filesystem supports
+    renameat2 RENAME_EXCHANGE, otherwise it is renamed aside immediately before the staging directory
+    is renamed into place.
+    """
+    if not path.exists(path.dirname(drop_directory)):
+        os.makedirs(path.dirname(drop_directory))
+
+    logging.info("Publishing drop directory: %s %s", staging_directory, drop_directory)
+    if not path.exists(drop_directory):
+        os.rename(staging_directory, drop_directory)
+    elif exchange_paths(staging_directory, drop_directory):
+        move_to_trash(target_directory, staging_directory)
+    else:
+        move_to_trash(target_directory, drop_directory)
+        os.rename(staging_directory, drop_directory)
 
-    for l in scons_tree_lines:
-        build_product_match = build_product_pattern.search(l)
-        if not build_product_match:
+def expired_trash_entries(target_directory, trash_age):
+    """List trash entries moved to trash more than trash_age seconds ago."""
+    trash_root = path.join(target_directory, ".trash")
+    if not path.exists(trash_root):
+        return []
+
+    now = time.time()
+    expired_entries = []
+
+    for entry in os.listdir(trash_root):
+        try:
+            trash_time = int(entry.split(".")[0])
+        except ValueError:
             continue
 
-        if object_file_pattern.search(l, build_product_match.start(), build_product_match.end()):
+        if now - trash_time > trash_age:
+            expired_entries.append(path.join(trash_root, entry))
+
+    return expired_entries
+
+# Replaced drops are retained in trash for running jobs still reading the drop.
+default_trash_age_days = 3
+
+def cleanup_deploy_directories(target_directory, trash_age = default_trash_age_days * 24 * 60 * 60, staging_age = 24 * 60 * 60):
+    """Remove trashed drops older than trash_age seconds and abandoned staging directories older than staging_age."""
+    now = time.time()
+
+    for entry in expired_trash_entries(target_directory, trash_age):
+        logging.info("Removing trashed drop: %s", entry)
+        shutil.rmtree(entry, ignore_errors=True)
+
+    staging_root = path.join(target_directory, ".staging")
+    if path.exists(staging_root):
+        for entry in os.listdir(staging_root):
+            if now - path.getmtime(path.join(staging_root, entry)) > staging_age:
+                logging.info("Removing abandoned staging directory: %s", path.join(staging_root, entry))
+                shutil.rmtree(path.join(staging_root, entry), ignore_errors=True)
+
+BuildDrop = namedtuple("BuildDrop", ["type_name", "branch", "revision", "path", "mtime"])
+
+def find_build_drops(target_directory):
+    """Find build drops of form <target_directory>/<type_name>/<branch>/<revision>.
+
+    Drops are identified as directories containing bin, lib or database directories or egg files.
+    Returns (drops, linked_paths), where linked_paths are the resolved targets of all links in the drop tree.
+    """
+    drops = []
+    linked_paths = set()
+
+    for type_name in os.listdir(target_directory):
+        type_directory = path.join(target_directory, type_name)
+        if type_name.startswith(".") or path.islink(type_directory) or not path.isdir(type_directory):
             continue
 
-        if library_file_pattern.search(l, build_product_match.start(), build_product_match.end()):
-            library_files.add(build_product_match.group())
+        for dirpath, dirnames, filenames in os.walk(type_directory):
+            for entry in dirnames + filenames:
+                if path.islink(path.join(dirpath, entry)):
+                    linked_paths.add(path.realpath(path.join(dirpath, entry)))
+
+            dirnames[:] = [d for d in dirnames if not d.startswith(".") and not path.islink(path.join(dirpath, d))]
+
+            if dirpath == type_directory:
+                continue
+
+            if set(dirnames) & set(["bin", "lib", "database"]) or any(f.endswith(".egg") for f in filenames):
+                branch, revision = path.split(path.relpath(dirpath, type_directory))
+                if branch:
+                    drops.append(BuildDrop(type_name, branch, revision, dirpath, path.getmtime(dirpath)))
+                dirnames[:] = []
+
+    return drops, linked_paths
+
+def select_expired_drops(drops, linked_paths, keep_last = None, max_age = None):
+    """Select drops beyond the newest keep_last drops of their type and branch, or older than max_age seconds.
+
+    Drops referenced by links, eg. 'current', are always retained.
+    """
+    now = time.time()
+    drops_by_branch = {}
+    for d in drops:
+        drops_by_branch.setdefault((d.type_name, d.branch), []).append(d)
+
+    expired_drops = []
+    for branch_drops in drops_by_branch.values():
+        for i, d in enumerate(sorted(branch_drops, key=lambda d: d.mtime, reverse=True)):
+            if path.realpath(d.path) in linked_paths:
+                continue
+
+            if (keep_last is not None and i >= keep_last) or (max_age is not None and now - d.mtime > max_age):
+                expired_drops.append(d)
+
+    return expired_drops
+
+def drop_object_references(drops):
+    """Content digests of store objects referenced by the file manifests of drops."""
+    references = set()
+    for d in drops:
+        if path.exists(path.join(d.path, drop_file_manifest_filename)):
+            references.update(entry[2] for entry in read_drop_file_manifest(d.path).values() if entry[2])
+    return references
+
+def drop_reclaimable_bytes(drop_path, retained_references = frozenset(), store_directory = None):
+    """Total bytes of files in drop not shared with retained drops.
+
+    Files are shared if their content digest is referenced by a retained drop, see drop_object_references,
+    or if hardlinked outside the drop other than to their object in store_directory.
+    """
+    drop_files = {}
+    if path.exists(path.join(drop_path, drop_file_manifest_filename)):
+        drop_files = read_drop_file_manifest(drop_path)
+
+    reclaimable_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(drop_path):
+        for f in filenames:
+            file_stat = os.lstat(path.join(dirpath, f))
+            if stat.S_ISLNK(file_stat.st_mode):
+                continue
+
+            digest = drop_files.get(path.relpath(path.join(dirpath, f), drop_path), (None, None, None))[2]
+            if digest in retained_references:
+                continue
+
+            links = file_stat.st_nlink
+            if digest and store_directory:
+                object_path = BuildObjectStore(store_directory).object_path(digest)
+                if path.exists(object_path) and path.samestat(os.stat(object_path), file_stat):
+                    links -= 1
+
+            if links <= 1:
+                reclaimable_bytes += file_stat.st_size
+    return reclaimable_bytes
+
+def throttled_remove_tree(tree, files_per_second = None):
+    """Remove directory tree, removing at most files_per_second files per second if provided."""
+    for dirpath, dirnames, filenames in os.walk(tree, topdown=False):
+        for f in filenames + [d for d in dirnames if path.islink(path.join(dirpath, d))]:
+            os.remove(path.join(dirpath, f))
+            if files_per_second:
+                time.sleep(1.0 / files_per_second)
+
+        for d in dirnames:
+            if not path.islink(path.join(dirpath, d)):
+                os.rmdir(path.join(dirpath, d))
+
+    os.rmdir(tree)
+
+def collect_object_store(target_directory, min_age = 60 * 60, files_per_second = None):
+    """Remove store objects not referenced by any drop and older than min_age seconds, returning bytes removed.
+
+    Objects are referenced by the file manifests of drops, see drop_object_references, rather than by link
+    count as reflinked objects share no inode with drops. The store is exclusively locked while references
+    are resolved and unreferenced objects are renamed into a trash entry, deploys hold the lock until drops
+    referencing added objects are published. The trash entry is removed at files_per_second after the lock
+    is released.
+    """
+    object_store = BuildObjectStore(path.join(target_directory, ".objects"))
+    if not path.exists(object_store.store_directory):
+        return 0
+
+    trash_root = path.join(target_directory, ".trash")
+    if not path.exists(trash_root):
+        os.makedirs(trash_root)
+
+    with object_store.lock(exclusive = True):
+        drops, linked_paths = find_build_drops(target_directory)
+        references = drop_object_references(drops)
+        logging.info("Resolved object references of %s drops: %s", len(drops), len(references))
+
+        trash_entry = tempfile.mkdtemp(dir=trash_root, prefix="%i.objects." % time.time())
+
+        now = time.time()
+        removed_bytes = 0
+        for dirpath, dirnames, filenames in os.walk(object_store.store_directory):
+            if dirpath == object_store.store_directory:
+                continue
+
+            for f in filenames:
+                digest = path.basename(dirpath) + f
+                if digest in references:
+                    continue
+
+                object_stat = os.lstat(path.join(dirpath, f))
+                if now - object_stat.st_mtime > min_age:
+                    os.rename(path.join(dirpath, f), path.join(trash_entry, digest))
+                    removed_bytes += object_stat.st_size
+
+    logging.info("Removing unreferenced store objects: %s", trash_entry)
+    throttled_remove_tree(trash_entry, files_per_second)
+
+    return removed_bytes
+
+def collect_build_drops(target_directory, keep_last = None, max_age = None, dry_run = False, jobs = None, background = False, files_per_second = None, trash_age = default_trash_age_days * 24 * 60 * 60):
+    """Remove drops expired under retention policy, see select_expired_drops.
+
+    Expired drops are scanned in parallel for reclaimable bytes and moved to trash. Trashed drops, along
+    with previously trashed drops older than trash_age seconds and unreferenced object store objects,
+    are then removed at files_per_second, in a detached background process if background.
+    """
+    drops, linked_paths = find_build_drops(target_directory)
+    expired_drops = select_expired_drops(drops, linked_paths, keep_last, max_age)
+    retained_references = drop_object_references(d for d in drops if d not in expired_drops)
+
+    scan_pool = ThreadPool(jobs or 1)
+    try:
+        reclaimable_bytes = scan_pool.map(
+                lambda drop_path: drop_reclaimable_bytes(drop_path, retained_references, path.join(target_directory, ".objects")),
+                [d.path for d in expired_drops])
+    finally:
+        scan_pool.terminate()
+        scan_pool.join()
+
+    for d, d_bytes in zip(expired_drops, reclaimable_bytes):
+        logging.info("Expired drop: %s reclaimable bytes: %s", d.path, d_bytes)
+    logging.info("Expired %s of %s drops, reclaimable bytes: %s", len(expired_drops), len(drops), sum(reclaimable_bytes))
+
+    if dry_run:
+        return
+
+    removal_entries = expired_trash_entries(target_directory, trash_age)
+    removal_entries.extend(move_to_trash(target_directory, d.path) for d in expired_drops)
+
+    if background:
+        pid = os.fork()
+        if pid:
+            logging.info("Removing %s trash entries in background process: %s", len(removal_entries), pid)
+            return
+
+        os.setsid()
+        os.nice(19)
+
+    try:
+        for entry in removal_entries:
+            logging.info("Removing trashed drop: %s", entry)
+            throttled_remove_tree(entry, files_per_second)
+
+        removed_bytes = collect_object_store(target_directory, files_per_second = files_per_second)
+        logging.info("Removed unreferenced store objects, bytes: %s", removed_bytes)
+    except:
+        if not background:
+            raise
+        logging.exception("Error removing expired drops in background process.")
+        os._exit(1)
+
+    if background:
+        os._exit(0)
+
+def resolve_build_products(rosetta_root, targets, mode = None, extras = None, revision = None, manifest_directory = None, refresh = False):
+    """Resolve binary and library build products, cached as product manifest for the given revision and build parameters.
+
+    manifest_directory - Product manifest cache directory, products are always resolved via test build if None.
+    refresh - Resolve products via test build, replacing any cached manifest.
+    """
+    manifest_key = json.dumps(dict(revision = revision, mode = mode, extras = extras, targets = sorted(targets)), sort_keys = True)
+    manifest_file = None
+    if manifest_directory and revision:
+        manifest_file = path.join(manifest_directory, hashlib.sha1(manifest_key).hexdigest() + ".json")
+
+    if manifest_file and path.exists(manifest_file) and not refresh:
+        logging.info("Loading cached build product manifest: %s", manifest_file)
+        with open(manifest_file) as manifest_in:
+            manifest = json.load(manifest_in)
+        return set(manifest["bins"]), set(manifest["libs"])
+
+    bins, libs = extract_build_products(perform_test_build(rosetta_root, targets, mode, extras))
+
+    if manifest_file:
+        logging.info("Caching build product manifest: %s", manifest_file)
+        if not path.exists(manifest_directory):
+            os.makedirs(manifest_directory)
+        with open(manifest_file + ".tmp.%s" % os.getpid(), "w") as manifest_out:
+            json.dump(dict(json.loads(manifest_key), bins = sorted(bins), libs = sorted(libs)), manifest_out, indent=2)
+        os.rename(manifest_file + ".tmp.%s" % os.getpid(), manifest_file)
+
+    return bins, libs
+
+def file_digest(file_path, block_size = 2**20):
+    """sha1 hex digest of file contents."""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def object_mode(source_mode):
+    """Read-only, world readable mode of store objects, executable by all if the source is executable (a-w,a+rX).
+
+    Objects are shared by drops, modes are final when added so drop permission fixes never modify shared objects.
+    """
+    mode = stat.S_IMODE(source_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+    if mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+        mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+    return mode
+
+class BuildObjectStore(object):
+    """Content-addressed store of archived build files, drops are materialized from the store via links."""
+
+    link_modes = ["hardlink", "reflink"]
+
+    def __init__(self, store_directory, link_mode = "hardlink"):
+        """Store within target directory, must share a filesystem with materialized drops.
+
+        store_directory - Object directory, objects are stored as <store_directory>/<digest[:2]>/<digest[2:]>.
+        link_mode - 'hardlink' or 'reflink', materialization falls back to copy if link is unsupported.
+        """
+        if link_mode not in self.link_modes:
+            raise ValueError("Unrecognized link mode: %s" % link_mode)
+
+        self.store_directory = store_directory
+        self.link_mode = link_mode
+
+        self.counter_lock = threading.Lock()
+        self.objects_added = 0
+        self.bytes_added = 0
+
+    def object_path(self, digest):
+        return path.join(self.store_directory, digest[:2], digest[2:])
+
+    @contextlib.contextmanager
+    def lock(self, exclusive = False):
+        """Hold store lock, shared by deploys and exclusive for collect_object_store.
+
+        Deploys hold the lock from adding objects until drops referencing the objects are published.
+        """
+        import fcntl
+
+        if not path.exists(self.store_directory):
+            try:
+                os.makedirs(self.store_directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        with open(path.join(self.store_directory, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def add(self, source, digest = None):
+        """Add file to store if not present, returning content digest."""
+        if digest is None:
+            digest = file_digest(source)
+
+        object_path = self.object_path(digest)
+        if path.exists(object_path):
+            return digest
+
+        if not path.exists(path.dirname(object_path)):
+            try:
+                os.makedirs(path.dirname(object_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Copy to private temp file and rename into place, objects are immutable once visible.
+        object_fd, object_temp = tempfile.mkstemp(dir=path.dirname(object_path), prefix=".tmp.")
+        try:
+            with os.fdopen(object_fd, "wb") as object_file, open(source, "rb") as source_file:
+                shutil.copyfileobj(source_file, object_file, 2**20)
+
+            os.chmod(object_temp, object_mode(os.stat(source).st_mode))
+            os.rename(object_temp, object_path)
+        except:
+            if path.exists(object_temp):
+                os.remove(object_temp)
+            raise
+
+        with self.counter_lock:
+            self.objects_added += 1
+            self.bytes_added += os.stat(object_path).st_size
+
+        return digest
+
+    def materialize(self, digest, target):
+        """Materialize stored object at target path."""
+        object_path = self.object_path(digest)
+
+        try:
+            if self.link_mode == "hardlink":
+                os.link(object_path, target)
+            else:
+                reflink_file(object_path, target)
+            return
+        except (OSError, IOError) as e:
+            logging.debug("Unable to %s object, copying: %s %s %s", self.link_mode, object_path, target, e)
+            if path.lexists(target):
+                os.remove(target)
+
+        shutil.copy2(object_path, target)
+
+    def archive_file(self, source, target):
+        """Add source file to store and materialize at target, returning content digest."""
+        digest = self.add(source)
+        self.materialize(digest, target)
+        return digest
+
+def reflink_file(source, target):
+    """Clone source into new target file via FICLONE ioctl, raises IOError if unsupported by filesystem."""
+    import fcntl
+    FICLONE = 0x40049409
+
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copymode(source, target)
+
+def copy_file(source, target, buffer_size = 16 * 2**20):
+    """Copy file contents and stat, via sendfile if available else with large buffers."""
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        if hasattr(os, "sendfile"):
+            source_size = os.fstat(source_file.fileno()).st_size
+            offset = 0
+            while offset < source_size:
+                sent = os.sendfile(target_file.fileno(), source_file.fileno(), offset, source_size - offset)
+                if not sent:
+                    break
+                offset += sent
         else:
-            binary_files.add(build_product_match.group())
-    if not binary_files and not library_files:
-        raise ValueError("No build products resolve from build result summary, likely build failure.")
+            shutil.copyfileobj(source_file, target_file, buffer_size)
 
-    return binary_files, library_files
+    shutil.copystat(source, target)
 
-def get_bin_name(build_binary):
-    """Convert binary path to base name, strips off additional build parameters added to binary name."""
-    binary_basename = path.basename(build_binary)
-    if not binary_basename.find("."):
-        return binary_basename
-    else:
-        return binary_basename[:binary_basename.find(".")]
+drop_file_manifest_filename = "drop_file_manifest.json"
+
+def read_drop_file_manifest(drop_directory):
+    """Read drop file manifest, {drop_path : (source size, source mtime, digest or None)}."""
+    with open(path.join(drop_directory, drop_file_manifest_filename)) as manifest_file:
+        return dict((drop_path, tuple(entry)) for drop_path, entry in json.load(manifest_file).items())
+
+def write_drop_file_manifest(drop_directory, drop_files):
+    with open(path.join(drop_directory, drop_file_manifest_filename), "w") as manifest_file:
+        json.dump(drop_files, manifest_file, sort_keys=True)
+
+def resolve_previous_drop(target_directory, branch, revision, type_name):
+    """Resolve previous drop of branch for incremental archive.
+
+    Returns drop directory of the branch's current link if present, else the
+    most recent drop of the branch with a drop file manifest, or None.
+    """
+    branch_directory = path.join(target_directory, type_name, branch)
+    if not path.isdir(branch_directory):
+        return None
+
+    current = path.join(branch_directory, "current")
+    if path.islink(current) and path.exists(path.join(current, drop_file_manifest_filename)):
+        return path.realpath(current)
+
+    candidates = [
+            path.join(branch_directory, d) for d in os.listdir(branch_directory)
+            if not d.startswith(".") and not path.islink(path.join(branch_directory, d))]
+    candidates = [c for c in candidates if path.exists(path.join(c, drop_file_manifest_filename))]
+
+    if not candidates:
+        return None
+
+    return max(candidates, key=path.getmtime)
+
+def link_unchanged_file(source, source_stat, target, previous_drop, drop_path, previous_entry):
+    """Hardlink target from previous drop if source is unchanged from previous drop file manifest entry.
+
+    Source is unchanged if size and mtime match, or if size and content digest match.
+    Returns (digest, linked).
+    """
+    if not previous_entry:
+        return None, False
+
+    previous_size, previous_mtime, previous_digest = previous_entry
+    if source_stat.st_size != previous_size:
+        return None, False
+
+    digest = previous_digest
+    if source_stat.st_mtime != previous_mtime:
+        if not previous_digest:
+            return None, False
 
-def get_lib_name(build_library):
-    """Convert library path to base name."""
-    library_basename = path.basename(build_library)
-    return library_basename
+        digest = file_digest(source)
+        if digest != previous_digest:
+            return digest, False
 
-def archive_build_products(rosetta_root, target_bins, target_libs, target_directory):
-    """Copy binaries, libraries, and database into target directory."""
+    try:
+        os.link(path.join(previous_drop, drop_path), target)
+    except OSError as e:
+        logging.debug("Unable to link from previous drop, archiving: %s %s", drop_path, e)
+        return None, False
+
+    return digest, True
+
+def perform_archive_tasks(archive_tasks, archive_file, jobs = None):
+    """Perform (source, target) file archive tasks, concurrently in a pool of jobs threads if jobs > 1.
+
+    Returns list of archive_file results.
+    """
+    def archive_task(task):
+        source, target = task
+        return archive_file(source, target)
+
+    if not (jobs and jobs > 1):
+        return [archive_task(t) for t in archive_tasks]
+
+    archive_pool = ThreadPool(jobs)
+    try:
+        return list(archive_pool.imap_unordered(archive_task, archive_tasks))
+    finally:
+        archive_pool.terminate()
+        archive_pool.join()
+
+def archive_counters(archive_results, wall_time = None):
+    """File and byte counters of archive results, with throughput if wall_time is given."""
+    counters = {
+            "files" : len(archive_results),
+            "bytes" : sum(entry[0] for drop_path, entry, linked in archive_results),
+            "linked_files" : sum(1 for drop_path, entry, linked in archive_results if linked),
+            "linked_bytes" : sum(entry[0] for drop_path, entry, linked in archive_results if linked),
+            }
+
+    if wall_time is not None:
+        counters["wall_time"] = wall_time
+        if wall_time > 0:
+            counters["throughput"] = counters["bytes"] / wall_time
+
+    return counters
+
+def archive_build_products(rosetta_root, target_bins, target_libs, target_directory, object_store = None, jobs = None, artifact = None, incremental = False, previous_drop = None):
+    """Copy binaries, libraries, and database into target directory.
+
+    Source size, mtime and content digest of archived files are recorded in
+    the drop file manifest.
+
+    object_store - BuildObjectStore, files are archived via the store rather than copied if provided.
+    jobs - Number of concurrent file archive threads.
+    artifact - DropArtifact, archived files are added to artifact as they are materialized if provided.
+    incremental - Record content digests of all archived files, for use by later incremental drops.
+    previous_drop - Drop directory, files unchanged from the previous drop's file manifest are hardlinked from the previous drop.
+
+    Returns dict of file and byte counters, with per-category counters and
+    wall time of binary and library ("products") and database archiving.
+    """
     database_drop_dir = path.join(target_directory, "database")
     bin_drop_dir = path.join(target_directory, "bin")
     lib_drop_dir = path.join(target_directory, "lib")
 
+    if object_store:
+        materialize_file = object_store.archive_file
+    else:
+        materialize_file = copy_file
+
+    previous_files = {}
+    if previous_drop:
+        previous_files = read_drop_file_manifest(previous_drop)
+        logging.info("Archiving incrementally from previous drop: %s files: %s", previous_drop, len(previous_files))
+
+    def archive_file(source, target):
+        drop_path = path.relpath(target, target_directory)
+        source_stat = os.stat(source)
+
+        digest, linked = link_unchanged_file(source, source_stat, target, previous_drop, drop_path, previous_files.get(drop_path))
+        if not linked:
+            digest = materialize_file(source, target)
+
+        if digest is None and incremental:
+            digest = file_digest(target)
+
+        if artifact:
+            artifact.add(target)
+
+        return drop_path, (source_stat.st_size, source_stat.st_mtime, digest), linked
+
+    archive_tasks = []
+    bin_links = []
+
     os.makedirs(bin_drop_dir)
     for b in target_bins:
         b_source = path.join(rosetta_root, "source", b)
         b_target = path.join(bin_drop_dir, get_bin_name(b))
         logging.info("Archive bin: %s %s", b_source, b_target)
         #Copy file with stripped filename and then symlink under old name
-        shutil.copy(b_source, b_target)
-
-        b_link_target = path.join(bin_drop_dir, path.basename(b))
-        logging.info("Linking bin: %s %s", get_bin_name(b), b_link_target)
-        os.symlink(get_bin_name(b), b_link_target)
+        archive_tasks.append((b_source, b_target))
+        bin_links.append((get_bin_name(b), path.join(bin_drop_dir, path.basename(b))))
 
     os.makedirs(lib_drop_dir)
     for l in target_libs:
         l_source = path.join(rosetta_root, "source", l)
         l_target = path.join(lib_drop_dir, get_lib_name(l))
         logging.info("Archive lib: %s %s", l_source, l_target)
-        shutil.copy(l_source, l_target)
+        archive_tasks.append((l_source, l_target))
 
     source_database = path.join(rosetta_root, "database")
     logging.info("Archive database: %s %s", source_database, database_drop_dir)
-    shutil.copytree(source_database, database_drop_dir)
+    database_dirs = []
+    database_tasks = []
+    for source_dir, dirnames, filenames in os.walk(source_database, followlinks=True):
+        target_dir = path.join(database_drop_dir, path.relpath(source_dir, source_database))
+        os.makedirs(target_dir)
+        database_dirs.append((source_dir, target_dir))
+
+        database_tasks.extend((path.join(source_dir, f), path.join(target_dir, f)) for f in filenames)
+
+    # Binaries and libraries are archived as a separate batch from the database,
+    # so that the two are timed separately.
+    category_counters = {}
+    archive_results = []
+    for category, category_tasks in (("products", archive_tasks), ("database", database_tasks)):
+        logging.info("Archiving %s %s files with %s jobs.", len(category_tasks), category, jobs or 1)
+        start_time = time.time()
+        category_results = perform_archive_tasks(category_tasks, archive_file, jobs)
+        category_counters[category] = archive_counters(category_results, time.time() - start_time)
+        archive_results.extend(category_results)
+
+    write_drop_file_manifest(target_directory, dict((drop_path, entry) for drop_path, entry, linked in archive_results))
+
+    for source_dir, target_dir in database_dirs:
+        shutil.copystat(source_dir, target_dir)
+
+    for bin_name, bin_link in bin_links:
+        logging.info("Linking bin: %s %s", bin_name, bin_link)
+        os.symlink(bin_name, bin_link)
+        if artifact:
+            artifact.add(bin_link)
+
+    counters = archive_counters(archive_results)
+    counters.update(category_counters)
+    return counters
+
+database_cache_patterns = ["rotamer/ExtendedOpt1-5/*"]
+database_warmup_binaries = ["score_jd2", "rosetta_scripts", "relax"]
+
+class DatabaseWarmupError(Exception):
+    pass
+
+def file_state(file_path):
+    """(size, mtime) of file."""
+    file_stat = os.lstat(file_path)
+    return (file_stat.st_size, file_stat.st_mtime)
+
+def database_file_states(database_directory):
+    """Return {relative_path : (size, mtime)} of all files in database directory."""
+    states = {}
+    for dirpath, dirnames, filenames in os.walk(database_directory):
+        for f in filenames:
+            file_path = path.join(dirpath, f)
+            states[path.relpath(file_path, database_directory)] = file_state(file_path)
+
+    return states
+
+def database_cache_files(database_directory, cache_patterns):
+    """Return relative paths of non-empty database cache files matching any of cache_patterns.
+
+    Caches archived from the source database are reused rather than rewritten by warm-up, empty files are
+    left by interrupted cache generation.
+    """
+    cache_files = set()
+    for pattern in cache_patterns:
+        cache_files.update(
+                path.relpath(f, database_directory)
+                for f in glob.glob(path.join(database_directory, pattern))
+                if path.isfile(f) and path.getsize(f) > 0)
+
+    return sorted(cache_files)
+
+def fix_database_permissions(database_directory):
+    """Grant read access to all, and execute access to directories and executables (chmod -R a+rX)."""
+    for dirpath, dirnames, filenames in os.walk(database_directory):
+        for p in [dirpath] + [path.join(dirpath, f) for f in filenames]:
+            mode = os.lstat(p).st_mode
+            if stat.S_ISLNK(mode):
+                continue
+
+            target_mode = mode | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+            if stat.S_ISDIR(mode) or mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+                target_mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+            if target_mode != mode:
+                os.chmod(p, stat.S_IMODE(target_mode))
+
+def resolve_warmup_binaries(drop_directory, test_binary = None):
+    """Resolve drop binaries to attempt database warm-up with, in order of preference.
+
+    Only test_binary and database_warmup_binaries are attempted, other drop binaries may
+    require mpi, interactive input or long-running protocols.
+    """
+    candidates = ([test_binary] if test_binary else []) + [b for b in database_warmup_binaries if b != test_binary]
+
+    return [
+            path.join(drop_directory, "bin", b) for b in candidates
+            if path.isfile(path.join(drop_directory, "bin", b)) and not path.islink(path.join(drop_directory, "bin", b))]
+
+def warmup_command(rosetta_root, binary, build_type = None):
+    """Generate database warm-up command for binary under build_type."""
+    command = []
+
+    if build_type == "mpi":
+        mpirun = find_executable("mpirun")
+        if not mpirun:
+            raise DatabaseWarmupError("Unable to resolve mpirun executable for mpi build.")
+        command.extend(["mpirun", "--prefix", path.dirname(path.dirname(mpirun))])
+    elif build_type:
+        raise DatabaseWarmupError("Unrecognized warm-up build type: %s" % build_type)
 
-def setup_build_products(rosetta_root, drop_directory, build_type = None, test_binary = None):
-    """Execute single rosetta binary to setup rosetta database.
+    command.extend([binary, "-s", path.join(rosetta_root, "source/test/core/io/test_in.pdb")])
+
+    return command
+
+def warm_build_database(rosetta_root, drop_directory, build_type = None, test_binary = None, cache_patterns = database_cache_patterns):
+    """Generate, verify and checksum drop database caches, then make database world readable.
+
+    Warm-up binaries, see resolve_warmup_binaries, are executed in order of
+    preference until a binary succeeds and expected cache files are present,
+    either generated or archived from the source database. Expected cache files
+    and files created or modified during warm-up are recorded with checksums in
+    database_cache_manifest.json in the drop directory. Independent drops may be
+    warmed concurrently.
 
         rosetta_root - Rosetta main root directory.
         drop_directory - Archived drop directory to search for bin & database.
         build_type - 'mpi' if build requires mpirun, else None.
-        test_binary - Binary to execute, resolves score_jd2, rosetta_scripts, or relax if None.
+        test_binary - Preferred warm-up binary name.
+        cache_patterns - Database-relative glob patterns of cache files expected after warm-up.
+
+    Raises DatabaseWarmupError if expected caches can not be generated.
+    Returns cache manifest, None if the drop contains no warm-up binaries.
     """
-    candidate_binaries = ["score_jd2", "rosetta_scripts", "relax"]
-    if test_binary:
-        candidate_binaries.insert(0, test_binary)
+    database_directory = path.join(drop_directory, "database")
 
-    tmpdir = tempfile.mkdtemp()
+    warmup_binaries = resolve_warmup_binaries(drop_directory, test_binary)
+    if not warmup_binaries:
+        logging.warning("Unable to resolve database warm-up binary, skipping warm-up: %s candidates: %s",
+                drop_directory, ([test_binary] if test_binary else []) + database_warmup_binaries)
+        return None
 
-    try:
-        test_binary = None
-        for c in candidate_binaries:
-            c_full = path.join(drop_directory, "bin", c)
-            if path.exists(c_full):
-                test_binary = c_full
-                break
-
-        if not test_binary:
-            logging.warning("Unable to resolve test binary from candidate binaries: %s", candidate_binaries)
+    initial_states = database_file_states(database_directory)
+
+    attempts = []
+    for binary in warmup_binaries:
+        command = warmup_command(rosetta_root, binary, build_type)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logging.info("Executing binary to prepare target database: %s", command)
+            returncode = subprocess.call(command, cwd=tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        attempts.append((path.basename(binary), returncode))
+        if returncode != 0:
+            logging.warning("Database warm-up binary failed: %s returncode: %s", binary, returncode)
+            continue
+
+        if not cache_patterns or database_cache_files(database_directory, cache_patterns):
+            break
+        logging.warning("Database warm-up binary did not generate expected caches: %s %s", binary, cache_patterns)
+    else:
+        raise DatabaseWarmupError(
+                "Unable to prepare database caches: %s attempts: %s" % (database_directory, attempts))
+
+    fix_database_permissions(database_directory)
+
+    final_states = database_file_states(database_directory)
+    cache_files = set(f for f, s in final_states.items() if initial_states.get(f) != s)
+    cache_files.update(database_cache_files(database_directory, cache_patterns))
+
+    cache_manifest = {
+            "build_type" : build_type,
+            "attempts" : attempts,
+            "cache_patterns" : cache_patterns,
+            "files" : dict((f, file_digest(path.join(database_directory, f))) for f in sorted(cache_files)),
+            }
+    with open(path.join(drop_directory, "database_cache_manifest.json"), "w") as manifest_file:
+        json.dump(cache_manifest, manifest_file, indent=2, sort_keys=True)
+
+    logging.info("Prepared database caches: %s files: %s", database_directory, len(cache_files))
+
+    return cache_manifest
+
+def frame_compressor(compression):
+    """Create compressor for artifact, returning function compressing data as an independent gzip member or zstd frame.
+
+    Concatenated frames form a valid gzip or zstd stream. zstd frames are compressed by a single
+    zstandard compression context per artifact.
+    """
+    if compression == "gzip":
+        def compress_gzip_frame(data):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        return compress_gzip_frame
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd artifact compression requires the zstandard module.")
+        return zstandard.ZstdCompressor(level=3).compress
+    else:
+        raise ValueError("Unrecognized artifact compression: %s" % compression)
+
+def decompress_frame(data, compression):
+    """Decompress single frame generated by frame_compressor."""
+    if compression == "gzip":
+        return zlib.decompress(data, 31)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd artifact compression requires the zstandard module.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError("Unrecognized artifact compression: %s" % compression)
+
+class FrameCompressionWriter(object):
+    """Write-only file object compressing output in independently decompressable frames.
+
+    frames - List of (uncompressed_offset, uncompressed_size, compressed_offset, compressed_size).
+    """
+
+    def __init__(self, fileobj, compression, frame_size = 4 * 2**20):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.compress_frame = frame_compressor(compression)
+        self.frame_size = frame_size
+
+        self.frames = []
+        self.offset = 0
+        self.compressed_offset = 0
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+
+        if self.buffered >= self.frame_size:
+            self.flush_frame()
+
+    def flush_frame(self):
+        if not self.buffered:
             return
 
-        test_command = []
+        data = "".join(self.buffer)
+        compressed = self.compress_frame(data)
+        self.fileobj.write(compressed)
 
-        if build_type=="mpi":
-            try:
-                mpi_prefix = re.search(
-                        "(.*)bin/mpirun",
-                        subprocess.check_output("which mpirun", shell=True)).group(1)
-            except subprocess.CalledProcessError:
-                logging.warning("setup_build_products unable to resolve mpirun executable for mpi build.")
-                return
+        self.frames.append((self.offset, len(data), self.compressed_offset, len(compressed)))
+        self.offset += len(data)
+        self.compressed_offset += len(compressed)
+        self.buffer = []
+        self.buffered = 0
 
-            test_command.extend(["mpirun", "--prefix", mpi_prefix])
-        elif build_type:
-            logging.warning("Unrecognized setup_build_products build type: %s", build_type)
+    def close(self):
+        self.flush_frame()
 
-        test_command.extend([test_binary, "-s", path.join(rosetta_root, "source/test/core/io/test_in.pdb")])
+class _DigestReader(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha1()
 
-        logging.info("Executing test binary to prepare target database: %s", test_command)
-        subprocess.call(test_command, cwd=tmpdir)
+    def read(self, size = -1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
 
-        if build_type=="mpi":
-            logging.info("Updating mpi database permissions: %s", test_command)
-            subprocess.call("chmod a+r %s/database/rotamer/ExtendedOpt1-5/*" % drop_directory, shell=True, cwd=tmpdir)
+class DropArtifact(object):
+    """Compressed, seekable tar artifact of a build drop.
 
-    finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+    The artifact is a tar stream compressed in independent frames, members are
+    added by a writer thread concurrently with drop materialization. An index
+    sidecar records frame and member offsets, allowing single member extraction
+    via extract_artifact_member. A drop manifest of bins, libs and member
+    checksums is embedded as the final archive member.
+    """
 
+    artifact_filename = "drop_artifact.tar"
+    manifest_member = "DROP_MANIFEST.json"
+    compression_extensions = {"gzip" : ".gz", "zstd" : ".zst"}
 
+    def __init__(self, drop_directory, compression = None, frame_size = 4 * 2**20):
+        """Open artifact within drop directory and start writer thread.
 
+        drop_directory - Drop directory, member names are relative to drop directory.
+        compression - "zstd" or "gzip", zstd if the zstandard module is available if None.
+        frame_size - Uncompressed size of independent compression frames.
+        """
+        if compression is None:
+            compression = "zstd" if zstandard is not None else "gzip"
 
-if __name__ == "__main__":
-    import argparse
+        self.drop_directory = drop_directory
+        self.compression = compression
+        self.frame_size = frame_size
 
-    parser = argparse.ArgumentParser(description="Process scons build tree.")
-    parser.add_argument("target_directory")
-    parser.add_argument("targets", nargs="+")
-    parser.add_argument("--mode", default=None)
-    parser.add_argument("--extras", default=None)
-    parser.add_argument("--branch", default=None)
-    parser.add_argument("--revision", default=None)
-    parser.add_argument("--build_name", default=None)
-    parser.add_argument("--force", default=False, action='store_true')
-    parser.add_argument("--link_current", default=False, action='store_true')
+        self.artifact_path = path.join(drop_directory, self.artifact_filename + self.compression_extensions[compression])
+        self.index_path = self.artifact_path + ".index.json"
 
-    args = parser.parse_args()
+        self.members = {}
+        self.added = set()
+        self.error = None
 
-    rosetta_root = subprocess.check_output("git rev-parse --show-toplevel".split(" ")).strip()
-    logging.info("Resolved root directory: %s", rosetta_root)
-    if not rosetta_root:
-        raise ValueError("Unable to resolve Rosetta root directory.")
+        self.member_queue = Queue.Queue()
+        self.writer_thread = threading.Thread(target=self._write_members)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def add(self, member_path):
+        """Queue file or link within drop directory for addition to artifact."""
+        name = path.relpath(member_path, self.drop_directory)
+        self.added.add(name)
+        self.member_queue.put((member_path, name))
+
+    def add_missing(self, directory):
+        """Queue all files and links within directory not yet added to artifact."""
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for f in filenames:
+                member_path = path.join(dirpath, f)
+                if member_path in (self.artifact_path, self.index_path):
+                    continue
+                if path.relpath(member_path, self.drop_directory) not in self.added:
+                    self.add(member_path)
+
+    def close(self, manifest = None):
+        """Add drop manifest, complete artifact and write artifact index.
+
+        manifest - Dict of drop properties, member checksums are added under "files".
+        """
+        self.member_queue.put(None)
+        self.writer_thread.join()
+        if self.error:
+            raise self.error
+
+        manifest = dict(manifest or {})
+        manifest["files"] = dict((name, member["sha1"]) for name, member in self.members.items() if "sha1" in member)
+        manifest_data = json.dumps(manifest, indent=2, sort_keys=True)
+
+        manifest_info = tarfile.TarInfo(self.manifest_member)
+        manifest_info.size = len(manifest_data)
+        manifest_info.mtime = time.time()
+        self._add_member(manifest_info, StringIO.StringIO(manifest_data))
+
+        self.tar.close()
+        self.frame_writer.close()
+        self.artifact_file.close()
+
+        with open(self.index_path, "w") as index_file:
+            json.dump({
+                "compression" : self.compression,
+                "frames" : self.frame_writer.frames,
+                "members" : self.members,
+                }, index_file)
+
+        logging.info(
+                "Wrote drop artifact: %s members: %s frames: %s uncompressed: %s compressed: %s",
+                self.artifact_path, len(self.members), len(self.frame_writer.frames),
+                self.frame_writer.offset, self.frame_writer.compressed_offset)
+
+    def _write_members(self):
+        try:
+            self.artifact_file = open(self.artifact_path, "wb")
+            self.frame_writer = FrameCompressionWriter(self.artifact_file, self.compression, self.frame_size)
+            self.tar = tarfile.open(fileobj=self.frame_writer, mode="w|")
+
+            while True:
+                member = self.member_queue.get()
+                if member is None:
+                    break
+
+                member_path, name = member
+                member_info = self.tar.gettarinfo(member_path, name)
+                if member_info.islnk():
+                    # Hardlinked drop files, eg. store objects, are stored as regular members with data and checksum
+                    member_info.type = tarfile.REGTYPE
+                    member_info.linkname = ""
+                    member_info.size = os.stat(member_path).st_size
+
+                if member_info.isreg():
+                    with open(member_path, "rb") as member_file:
+                        self._add_member(member_info, member_file)
+                else:
+                    self._add_member(member_info)
+        except Exception as error:
+            logging.exception("Error writing drop artifact: %s", self.artifact_path)
+            self.error = error
+
+    def _add_member(self, member_info, member_file = None):
+        if member_file is not None:
+            member_file = _DigestReader(member_file)
+
+        self.tar.addfile(member_info, member_file)
+
+        # Stream mode does not record data offsets, member data ends at block padded end of member.
+        member = {"size" : member_info.size}
+        if member_file is not None:
+            padded_size = -(-member_info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            member["offset"] = self.tar.offset - padded_size
+            member["sha1"] = member_file.digest.hexdigest()
+        self.members[member_info.name] = member
+
+def extract_artifact_member(artifact_path, member_name):
+    """Extract single member data from drop artifact, decompressing only frames containing member.
+
+    artifact_path - DropArtifact artifact path, index is read from index sidecar.
+    member_name - Drop-relative member name.
+    """
+    with open(artifact_path + ".index.json") as index_file:
+        index = json.load(index_file)
+
+    member = index["members"][member_name]
+    if "offset" not in member:
+        raise ValueError("Artifact member has no data: %s" % member_name)
+
+    member_start = member["offset"]
+    member_end = member_start + member["size"]
+
+    member_data = []
+    with open(artifact_path, "rb") as artifact_file:
+        for offset, size, compressed_offset, compressed_size in index["frames"]:
+            if offset + size <= member_start or offset >= member_end:
+                continue
+
+            artifact_file.seek(compressed_offset)
+            frame = decompress_frame(artifact_file.read(compressed_size), index["compression"])
+            member_data.append(frame[max(member_start - offset, 0):member_end - offset])
+
+    member_data = "".join(member_data)
+    if hashlib.sha1(member_data).hexdigest() != member["sha1"]:
+        raise ValueError("Artifact member checksum mismatch: %s" % member_name)
+
+    return member_data
+
+class DeployPhaseTimer(object):
+    """Record wall time and file and byte counters of deploy phases."""
+
+    report_start = "Deploy timing report"
+    report_end = "End of Deploy timing report"
+    report_filename = "deploy_timing.json"
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = []
+        self.variants = {}
+
+    def variant(self, name):
+        """Create child timer, reported under "variants" in report."""
+        timer = DeployPhaseTimer()
+        self.variants[name] = timer
+        return timer
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time phase, yielding counter dict to be updated by the phase.
 
-    drop_parameters = resolve_build_drop_parameters( args.branch, args.revision, args.mode, args.extras, args.build_name)
-    drop_directory = resolve_build_drop_directory(args.target_directory, **drop_parameters)
+        Throughput is reported for phases with a "bytes" counter.
+        """
+        counters = {}
+        start_time = time.time()
+        try:
+            yield counters
+        finally:
+            wall_time = time.time() - start_time
+
+            phase = dict(counters, phase = name, wall_time = wall_time)
+            if "bytes" in counters and wall_time > 0:
+                phase["throughput"] = counters["bytes"] / wall_time
+
+            logging.info("Deploy phase %s: %.2fs %s", name, wall_time, counters)
+            self.phases.append(phase)
+
+    def report(self):
+        report = {
+                "start_time" : self.start_time,
+                "total_time" : time.time() - self.start_time,
+                "phases" : self.phases,
+                }
+
+        if self.variants:
+            report["variants"] = dict((name, timer.report()) for name, timer in self.variants.items())
+
+        return report
+
+    def write(self, drop_directory):
+        """Write report as json sidecar in drop directory."""
+        report_fd, report_temp = tempfile.mkstemp(dir=drop_directory, prefix=".tmp.")
+        with os.fdopen(report_fd, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True)
+        os.chmod(report_temp, 0o644)
+        os.rename(report_temp, path.join(drop_directory, self.report_filename))
+
+    def print_report(self):
+        """Print report to stdout between report markers."""
+        sys.stdout.write("%s\n%s\n%s\n" % (self.report_start, json.dumps(self.report(), indent=2, sort_keys=True), self.report_end))
+        sys.stdout.flush()
+
+DeployVariant = namedtuple("DeployVariant", ["mode", "extras", "targets"])
+
+def parse_deploy_variant(variant):
+    """Parse deploy variant of form <mode>:<extras>:<target>[,<target>...], empty mode or extras are unset."""
+    fields = variant.split(":")
+    if len(fields) != 3 or not fields[2]:
+        raise ValueError("Invalid deploy variant, expected <mode>:<extras>:<targets>: %s" % variant)
+
+    mode, extras, targets = fields
+    return DeployVariant(mode or None, extras or None, targets.split(","))
+
+def format_deploy_variant(variant):
+    return "%s:%s:%s" % (variant.mode or "", variant.extras or "", ",".join(variant.targets))
+
+def current_umask():
+    """Return process umask.
+
+    The umask can only be read by setting it, not safe to call concurrently with file creation in other threads.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def make_staging_directory(target_directory, prefix, umask):
+    """Create staging directory within target directory, with permissions of umask."""
+    staging_root = path.join(target_directory, ".staging")
+    if not path.exists(staging_root):
+        try:
+            os.makedirs(staging_root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    staging_directory = tempfile.mkdtemp(dir=staging_root, prefix=prefix)
+    os.chmod(staging_directory, 0o777 & ~umask)
+
+    return staging_directory
+
+def stage_shared_database(rosetta_root, target_directory, umask, object_store = None, jobs = None):
+    """Archive database once into a staging directory, used as previous drop of concurrently deployed variants.
+
+    Returns (staging directory, archive counters), staging directory is removed by the caller after deploy.
+    """
+    staging_directory = make_staging_directory(target_directory, "database.", umask)
+    logging.info("Staging shared database: %s", staging_directory)
+
+    try:
+        counters = archive_build_products(rosetta_root, [], [], staging_directory, object_store, jobs)
+    except:
+        shutil.rmtree(staging_directory, ignore_errors=True)
+        raise
+
+    return staging_directory, counters
+
+def resolve_variant_products(rosetta_root, options, variant, timer):
+    """Resolve (bins, libs) of variant, timed as the resolve_products phase of timer.
+
+    Product resolution performs a dependency scan in the build tree, not safe to call concurrently within a checkout.
+    """
+    revision = resolve_build_drop_parameters(options.branch, options.revision, variant.mode, variant.extras, options.build_name)["revision"]
+
+    with timer.phase("resolve_products") as counters:
+        bins, libs = resolve_build_products(
+                rosetta_root, variant.targets, variant.mode, variant.extras, revision,
+                manifest_directory = path.join(options.target_directory, ".manifests"), refresh = options.refresh_manifest)
+        counters.update(bins = len(bins), libs = len(libs))
+
+    return bins, libs
+
+def deploy_build_drop(rosetta_root, options, variant, timer, umask, object_store = None, shared_database = None, products = None):
+    """Resolve, archive, warm and publish build drop of a single variant.
+
+    rosetta_root - Rosetta main root directory.
+    options - Parsed deploy command line options.
+    variant - DeployVariant to deploy.
+    timer - DeployPhaseTimer, timing report is written into published drop.
+    umask - Process umask, see current_umask, applied to the staging directory.
+    object_store - BuildObjectStore, files are archived via the store if provided.
+    shared_database - Staged shared database, database files are linked from the shared database if provided.
+    products - (bins, libs) of variant, resolved via resolve_variant_products if not provided.
+
+    Returns published drop directory.
+    """
+    drop_parameters = resolve_build_drop_parameters( options.branch, options.revision, variant.mode, variant.extras, options.build_name)
+    drop_directory = resolve_build_drop_directory(options.target_directory, **drop_parameters)
     logging.info("Resolved drop directory: %s", drop_directory)
 
     if path.exists(drop_directory):
         logging.warning("Existing drop directory: %s", drop_directory)
-        if args.force:
-            logging.warning("Removing existing drop directory: %s", drop_directory)
-            shutil.rmtree(drop_directory, ignore_errors=True)
+        if options.force:
+            logging.warning("Replacing existing drop directory: %s", drop_directory)
         else:
             raise ValueError("Drop directory already exists: %s" % drop_directory)
 
-    build_result = perform_test_build(rosetta_root, args.targets, args.mode, args.extras)
+    bins, libs = products or resolve_variant_products(rosetta_root, options, variant, timer)
+
+    # Drop is built in staging directory within target directory, then renamed into place.
+    staging_directory = make_staging_directory(options.target_directory, drop_parameters["revision"] + ".", umask)
+    logging.info("Staging drop directory: %s", staging_directory)
+
+    try:
+        artifact = None
+        if options.artifact:
+            artifact = DropArtifact(staging_directory, options.artifact_compression)
+            logging.info("Writing drop artifact: %s", artifact.artifact_path)
+
+        previous_drop = shared_database
+        if options.incremental and not shared_database:
+            previous_drop = resolve_previous_drop(options.target_directory, **drop_parameters)
+            if not previous_drop:
+                logging.warning("No previous drop with file manifest, archiving all files.")
+
+        with timer.phase("archive") as counters:
+            counters.update(archive_build_products(
+                    rosetta_root, bins, libs, staging_directory, object_store, options.jobs, artifact,
+                    incremental = options.incremental, previous_drop = previous_drop))
+            if previous_drop:
+                counters["previous_drop"] = previous_drop
+            if object_store and not shared_database:
+                counters.update(objects_added = object_store.objects_added, object_bytes_added = object_store.bytes_added)
+
+        build_type = None
+        if variant.extras and re.search("mpi", variant.extras):
+            build_type = "mpi"
+
+        if options.skip_warmup:
+            logging.warning("Skipping database warm-up: %s", staging_directory)
+        else:
+            with timer.phase("warmup") as counters:
+                cache_manifest = warm_build_database(
+                        rosetta_root, staging_directory, build_type = build_type,
+                        test_binary = options.warmup_binary, cache_patterns = options.warmup_cache_pattern or database_cache_patterns)
+                counters["files"] = len(cache_manifest["files"]) if cache_manifest else 0
+
+        if artifact:
+            with timer.phase("artifact") as counters:
+                # Include database caches and manifests generated during setup
+                artifact.add_missing(staging_directory)
+                artifact.close(dict(
+                    drop_parameters,
+                    bins = sorted(get_bin_name(b) for b in bins),
+                    libs = sorted(get_lib_name(l) for l in libs)))
+                counters.update(
+                        files = len(artifact.members),
+                        bytes = artifact.frame_writer.offset,
+                        compressed_bytes = artifact.frame_writer.compressed_offset)
+
+        with timer.phase("publish"):
+            publish_drop(options.target_directory, staging_directory, drop_directory)
+    except:
+        shutil.rmtree(staging_directory, ignore_errors=True)
+        raise
+
+    if options.link_current:
+        with timer.phase("link"):
+            setup_drop_links("current", options.target_directory, **drop_parameters)
+
+    timer.write(drop_directory)
+
+    return drop_directory
+
+def deploy_build_variants(rosetta_root, options, variants, timer, umask, object_store = None):
+    """Deploy build drops of multiple variants concurrently.
+
+    The database is archived once into a shared staging directory and linked
+    into each variant drop. Variant products are resolved serially, as the
+    dependency scans share the build tree, then archive and warm-up of
+    variants overlap. Variant timing is reported as child timers of timer.
+
+    Raises RuntimeError after all variants complete if any variant failed.
+    Returns list of published drop directories.
+    """
+    with timer.phase("shared_database") as counters:
+        shared_database, shared_counters = stage_shared_database(rosetta_root, options.target_directory, umask, object_store, options.jobs)
+        counters.update(shared_counters)
+
+    try:
+        with timer.phase("variants") as counters:
+            variant_timers = [timer.variant(format_deploy_variant(v)) for v in variants]
+            variant_products = [resolve_variant_products(rosetta_root, options, v, t) for v, t in zip(variants, variant_timers)]
+
+            variant_pool = ThreadPool(len(variants))
+            try:
+                variant_results = [
+                    (v, variant_pool.apply_async(
+                        deploy_build_drop,
+                        (rosetta_root, options, v, t, umask),
+                        dict(object_store = object_store, shared_database = shared_database, products = products)))
+                    for v, t, products in zip(variants, variant_timers, variant_products) ]
+
+                drop_directories = []
+                failed_variants = []
+                for v, result in variant_results:
+                    try:
+                        drop_directories.append(result.get())
+                    except Exception:
+                        logging.exception("Error deploying variant: %s", format_deploy_variant(v))
+                        failed_variants.append(format_deploy_variant(v))
+            finally:
+                variant_pool.close()
+                variant_pool.join()
+
+            counters["variants"] = len(variants)
+            if object_store:
+                counters.update(objects_added = object_store.objects_added, object_bytes_added = object_store.bytes_added)
+    finally:
+        shutil.rmtree(shared_database, ignore_errors=True)
+
+    if failed_variants:
+        raise RuntimeError("Failed to deploy variants: %s" % failed_variants)
+
+    return drop_directories
+
+
 
-    bins, libs = extract_build_products(build_result.split("\n"))
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Deploy build drops and remove expired drops.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    gc_parser = subparsers.add_parser("gc", help="Remove build drops expired under retention policy. Drops referenced by links are always retained.")
+    gc_parser.add_argument("target_directory")
+    gc_parser.add_argument("--keep_last", type=int, default=None, help="Retain newest drops per type and branch.")
+    gc_parser.add_argument("--max_age_days", type=float, default=None, help="Retain drops newer than max age.")
+    gc_parser.add_argument("--dry_run", default=False, action='store_true', help="Report expired drops and reclaimable bytes only.")
+    gc_parser.add_argument("--jobs", "-j", type=int, default=8, help="Number of concurrent drop scan threads.")
+    gc_parser.add_argument("--background", default=False, action='store_true', help="Remove expired drops in detached background process.")
+    gc_parser.add_argument("--files_per_second", type=float, default=None, help="Removal rate limit.")
+    gc_parser.add_argument("--trash_age_days", type=float, default=default_trash_age_days, help="Remove previously trashed drops older than trash age.")
+
+    deploy_parser = subparsers.add_parser("deploy", help="Archive build products into drop directory.")
+    deploy_parser.add_argument("target_directory")
+    deploy_parser.add_argument("targets", nargs="*")
+    deploy_parser.add_argument("--mode", default=None)
+    deploy_parser.add_argument("--extras", default=None)
+    deploy_parser.add_argument("--branch", default=None)
+    deploy_parser.add_argument("--revision", default=None)
+    deploy_parser.add_argument("--build_name", default=None)
+    deploy_parser.add_argument("--force", default=False, action='store_true')
+    deploy_parser.add_argument("--variant", default=None, action='append',
+            help="Deploy variant <mode>:<extras>:<target>[,<target>...], multiple variants are deployed concurrently sharing one database copy.")
+    deploy_parser.add_argument("--link_current", default=False, action='store_true')
+    deploy_parser.add_argument("--trash_age_days", type=float, default=default_trash_age_days,
+            help="Remove replaced drops from trash once older than trash age, running jobs may still read trashed drops.")
+    deploy_parser.add_argument("--object_store", default=False, action='store_true',
+            help="Archive build products via content-addressed object store in target_directory/.objects.")
+    deploy_parser.add_argument("--link_mode", default="hardlink", choices=BuildObjectStore.link_modes,
+            help="Object store materialization mode.")
+    deploy_parser.add_argument("--jobs", "-j", type=int, default=8,
+            help="Number of concurrent file archive threads.")
+    deploy_parser.add_argument("--refresh_manifest", default=False, action='store_true',
+            help="Resolve build products via scons test build, replacing cached product manifest for revision.")
+    deploy_parser.add_argument("--incremental", default=False, action='store_true',
+            help="Hardlink files unchanged from the branch's previous drop, copying only changed files.")
+    deploy_parser.add_argument("--skip_warmup", default=False, action='store_true',
+            help="Do not generate database caches in drop.")
+    deploy_parser.add_argument("--warmup_binary", default=None,
+            help="Preferred database warm-up binary.")
+    deploy_parser.add_argument("--warmup_cache_pattern", default=None, action='append',
+            help="Database-relative glob of cache files expected after warm-up, default: %s" % database_cache_patterns)
+    deploy_parser.add_argument("--artifact", default=False, action='store_true',
+            help="Write compressed, seekable tar artifact of drop contents within drop directory.")
+    deploy_parser.add_argument("--artifact_compression", default=None, choices=sorted(DropArtifact.compression_extensions),
+            help="Artifact compression, zstd if the zstandard module is available if not specified.")
+
+    args = parser.parse_args()
+
+    if args.command == "gc":
+        if args.keep_last is None and args.max_age_days is None:
+            gc_parser.error("At least one of --keep_last or --max_age_days is required.")
+
+        collect_build_drops(
+                args.target_directory,
+                keep_last = args.keep_last,
+                max_age = args.max_age_days * 24 * 60 * 60 if args.max_age_days is not None else None,
+                dry_run = args.dry_run,
+                jobs = args.jobs,
+                background = args.background,
+                files_per_second = args.files_per_second,
+                trash_age = args.trash_age_days * 24 * 60 * 60)
+        sys.exit(0)
+
+    if args.variant:
+        if args.targets or args.mode or args.extras or args.build_name:
+            deploy_parser.error("--variant may not be combined with targets, --mode, --extras or --build_name.")
+        try:
+            variants = [parse_deploy_variant(v) for v in args.variant]
+        except ValueError as e:
+            deploy_parser.error(str(e))
+    else:
+        if not args.targets:
+            deploy_parser.error("At least one target or --variant is required.")
+        variants = [DeployVariant(args.mode, args.extras, args.targets)]
+
+    rosetta_root = subprocess.check_output("git rev-parse --show-toplevel".split(" ")).strip()
+    logging.info("Resolved root directory: %s", rosetta_root)
+    if not rosetta_root:
+        raise ValueError("Unable to resolve Rosetta root directory.")
+
+    timer = DeployPhaseTimer()
+    try:
+        with timer.phase("cleanup"):
+            cleanup_deploy_directories(args.target_directory, trash_age = args.trash_age_days * 24 * 60 * 60)
 
-    archive_build_products(rosetta_root, bins, libs, drop_directory)
+        object_store = None
+        if args.object_store:
+            object_store = BuildObjectStore(path.join(args.target_directory, ".objects"), args.link_mode)
+            logging.info("Archiving via object store: %s", object_store.store_directory)
 
-    build_type = None
-    if args.extras and re.search("mpi", args.extras):
-        build_type = "mpi"
+        # Read once before any deploy threads are started
+        umask = current_umask()
 
-    setup_build_products(rosetta_root, drop_directory, build_type = build_type)
+        def deploy():
+            if len(variants) == 1:
+                deploy_build_drop(rosetta_root, args, variants[0], timer, umask, object_store)
+            else:
+                deploy_build_variants(rosetta_root, args, variants, timer, umask, object_store)
 
-    if args.link_current:
-        setup_drop_links("current", args.target_directory, **drop_parameters)
+        if object_store:
+            # Objects are unreferenced until drops are published, gc is excluded until the deploy completes
+            with object_store.lock():
+                deploy()
+        else:
+            deploy()
+    finally:
+        timer.print_report()
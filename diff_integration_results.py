@@ -2,9 +2,16 @@
 from integration_test_support import *
 
 import argparse
+import logging
+logging.basicConfig(level=logging.INFO)
+
 parser = argparse.ArgumentParser(description="Diff integration tests.")
 
 parser.add_argument("--jobs", "-j", type=int, help="Number of processing jobs.")
+parser.add_argument("--numeric_tolerance", nargs=3, action="append", default=[], metavar=("GLOB", "ATOL", "RTOL"),
+        help="Compare numeric fields of files matching glob within absolute and relative tolerance, may be repeated.")
+parser.add_argument("--resume", action="store_true", default=False,
+        help="Resume from checkpoint in outdir, only re-analyzing tests with modified result directories.")
 
 parser.add_argument("reference_results", help="Reference result directory.")
 parser.add_argument("new_results", help="Test result directory.")
@@ -12,5 +19,10 @@ parser.add_argument("outdir", help="Output summary directory.")
 
 options = parser.parse_args()
 
-analysis = IntegrationAnalysis(options.reference_results, options.new_results)
-analysis.write_test_report(options.outdir)
+config = IntegrationConfig(
+        numeric_tolerances = dict((glob, dict(atol=float(atol), rtol=float(rtol))) for glob, atol, rtol in options.numeric_tolerance))
+
+checkpoint = IntegrationAnalysis.load_checkpoint(options.outdir) if options.resume else None
+
+analysis = IntegrationAnalysis(options.reference_results, options.new_results, config, jobs=options.jobs, checkpoint=checkpoint)
+analysis.write_test_report(options.outdir, process_pool_size=options.jobs)
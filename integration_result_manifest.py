@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+from integration_test_support import *
+
+import argparse
+import logging
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser(description="Store filtered result digest manifest in integration result directory.")
+
+parser.add_argument("--jobs", "-j", type=int, help="Number of processing jobs.")
+
+parser.add_argument("results", help="Integration result directory.")
+
+options = parser.parse_args()
+
+manifest = ResultDigestManifest.generate(options.results, jobs=options.jobs)
+manifest.write()
+logging.info("Wrote digest manifest for %s tests: %s", len(manifest.test_digests), path.join(options.results, manifest.manifest_filename))
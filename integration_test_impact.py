@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Run integration tests affected by changed source files.
+
+Changed files are mapped to binaries through a cached dependency index derived
+from the scons build tree, and binaries to the integration tests whose command
+files invoke them. Changes which can not be attributed, eg. to the database, build
+settings or sources not present in the index, select all tests.
+
+    integration_test_impact.py --changed_files <file> ... -- ./integration.py -j 8
+"""
+import os
+from os import path
+import sys
+import re
+import json
+import time
+import hashlib
+import subprocess
+
+import logging
+
+from scons_support import perform_test_build, extract_build_dependencies, extract_build_products, get_bin_name
+
+# Repository-relative path prefixes with no effect on integration test results.
+unaffected_prefixes = ["source/test/", "source/doc/", "doc/", "tests/unit/", "tests/profile/", "tests/scientific/"]
+
+# Source prefixes attributed to binaries via the dependency index.
+indexed_prefixes = ["source/src/", "source/external/"]
+
+integration_tests_prefix = "tests/integration/tests/"
+
+# Command files invoke binaries as %(bin)s/<binary>.%(binext)s
+test_binary_pattern = re.compile(r"%\(bin\)s/(\w+)")
+
+class DependencyIndex(object):
+    """Source to binary dependency index derived from the scons build tree."""
+
+    def __init__(self, nodes, children, binaries):
+        """nodes - Node names, children - Child node indices per node, binaries - {binary name : node index}."""
+        self.nodes = nodes
+        self.children = children
+        self.binaries = binaries
+
+    @staticmethod
+    def generate(rosetta_root, targets, mode = None, extras = None):
+        tree_lines = list(perform_test_build(rosetta_root, targets, mode, extras, tree = "prune"))
+
+        dependencies = extract_build_dependencies(tree_lines)
+        binary_files, library_files = extract_build_products(tree_lines)
+
+        nodes = sorted(dependencies)
+        node_indices = dict((n, i) for i, n in enumerate(nodes))
+
+        return DependencyIndex(
+                nodes,
+                [sorted(node_indices[c] for c in dependencies[n]) for n in nodes],
+                dict((get_bin_name(b), node_indices[b]) for b in binary_files))
+
+    @staticmethod
+    def load(index_file):
+        with open(index_file) as index_in:
+            index = json.load(index_in)
+        return DependencyIndex(index["nodes"], index["children"], index["binaries"])
+
+    def write(self, index_file):
+        with open(index_file + ".tmp.%s" % os.getpid(), "w") as index_out:
+            json.dump({"nodes" : self.nodes, "children" : self.children, "binaries" : self.binaries}, index_out)
+        os.rename(index_file + ".tmp.%s" % os.getpid(), index_file)
+
+    def affected_binaries(self, source_files):
+        """Resolve binaries depending on any of the given source-relative files.
+
+        Returns (affected binary names, source files not present in index).
+        """
+        parents = [[] for n in self.nodes]
+        for i, children in enumerate(self.children):
+            for c in children:
+                parents[c].append(i)
+
+        node_indices = dict((n, i) for i, n in enumerate(self.nodes))
+        unindexed = [f for f in source_files if f not in node_indices]
+
+        affected = set()
+        pending = [node_indices[f] for f in source_files if f in node_indices]
+        while pending:
+            n = pending.pop()
+            if n in affected:
+                continue
+            affected.add(n)
+            pending.extend(parents[n])
+
+        return set(b for b, n in self.binaries.items() if n in affected), unindexed
+
+def build_settings_digest(rosetta_root):
+    """Digest of scons build settings, the dependency index is regenerated if settings change."""
+    digest = hashlib.sha1()
+    for settings_root in ["source/src", "source/external", "source/tools/build"]:
+        for dirpath, dirnames, filenames in os.walk(path.join(rosetta_root, settings_root)):
+            dirnames.sort()
+            for f in sorted(filenames):
+                if f.endswith(".settings") or f.startswith("SConscript"):
+                    digest.update(path.relpath(path.join(dirpath, f), rosetta_root))
+                    with open(path.join(dirpath, f), "rb") as settings_file:
+                        digest.update(settings_file.read())
+    return digest.hexdigest()
+
+def resolve_dependency_index(rosetta_root, index_directory, targets, mode = None, extras = None, max_age = 24 * 60 * 60):
+    """Load cached dependency index for build settings and parameters, generating index if not cached or older than max_age."""
+    index_key = json.dumps(dict(settings = build_settings_digest(rosetta_root), targets = sorted(targets), mode = mode, extras = extras), sort_keys = True)
+    index_file = path.join(index_directory, hashlib.sha1(index_key).hexdigest() + ".json")
+
+    if path.exists(index_file) and time.time() - path.getmtime(index_file) < max_age:
+        logging.info("Loading cached dependency index: %s", index_file)
+        return DependencyIndex.load(index_file)
+
+    logging.info("Generating dependency index: %s", index_file)
+    index = DependencyIndex.generate(rosetta_root, targets, mode, extras)
+
+    if not path.exists(index_directory):
+        os.makedirs(index_directory)
+    index.write(index_file)
+
+    return index
+
+def integration_test_binaries(tests_directory):
+    """Resolve {test name : set(binary names)} from integration test command files."""
+    test_binaries = {}
+    for test in sorted(os.listdir(tests_directory)):
+        command_file = path.join(tests_directory, test, "command")
+        if not path.isfile(command_file):
+            continue
+
+        with open(command_file) as command_in:
+            test_binaries[test] = set(test_binary_pattern.findall(command_in.read()))
+
+    return test_binaries
+
+def select_integration_tests(changed_files, test_binaries, index):
+    """Select integration tests affected by repository-relative changed files.
+
+    Returns (sorted selected tests, reason), selected tests is None if all tests are selected.
+    """
+    if not changed_files:
+        return None, "no changed files"
+
+    selected = set()
+    source_files = []
+
+    for f in changed_files:
+        if any(f.startswith(p) for p in unaffected_prefixes):
+            continue
+        elif f.startswith(integration_tests_prefix):
+            test = f[len(integration_tests_prefix):].split("/")[0]
+            if test in test_binaries:
+                selected.add(test)
+        elif any(f.startswith(p) for p in indexed_prefixes):
+            if f.endswith(".settings") or path.basename(f).startswith("SConscript"):
+                return None, "build settings changed: %s" % f
+            source_files.append(path.relpath(f, "source"))
+        else:
+            return None, "unattributed change: %s" % f
+
+    affected_binaries, unindexed = index.affected_binaries(source_files)
+    if unindexed:
+        # New, moved or generated files are not attributable until the index is regenerated
+        return None, "changed files not present in dependency index: %s" % unindexed
+
+    for test, binaries in test_binaries.items():
+        if not binaries:
+            logging.warning("Unable to resolve binaries for test, selecting: %s", test)
+            selected.add(test)
+        elif binaries & affected_binaries:
+            selected.add(test)
+
+    return sorted(selected), "affected binaries: %s" % sorted(affected_binaries)
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Run integration tests affected by changed source files.")
+    parser.add_argument("--changed_files", nargs="*", default=[], help="Repository-relative changed files.")
+    parser.add_argument("--full", default=False, action="store_true", help="Run all tests.")
+    parser.add_argument("--index_directory", default=path.expanduser("~/.integration_impact_index"), help="Dependency index cache directory.")
+    parser.add_argument("--index_max_age", type=float, default=24 * 60 * 60, help="Regenerate cached dependency index older than max age seconds.")
+    parser.add_argument("--targets", nargs="+", default=["bin"], help="Build targets providing integration test binaries.")
+    parser.add_argument("--mode", default=None)
+    parser.add_argument("--extras", default=None)
+    parser.add_argument("--tests_directory", default="tests", help="Integration test directory.")
+    parser.add_argument("--tests", nargs="+", default=None, help="Candidate tests, eg. of a test shard, selection is limited to candidate tests.")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Integration test command, selected tests are appended.")
+
+    args = parser.parse_args()
+
+    command = [c for c in args.command if c and c != "--"]
+    if not command:
+        parser.error("Integration test command is required.")
+
+    rosetta_root = subprocess.check_output("git rev-parse --show-toplevel".split(" ")).strip()
+
+    if args.full:
+        selected_tests, reason = None, "full run requested"
+    else:
+        index = resolve_dependency_index(rosetta_root, args.index_directory, args.targets, args.mode or None, args.extras or None, args.index_max_age)
+        test_binaries = integration_test_binaries(args.tests_directory)
+        if args.tests:
+            test_binaries = dict((t, b) for t, b in test_binaries.items() if t in args.tests)
+        selected_tests, reason = select_integration_tests(args.changed_files, test_binaries, index)
+
+    if selected_tests is None and args.tests:
+        selected_tests = sorted(args.tests)
+
+    if selected_tests is None:
+        logging.info("Integration test impact selection: all tests, %s", reason)
+    elif not selected_tests:
+        logging.info("Integration test impact selection: no tests, %s", reason)
+        sys.exit(0)
+    else:
+        logging.info("Integration test impact selection: %s tests, %s tests: %s", len(selected_tests), reason, " ".join(selected_tests))
+        command.extend(selected_tests)
+
+    sys.stdout.flush()
+    os.execvp(command[0], command)
@@ -2,30 +2,138 @@ import filecmp
 import difflib
 from os import path
 import os
+import re
 import json
+import errno
+import shutil
+import fnmatch
+import logging
+import time
 
-import pygments
-import pygments.formatters
-import pygments.lexers
+from collections import namedtuple
+from itertools import islice, izip_longest
+
+# numpy and pygments are imported by the numeric comparison and report writers,
+# digest manifests are generated on slaves without either installed.
+
+from hashlib import sha1 as content_hash
+
+# Digest algorithm recorded in digest manifests, manifests of other algorithms are ignored.
+content_hash_name = "sha1"
 
 class IntegrationConfig(object):
-    def __init__(self, sub_test_parameters = ["database", "minidir", "bin"], common_patterns = None, ignore_files=["command.sh"]):
+    def __init__(self, sub_test_parameters = ["database", "minidir", "bin"], common_patterns = None, ignore_files=["command.sh"],
+            streaming_diff_threshold = 64 * 2**20, streaming_diff_chunk_lines = 2**14, streaming_diff_max_hunks = 100,
+            numeric_tolerances = None):
         """Configuration for integration analysis.
 
         sub_test_paramters - Replace test parameters values with placeholders during diff.        
 
-        common_patterns - Equivalent patterns to be ignore in diff generation. Provided as dict of form:
+        common_patterns - Equivalent literal patterns to be ignore in diff generation, replaced by pattern_name. Provided as dict of form:
                             { pattern_name : (ref_pattern, new_pattern) }
                  
                           Eg. { "branch_directory" : ("build_dir/branch_a", "build_dir/branch_b") }
 
         ignore_files - Files to ignore. Defaults to ["command.sh"]
 
+        streaming_diff_threshold - File size in bytes above which diffs are generated chunk-by-chunk by
+                                   streaming_unified_diff, None to always perform full diffs.
+
+        streaming_diff_chunk_lines - Lines per chunk in streaming diffs.
+
+        streaming_diff_max_hunks - Hunks reported in streaming diffs, remaining hunks are summarized.
+
+        numeric_tolerances - Numeric field tolerances for differing files, compared by numeric_fields_equivalent.
+                             Provided as dict of form:
+                                { file_glob : dict(atol=absolute_tolerance, rtol=relative_tolerance) }
+
+                             Eg. { "*.sc" : dict(atol=1e-3, rtol=0), "*.pdb" : dict(atol=1e-3, rtol=0) }
+
+                             Globs are matched against the test-relative path and file name, the longest
+                             matching glob is used. Files within tolerance are considered equivalent.
+
         """
 
         self.sub_test_parameters = sub_test_parameters
         self.common_patterns = common_patterns
         self.ignore_files = ignore_files
+        self.streaming_diff_threshold = streaming_diff_threshold
+        self.streaming_diff_chunk_lines = streaming_diff_chunk_lines
+        self.streaming_diff_max_hunks = streaming_diff_max_hunks
+        self.numeric_tolerances = numeric_tolerances
+
+    def file_numeric_tolerance(self, result_file):
+        """Numeric tolerance dict for test-relative result file, None if no glob matches."""
+        if not self.numeric_tolerances:
+            return None
+
+        matching_globs = [
+            g for g in self.numeric_tolerances
+            if fnmatch.fnmatch(result_file, g) or fnmatch.fnmatch(path.basename(result_file), g)]
+
+        if not matching_globs:
+            return None
+
+        return self.numeric_tolerances[max(matching_globs, key=len)]
+
+    def signature(self):
+        """Digest of configuration values, analysis checkpoints are invalidated if configuration changes."""
+        return content_hash(encode_text(json.dumps(vars(self), sort_keys=True))).hexdigest()
+
+    def result_substitutions(self, run_parameters):
+        """Compile (ref, new) ResultSubstitutions for the given IntegrationRunParameters."""
+        ref_replacements = self.parameter_replacements(run_parameters.ref_parameters if run_parameters else {})
+        new_replacements = self.parameter_replacements(run_parameters.new_parameters if run_parameters else {})
+
+        if self.common_patterns:
+            for pattern_name, (ref_pattern, new_pattern) in self.common_patterns.items():
+                ref_replacements[ref_pattern] = pattern_name
+                new_replacements[new_pattern] = pattern_name
+
+        return ResultSubstitution(ref_replacements), ResultSubstitution(new_replacements)
+
+    def parameter_replacements(self, test_parameters):
+        """Replacements of substituted test parameter values by parameter name."""
+        replacements = {}
+
+        if self.sub_test_parameters:
+            for param in self.sub_test_parameters:
+                if param in test_parameters:
+                    replacements[str(test_parameters[param])] = param
+
+        return replacements
+
+class ResultSubstitution(object):
+    def __init__(self, replacements):
+        """Single-pass literal substitution of result text.
+
+        replacements - dict of form { value : placeholder }, compiled into a single alternation
+                       preferring the longest value at each position.
+        """
+        self.replacements = dict((value, placeholder) for value, placeholder in replacements.items() if value)
+
+        if self.replacements:
+            self.pattern = re.compile("|".join(re.escape(v) for v in sorted(self.replacements, key=len, reverse=True)))
+        else:
+            self.pattern = None
+
+    def substitute(self, text):
+        if self.pattern is None:
+            return text
+
+        return self.pattern.sub(self._replace_match, text)
+
+    def substitute_lines(self, lines):
+        """Substitute lines from iterable, eg. an open file, yielding substituted lines."""
+        if self.pattern is None:
+            return iter(lines)
+
+        return (self.pattern.sub(self._replace_match, l) for l in lines)
+
+    def _replace_match(self, match):
+        return self.replacements[match.group()]
+
+IntegrationTestResult = namedtuple("IntegrationTestResult", ["test", "diff_files", "passed", "analysis_time", "signature"])
 
 class IntegrationRunParameters(object):
     def __init__(self, ref_parameters, new_parameters):
@@ -41,131 +149,676 @@ class IntegrationRunParameters(object):
             new_parameters = json.load(new_file)
 
         return IntegrationRunParameters(ref_parameters, new_parameters)
+
+class ResultDigestManifest(object):
+    manifest_filename = "result_digests.json"
+
+    def __init__(self, result_dir, replacements, test_digests):
+        """Filtered content digests of all result files in a result directory.
+
+        result_dir - Result directory, manifest is stored as result_dir/result_digests.json.
+        replacements - ResultSubstitution replacements used to filter digested content.
+        test_digests - dict of form { test : { result_file : (size, mtime, digest) } }
+        """
+        self.result_dir = result_dir
+        self.replacements = replacements
+        self.test_digests = test_digests
+
+    @classmethod
+    def from_result_directory(cls, result_dir, substitution):
+        """Load stored manifest, None if not present, digested with a different algorithm or filtered with different substitutions."""
+        manifest_file = path.join(result_dir, cls.manifest_filename)
+        if not path.exists(manifest_file):
+            return None
+
+        with open(manifest_file) as manifest_in:
+            manifest = json.load(manifest_in)
+
+        if manifest.get("digest") != content_hash_name:
+            logging.info("Ignoring digest manifest with mismatched digest algorithm: %s %s", manifest_file, manifest.get("digest"))
+            return None
+
+        if manifest["replacements"] != substitution.replacements:
+            logging.info("Ignoring digest manifest with mismatched substitutions: %s", manifest_file)
+            return None
+
+        return cls(result_dir, manifest["replacements"], manifest["tests"])
+
+    @classmethod
+    def generate(cls, result_dir, config = IntegrationConfig(), jobs = None):
+        """Digest all test results in result directory, filtered by the directory's test parameters."""
+        with open(path.join(result_dir, "test_parameters.json")) as parameter_file:
+            substitution = ResultSubstitution(config.parameter_replacements(json.load(parameter_file)))
+
+        tests = [t for t in os.listdir(result_dir) if path.isdir(path.join(result_dir, t)) and t not in config.ignore_files]
+        digest_tasks = [(t, path.join(result_dir, t), substitution, config.ignore_files) for t in tests]
+
+        return cls(result_dir, substitution.replacements, dict(map_tasks(_digest_test_results, digest_tasks, jobs)))
+
+    def write(self):
+        manifest_file = path.join(self.result_dir, self.manifest_filename)
+
+        with open(manifest_file + ".tmp", "w") as manifest_out:
+            json.dump(dict(digest = content_hash_name, replacements = self.replacements, tests = self.test_digests), manifest_out)
+        os.rename(manifest_file + ".tmp", manifest_file)
+
+def list_result_files(test_dir, ignore_files):
+    """List files in test directory and its immediate subdirectories, matching filecmp.dircmp analysis."""
+    result_files = []
+
+    for entry in os.listdir(test_dir):
+        if entry in ignore_files:
+            continue
+
+        if path.isdir(path.join(test_dir, entry)):
+            result_files.extend(
+                    path.join(entry, f) for f in os.listdir(path.join(test_dir, entry))
+                    if f not in ignore_files and path.isfile(path.join(test_dir, entry, f)))
+        elif path.isfile(path.join(test_dir, entry)):
+            result_files.append(entry)
+
+    return result_files
+
+def manifest_file_digest(result_digests, test_dir, result_file):
+    """Stored digest of result file, None if not present or size or mtime have changed."""
+    if not result_digests or result_file not in result_digests:
+        return None
+
+    size, mtime, digest = result_digests[result_file]
+    stat = os.stat(path.join(test_dir, result_file))
+    if stat.st_size != size or stat.st_mtime != mtime:
+        return None
+
+    return digest
+
+def _digest_test_results(task):
+    """Digest filtered result files of single test, returning (test, { result_file : (size, mtime, digest) })."""
+    test, test_dir, substitution, ignore_files = task
+
+    test_digests = {}
+    for f in list_result_files(test_dir, ignore_files):
+        stat = os.stat(path.join(test_dir, f))
+        with open(path.join(test_dir, f)) as result_file:
+            test_digests[f] = (stat.st_size, stat.st_mtime, result_digest(substitution.substitute_lines(result_file)))
+
+    return test, test_digests
         
 class IntegrationAnalysis(object):
-    def __init__(self, ref_dir, new_dir, config = IntegrationConfig()):
+    checkpoint_filename = "analysis_checkpoint.jsonl"
+
+    def __init__(self, ref_dir, new_dir, config = IntegrationConfig(), jobs = None, checkpoint = None):
         """Configure integration analysis.
 
         ref_dir - Reference result directory.
         new_dir - New result directory.
         config - IntegrationConfig config object.
+        jobs - Number of analysis processes, analysis performed in-process if None.
+        checkpoint - Completed test entries of a previous analysis, from load_checkpoint. Tests with unchanged
+                     ref and new directory signatures and analysis configuration are resumed from the checkpoint
+                     rather than re-analyzed.
 
+        Stored ResultDigestManifests in ref_dir or new_dir are used in place of reading unchanged result files.
         """
 
         self.ref_dir = ref_dir
         self.new_dir = new_dir
         self.config = config
+        self.jobs = jobs
+        self.checkpoint = checkpoint
         self.run_parameters = IntegrationRunParameters.from_run_directories(ref_dir, new_dir)
+        self.substitutions = config.result_substitutions(self.run_parameters)
+
+        self.ref_manifest = ResultDigestManifest.from_result_directory(ref_dir, self.substitutions[0])
+        self.new_manifest = ResultDigestManifest.from_result_directory(new_dir, self.substitutions[1])
         
         self.perform_analysis()
+
+    @classmethod
+    def load_checkpoint(cls, outdir):
+        """Load completed test entries from test report checkpoint, empty if not present."""
+        checkpoint = {}
+
+        checkpoint_file = path.join(outdir, cls.checkpoint_filename)
+        if not path.exists(checkpoint_file):
+            return checkpoint
+
+        with open(checkpoint_file) as checkpoint_in:
+            for l in checkpoint_in:
+                try:
+                    entry = json.loads(l)
+                except ValueError:
+                    # Partial entry of interrupted report
+                    continue
+                checkpoint[entry["test"]] = entry
+
+        return checkpoint
     
     def perform_analysis(self):
         dir_comparer = filecmp.dircmp(self.ref_dir, self.new_dir, ignore=self.config.ignore_files)
         
-        self.tests_removed = dir_comparer.left_list
-        self.tests_added = dir_comparer.right_list
+        self.tests_removed = [t for t in dir_comparer.left_only if path.isdir(path.join(self.ref_dir, t))]
+        self.tests_added = [t for t in dir_comparer.right_only if path.isdir(path.join(self.new_dir, t))]
         
         self.test_results = {}
-        
-        for test in dir_comparer.common_dirs:
-            self.test_results[test] = \
-                IntegrationTestAnalysis(
-                    path.join(self.ref_dir, test),
-                    path.join(self.new_dir, test),
-                    self.config,
-                    self.run_parameters)
+        self.test_signatures = {}
+        self.resumed_tests = {}
+
+        checkpoint = self.checkpoint or {}
+        analysis_signature = self.analysis_signature()
+
+        test_tasks = [
+            (test, self.ref_dir, self.new_dir, self.config, self.run_parameters, self.substitutions, self._test_digests(test), checkpoint.get(test), analysis_signature)
+            for test in dir_comparer.common_dirs]
+
+        for result in map_tasks(_analyze_integration_test, test_tasks, self.jobs):
+            self.test_results[result.test] = self._test_analysis(result)
+            self.test_signatures[result.test] = result.signature
+
+            if result.test in checkpoint and checkpoint[result.test]["signature"] == result.signature:
+                self.resumed_tests[result.test] = checkpoint[result.test]
+
+        if self.checkpoint is not None:
+            logging.info("Resumed %s of %s tests from checkpoint.", len(self.resumed_tests), len(self.test_results))
+
+    def analysis_signature(self):
+        """Digest of analysis configuration and compiled result substitutions."""
+        return content_hash(encode_text(json.dumps(
+            [self.config.signature(), self.substitutions[0].replacements, self.substitutions[1].replacements],
+            sort_keys=True))).hexdigest()
+
+    def _test_analysis(self, result):
+        """Reconstruct test analysis from IntegrationTestResult."""
+        return IntegrationTestAnalysis(
+                path.join(self.ref_dir, result.test),
+                path.join(self.new_dir, result.test),
+                self.config,
+                self.run_parameters,
+                substitutions = self.substitutions,
+                diff_files = result.diff_files,
+                analysis_time = result.analysis_time)
+
+    def _test_digests(self, test):
+        """Stored (ref, new) digests for test, None if no manifest is available."""
+        if not (self.ref_manifest or self.new_manifest):
+            return None
+
+        return (
+            self.ref_manifest.test_digests.get(test, {}) if self.ref_manifest else {},
+            self.new_manifest.test_digests.get(test, {}) if self.new_manifest else {})
                 
     def write_html_report(self, outdir, htmldiff = difflib.HtmlDiff(), process_pool_size = None):
-        os.makedirs(outdir)
-        
-        tests_to_report = [(t, r) for t, r in self.test_results.iteritems() if not r.passed]
-        
-        if process_pool_size:
-            from multiprocessing import Pool
-            process_pool = Pool(process_pool_size)
-            
-            for testname, result in tests_to_report:
-                test_outdir = path.join(outdir, testname)
-                process_pool.apply_async(__write_analysis_html_report, result, test_outdir)
-                
-            process_pool.close()
-            process_pool.join()
-            
-        else:
-            for testname, result in tests_to_report:
-                result.write_html_report(path.join(outdir, testname))
-    
-    def write_test_report(self, outdir):
+        ensure_directory(outdir)
+
+        report_tasks = [
+            (result, "write_file_html_report", f, path.join(outdir, test), dict(htmldiff=htmldiff))
+            for test, result in self.test_results.iteritems() if not result.passed
+            for f in result.diff_files]
+
+        for _ in perform_report_tasks(report_tasks, process_pool_size):
+            pass
+
+    def write_test_report(self, outdir, process_pool_size = None):
+        """Write test lists, per-file reports of failed tests and test_summary.jsonl summary.
+
+        test_summary.jsonl contains one json entry per test, written as each test's report completes, of form:
+            { "test" : name, "status" : "passed"|"failed"|"added"|"removed", "diff_files" : [file],
+              "diff_lines" : { file : changed line count }, "analysis_time" : seconds }
+
+        Completed tests are recorded in analysis_checkpoint.jsonl. If the analysis was resumed from a checkpoint
+        the checkpoint is extended and reports of resumed tests are retained, otherwise it is rewritten.
+        """
         if not path.exists(outdir):
             os.makedirs(outdir)
 
-        with open(path.join(outdir, "tests_failed.txt"), "w") as failed, open(path.join(outdir, "tests_passed.txt"), "w") as passed:
+        report_tasks = []
+        pending_reports = {}
+
+        with open(path.join(outdir, "tests_failed.txt"), "w") as failed, \
+                open(path.join(outdir, "tests_passed.txt"), "w") as passed, \
+                open(path.join(outdir, "test_summary.jsonl"), "w") as summary, \
+                open(path.join(outdir, self.checkpoint_filename), "a" if self.checkpoint is not None else "w") as checkpoint:
+
+            for test in self.tests_removed:
+                write_summary_entry(summary, test, "removed")
+            for test in self.tests_added:
+                write_summary_entry(summary, test, "added")
+
             for test, result in self.test_results.iteritems():
-                if result.passed:
+                if test not in self.resumed_tests and path.exists(path.join(outdir, test)):
+                    logging.info("Removing previous test report: %s", path.join(outdir, test))
+                    shutil.rmtree(path.join(outdir, test))
+
+                if test in self.resumed_tests:
+                    (passed if result.passed else failed).write(test + "\n")
+                    write_summary_entry(
+                            summary, test, "passed" if result.passed else "failed",
+                            diff_files = result.diff_files, diff_lines = self.resumed_tests[test]["diff_lines"],
+                            analysis_time = result.analysis_time)
+                elif result.passed:
                     passed.write(test + "\n")
+                    write_summary_entry(summary, test, "passed", analysis_time = result.analysis_time)
+                    self._write_checkpoint_entry(checkpoint, test, {})
                 else:
                     failed.write(test + "\n")
-                    result.write_test_report(path.join(outdir, test))
+                    pending_reports[path.join(outdir, test)] = (test, {})
+                    report_tasks.extend(
+                        (result, "write_file_test_report", f, path.join(outdir, test), {})
+                        for f in result.diff_files)
+
+            for test_outdir, target_file, diff_lines in perform_report_tasks(report_tasks, process_pool_size):
+                test, test_diff_lines = pending_reports[test_outdir]
+                test_diff_lines[target_file] = diff_lines
+
+                result = self.test_results[test]
+                if len(test_diff_lines) == len(result.diff_files):
+                    write_summary_entry(
+                            summary, test, "failed",
+                            diff_files = result.diff_files, diff_lines = test_diff_lines, analysis_time = result.analysis_time)
+                    self._write_checkpoint_entry(checkpoint, test, test_diff_lines)
+
+    def _write_checkpoint_entry(self, checkpoint, test, diff_lines):
+        """Write and flush completed test checkpoint entry."""
+        result = self.test_results[test]
+
+        checkpoint.write(json.dumps(dict(
+            test = test, signature = self.test_signatures[test],
+            diff_files = result.diff_files, diff_lines = diff_lines, analysis_time = result.analysis_time)) + "\n")
+        checkpoint.flush()
+
+def _analyze_integration_test(task):
+    """Analyze single test, returning picklable IntegrationTestResult.
+
+    Analysis is skipped if the test directory and analysis configuration signatures match the test's checkpoint entry.
+    """
+    test, ref_dir, new_dir, config, run_parameters, substitutions, digests, checkpoint_entry, analysis_signature = task
+
+    signature = [test_directory_signature(path.join(ref_dir, test)), test_directory_signature(path.join(new_dir, test)), analysis_signature]
+    if checkpoint_entry and checkpoint_entry["signature"] == signature:
+        return IntegrationTestResult(
+                test, checkpoint_entry["diff_files"], not checkpoint_entry["diff_files"], checkpoint_entry["analysis_time"], signature)
 
-def __write_analysis_html_report(result, test_outdir):
-    result.write_html_report(test_outdir)
+    analysis = IntegrationTestAnalysis(path.join(ref_dir, test), path.join(new_dir, test), config, run_parameters, substitutions, digests = digests)
+    return IntegrationTestResult(test, analysis.diff_files, analysis.passed, analysis.analysis_time, signature)
+
+def test_directory_signature(test_dir):
+    """Digest of the relative path, size and mtime of all files in test directory."""
+    signature = content_hash()
+
+    for dirpath, dirnames, filenames in os.walk(test_dir):
+        dirnames.sort()
+        for f in sorted(filenames):
+            stat = os.stat(path.join(dirpath, f))
+            signature.update(encode_text("%s %s %r\n" % (path.relpath(path.join(dirpath, f), test_dir), stat.st_size, stat.st_mtime)))
+
+    return signature.hexdigest()
+
+def write_summary_entry(summary, test, status, diff_files = [], diff_lines = {}, analysis_time = None):
+    """Write and flush single json summary line."""
+    summary.write(json.dumps(dict(
+        test = test, status = status, diff_files = diff_files, diff_lines = diff_lines, analysis_time = analysis_time)) + "\n")
+    summary.flush()
+
+def result_digest(result_lines):
+    """Digest of filtered result lines, consumed incrementally."""
+    digest = content_hash()
+    for l in result_lines:
+        digest.update(encode_text(l))
+    return digest.hexdigest()
+
+def encode_text(text):
+    """Encode text for digests, bytes are returned unchanged."""
+    return text if isinstance(text, bytes) else text.encode("utf-8")
+
+def streaming_unified_diff(ref_lines, new_lines, fromfile, tofile, chunk_lines, max_hunks, n=3, stats=None):
+    """Unified diff of line iterables in bounded memory, returning newline-terminated diff lines.
+
+    Lines are consumed in chunks of chunk_lines and compared by line hash. Each chunk pair is diffed up
+    to its last matching block, the unmatched tails are carried into the next chunk pair to realign
+    insertions and deletions shorter than a chunk. Chunk pairs without any matching line are reported as
+    replaced. Only the first max_hunks hunks are reported, followed by a summary of the remaining hunks.
+
+    stats - Optional dict, updated with total "hunks", "ref_changed" and "new_changed" line counts.
+    """
+    ref_lines = iter(ref_lines)
+    new_lines = iter(new_lines)
+
+    ref_chunk, new_chunk = [], []
+    ref_offset, new_offset = 0, 0
+    ref_done, new_done = False, False
+
+    diff_lines = []
+    hunks = 0
+    ref_changed, new_changed = 0, 0
+
+    while True:
+        if not ref_done:
+            ref_read = list(islice(ref_lines, chunk_lines - len(ref_chunk)))
+            ref_done = len(ref_read) < chunk_lines - len(ref_chunk)
+            ref_chunk.extend(ref_read)
+        if not new_done:
+            new_read = list(islice(new_lines, chunk_lines - len(new_chunk)))
+            new_done = len(new_read) < chunk_lines - len(new_chunk)
+            new_chunk.extend(new_read)
+
+        if not ref_chunk and not new_chunk:
+            break
+
+        if ref_chunk == new_chunk:
+            ref_consumed, new_consumed = len(ref_chunk), len(new_chunk)
+        else:
+            ref_hashes = [hash(l) for l in ref_chunk]
+            new_hashes = [hash(l) for l in new_chunk]
+
+            if ref_done and new_done:
+                ref_consumed, new_consumed = len(ref_chunk), len(new_chunk)
+            else:
+                # Final matching block is a zero-size sentinel, anchor on the last real match
+                matching_blocks = difflib.SequenceMatcher(None, ref_hashes, new_hashes, autojunk=False).get_matching_blocks()
+                if len(matching_blocks) > 1:
+                    anchor_ref, anchor_new, anchor_size = matching_blocks[-2]
+                    ref_consumed, new_consumed = anchor_ref + anchor_size, anchor_new + anchor_size
+                else:
+                    ref_consumed, new_consumed = len(ref_chunk), len(new_chunk)
+
+            matcher = difflib.SequenceMatcher(None, ref_hashes[:ref_consumed], new_hashes[:new_consumed], autojunk=False)
+            for group in matcher.get_grouped_opcodes(n):
+                for tag, i1, i2, j1, j2 in group:
+                    if tag != "equal":
+                        ref_changed += i2 - i1
+                        new_changed += j2 - j1
+
+                hunks += 1
+                if hunks > max_hunks:
+                    continue
+
+                if hunks == 1:
+                    diff_lines.append("--- %s\n" % fromfile)
+                    diff_lines.append("+++ %s\n" % tofile)
+
+                diff_lines.append("@@ -%s +%s @@\n" % (
+                    _format_diff_range(ref_offset + group[0][1], ref_offset + group[-1][2]),
+                    _format_diff_range(new_offset + group[0][3], new_offset + group[-1][4])))
+
+                for tag, i1, i2, j1, j2 in group:
+                    if tag == "equal":
+                        diff_lines.extend(" " + l for l in ref_chunk[i1:i2])
+                    else:
+                        diff_lines.extend("-" + l for l in ref_chunk[i1:i2])
+                        diff_lines.extend("+" + l for l in new_chunk[j1:j2])
+
+        ref_chunk, new_chunk = ref_chunk[ref_consumed:], new_chunk[new_consumed:]
+        ref_offset += ref_consumed
+        new_offset += new_consumed
+
+    if stats is not None:
+        stats.update(hunks = hunks, ref_changed = ref_changed, new_changed = new_changed)
+
+    if hunks > max_hunks:
+        diff_lines.append("# Diff truncated, first %s of %s hunks shown. %s ref lines and %s new lines differ.\n" % (
+            max_hunks, hunks, ref_changed, new_changed))
+
+    return [ l if l.endswith("\n") else l + "\n" for l in diff_lines ]
+
+numeric_token_pattern = re.compile(r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+pdb_coordinate_columns = [(30, 38), (38, 46), (46, 54), (54, 60), (60, 66)]
+
+def tokenize_numeric_fields(line):
+    """Split line into (text skeleton, numeric values).
+
+    PDB ATOM/HETATM records are split on the coordinate, occupancy and b-factor columns, all other lines
+    are split on whitespace with numeric tokens replaced by placeholders in the skeleton.
+    """
+    if line.startswith(("ATOM  ", "HETATM")) and len(line.rstrip()) >= 54:
+        values = []
+        for start, end in pdb_coordinate_columns:
+            field = line[start:end].strip()
+            if not numeric_token_pattern.match(field):
+                return line, []
+            values.append(float(field))
+
+        return line[:30] + line[66:], values
+
+    skeleton = []
+    values = []
+    for token in line.split():
+        if numeric_token_pattern.match(token):
+            skeleton.append("#")
+            values.append(float(token))
+        else:
+            skeleton.append(token)
+
+    return " ".join(skeleton), values
+
+def numeric_fields_equivalent(ref_lines, new_lines, atol = 0, rtol = 0, chunk_values = 2**16):
+    """Compare line iterables, requiring equal text skeletons and numeric fields within tolerance.
+
+    Numeric fields are accumulated and compared in vectorized chunks of chunk_values.
+    """
+    import numpy
+
+    ref_values = []
+    new_values = []
+
+    def values_within_tolerance():
+        return numpy.allclose(new_values, ref_values, rtol=rtol, atol=atol)
+
+    for ref_line, new_line in izip_longest(ref_lines, new_lines):
+        if ref_line is None or new_line is None:
+            return False
+
+        ref_skeleton, ref_line_values = tokenize_numeric_fields(ref_line)
+        new_skeleton, new_line_values = tokenize_numeric_fields(new_line)
+        if ref_skeleton != new_skeleton or len(ref_line_values) != len(new_line_values):
+            return False
+
+        ref_values.extend(ref_line_values)
+        new_values.extend(new_line_values)
+
+        if len(ref_values) >= chunk_values:
+            if not values_within_tolerance():
+                return False
+            ref_values = []
+            new_values = []
+
+    return not ref_values or values_within_tolerance()
+
+def _format_diff_range(start, stop):
+    """Format unified diff range from zero-based [start, stop)."""
+    length = stop - start
+    if length == 1:
+        return "%s" % (start + 1)
+    if not length:
+        return "%s,0" % start
+    return "%s,%s" % (start + 1, length)
+
+def map_tasks(task_function, tasks, process_pool_size = None):
+    """Map function over tasks, yielding results as completed.
+
+    task_function - Picklable module-level function.
+    tasks - Picklable task arguments.
+    process_pool_size - Number of worker processes, tasks performed in-process if None.
+
+    Worker exceptions are raised in the caller.
+    """
+    if not (process_pool_size and process_pool_size > 1):
+        for task in tasks:
+            yield task_function(task)
+        return
+
+    from multiprocessing import Pool
+    process_pool = Pool(process_pool_size)
+    try:
+        for result in process_pool.imap_unordered(task_function, tasks):
+            yield result
+        process_pool.close()
+    finally:
+        process_pool.terminate()
+        process_pool.join()
+
+def perform_report_tasks(report_tasks, process_pool_size = None):
+    """Render per-file report tasks, logging progress and yielding (test outdir, target file, report result) as tasks complete."""
+    for i, (test_outdir, target_file, report_result) in enumerate(map_tasks(_write_file_report, report_tasks, process_pool_size)):
+        logging.info("Wrote report %s/%s: %s", i + 1, len(report_tasks), path.join(test_outdir, target_file))
+        yield test_outdir, target_file, report_result
+
+def _write_file_report(task):
+    """Render report for single differing file.
+
+    task - (test analysis, report method name, target file, test outdir, report kwargs)
+    """
+    result, report_method, target_file, test_outdir, report_kwargs = task
+    report_result = getattr(result, report_method)(target_file, test_outdir, **report_kwargs)
+
+    return test_outdir, target_file, report_result
+
+def ensure_directory(directory):
+    """Create directory if not present, tolerating concurrent creation."""
+    if not directory:
+        return
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
 class IntegrationTestAnalysis(object):
-    def __init__(self, ref_dir, new_dir, config = IntegrationConfig(), run_parameters=None):
+    def __init__(self, ref_dir, new_dir, config = IntegrationConfig(), run_parameters=None, substitutions=None, diff_files=None, digests=None, analysis_time=None):
         """Result analysis for a single integration test result.
 
         ref_dir - Reference result directory.
         new_dir - New result directory.
         config - IntegrationConfifg config object.
+        substitutions - (ref, new) ResultSubstitution pair, compiled from config and run_parameters if None.
+        diff_files - Previously analyzed diff files, analysis is performed if None.
+        digests - (ref, new) stored ResultDigestManifest entries for this test, compared in place of dircmp if provided.
+        analysis_time - Analysis time in seconds of previously analyzed diff files.
         """
         
         self.ref_dir = ref_dir
         self.new_dir = new_dir
         self.config = config
         self.run_parameters = run_parameters
+
+        if substitutions is None:
+            substitutions = config.result_substitutions(run_parameters)
+        self.ref_substitution, self.new_substitution = substitutions
+        self.ref_digests, self.new_digests = digests if digests else (None, None)
         
-        self.perform_analysis()
+        if diff_files is None:
+            self.perform_analysis()
+        else:
+            self.diff_files = diff_files
+            self.analysis_time = analysis_time
 
     def read_ref_result_file(self, result_file):
         """Filter ref result file."""
-        if self.config.sub_test_parameters:
-            result = result_file.read()
-            for param, value in self.run_parameters.ref_parameters.items():
-                if param in self.config.sub_test_parameters:
-                    result = result.replace(value, param)
-
-            return result.split("\n")
-        else:
-            return result_file.readlines()
+        return list(self.filter_ref_result_lines(result_file))
 
     def read_new_result_file(self, result_file):
         """Filter new result file."""
-        if self.config.sub_test_parameters:
-            result = result_file.read()
-            for param, value in self.run_parameters.new_parameters.items():
-                if param in self.config.sub_test_parameters:
-                    result = result.replace(value, param)
+        return list(self.filter_new_result_lines(result_file))
 
-            return result.split("\n")
-        else:
-            return result_file.readlines()
+    def filter_ref_result_lines(self, result_file):
+        """Filter ref result file line-by-line, yielding substituted lines."""
+        return self.ref_substitution.substitute_lines(result_file)
+
+    def filter_new_result_lines(self, result_file):
+        """Filter new result file line-by-line, yielding substituted lines."""
+        return self.new_substitution.substitute_lines(result_file)
     
     def perform_analysis(self):
-        dir_comparer = filecmp.dircmp(self.ref_dir, self.new_dir, ignore=self.config.ignore_files)
-        
-        candidate_diffs = []
-        candidate_diffs.extend(dir_comparer.diff_files)
-        for subdir, subdir_diff in dir_comparer.subdirs.iteritems():
-            candidate_diffs.extend(path.join(subdir, f) for f in subdir_diff.diff_files)
+        start_time = time.time()
+
+        if self.ref_digests is not None or self.new_digests is not None:
+            # Stored digests replace byte comparison, all common files are candidates
+            ref_files = set(list_result_files(self.ref_dir, self.config.ignore_files))
+            new_files = set(list_result_files(self.new_dir, self.config.ignore_files))
+            candidate_diffs = sorted(ref_files & new_files)
+        else:
+            dir_comparer = filecmp.dircmp(self.ref_dir, self.new_dir, ignore=self.config.ignore_files)
+
+            candidate_diffs = []
+            candidate_diffs.extend(dir_comparer.diff_files)
+            for subdir, subdir_diff in dir_comparer.subdirs.iteritems():
+                candidate_diffs.extend(path.join(subdir, f) for f in subdir_diff.diff_files)
         
-        self.diff_files = [target_file for target_file in candidate_diffs if self.perform_file_diff(target_file)]
+        self.diff_files = [
+            target_file for target_file in candidate_diffs
+            if not (self.files_equivalent(target_file) or self.files_numerically_equivalent(target_file))]
+
+        self.analysis_time = time.time() - start_time
+
+    def files_equivalent(self, target_file):
+        """Compare filtered file contents by digest, without generating a diff."""
+        return self.ref_file_digest(target_file) == self.new_file_digest(target_file)
+
+    def files_numerically_equivalent(self, target_file):
+        """Compare filtered file numeric fields within configured tolerance, False if no tolerance configured."""
+        tolerance = self.config.file_numeric_tolerance(target_file)
+        if tolerance is None:
+            return False
+
+        with open(path.join(self.ref_dir, target_file)) as ref_file, open(path.join(self.new_dir, target_file)) as new_file:
+            equivalent = numeric_fields_equivalent(self.filter_ref_result_lines(ref_file), self.filter_new_result_lines(new_file), **tolerance)
+
+        if equivalent:
+            logging.debug("Result file within numeric tolerance: %s", path.join(self.new_dir, target_file))
+
+        return equivalent
+
+    def ref_file_digest(self, target_file):
+        """Filtered ref file digest, from stored digests if unchanged."""
+        digest = manifest_file_digest(self.ref_digests, self.ref_dir, target_file)
+        if digest is None:
+            with open(path.join(self.ref_dir, target_file)) as ref_file:
+                digest = result_digest(self.filter_ref_result_lines(ref_file))
+
+        return digest
 
-    def perform_file_diff(self, target_file):
+    def new_file_digest(self, target_file):
+        """Filtered new file digest, from stored digests if unchanged."""
+        digest = manifest_file_digest(self.new_digests, self.new_dir, target_file)
+        if digest is None:
+            with open(path.join(self.new_dir, target_file)) as new_file:
+                digest = result_digest(self.filter_new_result_lines(new_file))
+
+        return digest
+
+    def read_filtered_file_pair(self, target_file):
+        """Read filtered ref and new file lines, retaining line endings."""
         with open(path.join(self.ref_dir, target_file)) as ref_file, open(path.join(self.new_dir, target_file)) as new_file:
-            return list(difflib.unified_diff(
-                self.read_ref_result_file(ref_file), self.read_new_result_file(new_file),
+            return list(self.filter_ref_result_lines(ref_file)), list(self.filter_new_result_lines(new_file))
+
+    def use_streaming_diff(self, target_file):
+        """True if either file version exceeds the configured streaming diff threshold."""
+        if self.config.streaming_diff_threshold is None:
+            return False
+
+        return max(
+            path.getsize(path.join(self.ref_dir, target_file)),
+            path.getsize(path.join(self.new_dir, target_file))) > self.config.streaming_diff_threshold
+
+    def perform_file_diff(self, target_file, ref_lines = None, new_lines = None):
+        """Generate newline-terminated unified diff lines, reading filtered file pair if not provided."""
+        if ref_lines is None or new_lines is None:
+            if self.use_streaming_diff(target_file):
+                with open(path.join(self.ref_dir, target_file)) as ref_file, open(path.join(self.new_dir, target_file)) as new_file:
+                    return self.perform_streaming_file_diff(target_file, self.filter_ref_result_lines(ref_file), self.filter_new_result_lines(new_file))
+
+            ref_lines, new_lines = self.read_filtered_file_pair(target_file)
+
+        return [ l if l.endswith("\n") else l + "\n" for l in difflib.unified_diff(
+                ref_lines, new_lines,
+                path.join(self.ref_dir, target_file), path.join(self.new_dir, target_file),
+                n=3)]
+
+    def perform_streaming_file_diff(self, target_file, ref_lines, new_lines, stats = None):
+        """Generate truncated unified diff lines from filtered line iterables in bounded memory."""
+        return streaming_unified_diff(
+                ref_lines, new_lines,
                 path.join(self.ref_dir, target_file), path.join(self.new_dir, target_file),
-                n=3))
+                self.config.streaming_diff_chunk_lines, self.config.streaming_diff_max_hunks,
+                stats = stats)
                 
     @property
     def passed(self):
@@ -173,39 +826,83 @@ class IntegrationTestAnalysis(object):
     
     def write_html_report(self, outdir, htmldiff = difflib.HtmlDiff()):
         for f in self.diff_files:
-            with open(path.join(self.ref_dir, f)) as ref_file, open(path.join(self.new_dir, f)) as new_file:
-                output_file = path.join(outdir, f + ".html")
-                if path.dirname(output_file) and not path.exists(path.dirname(output_file)):
-                    os.makedirs(path.dirname(output_file))
-                    
-                with open(output_file, "w") as outfile:
-                    outfile.writelines(htmldiff.make_file(ref_file.readlines(), new_file.readlines(), context=True, numlines=3))
+            self.write_file_html_report(f, outdir, htmldiff)
+
+    def write_file_html_report(self, f, outdir, htmldiff = difflib.HtmlDiff()):
+        output_file = path.join(outdir, f + ".html")
+        ensure_directory(path.dirname(output_file))
+
+        if self.use_streaming_diff(f):
+            with open(output_file, "w") as outfile:
+                write_highlighted_diff("".join(self.perform_file_diff(f)), outfile)
+            return
+
+        with open(path.join(self.ref_dir, f)) as ref_file, open(path.join(self.new_dir, f)) as new_file:
+            with open(output_file, "w") as outfile:
+                outfile.writelines(htmldiff.make_file(ref_file.readlines(), new_file.readlines(), context=True, numlines=3))
 
     def write_test_report(self, outdir):
         for f in self.diff_files:
-            output_basename = path.join(outdir, f)
-            if path.dirname(output_basename) and not path.exists(path.dirname(output_basename)):
-                os.makedirs(path.dirname(output_basename))
-
-            #Write raw diffs
-            with open(output_basename + ".diff", "w") as diffout:
-                diffout.writelines(( l + "\n" for l in self.perform_file_diff(f)))
-
-            #Write html highlighted diffs
-            with open(output_basename + ".diff") as diffin, open(output_basename + ".html", "w") as htmlout:
-                pygments.highlight(
-                        "".join(diffin.readlines()),
-                        pygments.lexers.get_lexer_by_name("diff"),
-                        pygments.formatters.get_formatter_by_name("html", full=True),
-                        htmlout)
+            self.write_file_test_report(f, outdir)
+
+    def write_file_test_report(self, f, outdir):
+        """Write raw diff, highlighted diff and filtered file versions from a single read of the file pair.
+
+        Returns number of changed lines in the diff.
+        """
+        output_basename = path.join(outdir, f)
+        ensure_directory(path.dirname(output_basename))
+        ensure_directory(path.dirname(path.join(outdir, "ref", f)))
+        ensure_directory(path.dirname(path.join(outdir, "new", f)))
+
+        if self.use_streaming_diff(f):
+            #Write ref and new file versions as lines are consumed by the diff
+            with open(path.join(self.ref_dir, f)) as ref_file, open(path.join(outdir, "ref", f), "w") as ref_out, \
+                    open(path.join(self.new_dir, f)) as new_file, open(path.join(outdir, "new", f), "w") as new_out:
+                diff_stats = {}
+                diff = "".join(self.perform_streaming_file_diff(
+                    f,
+                    _write_through(self.filter_ref_result_lines(ref_file), ref_out),
+                    _write_through(self.filter_new_result_lines(new_file), new_out),
+                    diff_stats))
+                diff_lines = diff_stats["ref_changed"] + diff_stats["new_changed"]
+        else:
+            ref_lines, new_lines = self.read_filtered_file_pair(f)
+            file_diff = self.perform_file_diff(f, ref_lines, new_lines)
+            diff = "".join(file_diff)
+            diff_lines = sum(1 for l in file_diff[2:] if l.startswith(("+", "-")))
 
             #Write ref and new file versions
-            if not path.exists(path.dirname(path.join(outdir, "ref", f))):
-                os.makedirs(path.dirname(path.join(outdir, "ref", f)))
-            with open(path.join(self.ref_dir, f), "r") as infile, open(path.join(outdir, "ref", f), "w") as outfile:
-                outfile.writelines(self.read_ref_result_file(infile))
-
-            if not path.exists(path.dirname(path.join(outdir, "new", f))):
-                os.makedirs(path.dirname(path.join(outdir, "new", f)))
-            with open(path.join(self.new_dir, f), "r") as infile, open(path.join(outdir, "new", f), "w") as outfile:
-                outfile.writelines(self.read_new_result_file(infile))
+            with open(path.join(outdir, "ref", f), "w") as outfile:
+                outfile.writelines(ref_lines)
+
+            with open(path.join(outdir, "new", f), "w") as outfile:
+                outfile.writelines(new_lines)
+
+        #Write raw diffs
+        with open(output_basename + ".diff", "w") as diffout:
+            diffout.write(diff)
+
+        #Write html highlighted diffs
+        with open(output_basename + ".html", "w") as htmlout:
+            write_highlighted_diff(diff, htmlout)
+
+        return diff_lines
+
+def _write_through(lines, outfile):
+    """Yield lines, writing each line to outfile."""
+    for l in lines:
+        outfile.write(l)
+        yield l
+
+def write_highlighted_diff(diff, outfile):
+    """Write pygments html highlighted diff."""
+    import pygments
+    import pygments.formatters
+    import pygments.lexers
+
+    pygments.highlight(
+            diff,
+            pygments.lexers.get_lexer_by_name("diff"),
+            pygments.formatters.get_formatter_by_name("html", full=True),
+            outfile)
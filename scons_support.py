@@ -0,0 +1,113 @@
+"""Scons test build and build dependency tree parsing, shared by deploy and test impact tools."""
+from os import path
+import re
+import logging
+import subprocess
+
+def perform_test_build(rosetta_root, targets = None, mode = None, extras = None, tree = "prune,derived"):
+    """Perform no-op scons build of the given build targets, yielding lines of the tree of build dependencies.
+
+    Output is streamed from scons rather than collected.
+
+    tree - scons --tree options, "prune" includes source files in the tree.
+    """
+    command = ["scons", "--tree=%s" % tree, "-n"]
+
+    if mode:
+        command.append("mode=%s" % mode)
+    if extras:
+        command.append("extras=%s" % extras)
+
+    targets = targets or []
+    command.extend(targets)
+
+    logging.info("Beginning archive test build: %s", " ".join(command))
+    build_process = subprocess.Popen(command, cwd=path.join(rosetta_root, "source"), stdout=subprocess.PIPE, universal_newlines=True)
+
+    up_to_date_targets = set()
+
+    try:
+        for l in iter(build_process.stdout.readline, ""):
+            up_to_date_match = re.search("`(.*)' is up to date.", l)
+            if up_to_date_match:
+                up_to_date_targets.add(up_to_date_match.group(1))
+
+            yield l
+    finally:
+        if build_process.poll() is None:
+            build_process.terminate()
+        build_process.stdout.close()
+        build_process.wait()
+
+    if build_process.returncode != 0:
+        raise subprocess.CalledProcessError(build_process.returncode, command)
+
+    for t in targets:
+        if not t in up_to_date_targets:
+            logging.error("Target not up to date in scons test build: %s", t)
+
+def extract_build_products(scons_tree_lines):
+    """Process tree of build dependencies to extract all binary and library targets."""
+    build_product_pattern=re.compile("(?<=\+-)build.*")
+    object_file_pattern=re.compile("\.(os|o)$")
+    library_file_pattern=re.compile("\.so$")
+
+    library_files = set()
+    binary_files = set()
+
+    for l in scons_tree_lines:
+        build_product_match = build_product_pattern.search(l)
+        if not build_product_match:
+            continue
+
+        if object_file_pattern.search(l, build_product_match.start(), build_product_match.end()):
+            continue
+
+        if library_file_pattern.search(l, build_product_match.start(), build_product_match.end()):
+            library_files.add(build_product_match.group())
+        else:
+            binary_files.add(build_product_match.group())
+    if not binary_files and not library_files:
+        raise ValueError("No build products resolve from build result summary, likely build failure.")
+
+    return binary_files, library_files
+
+def extract_build_dependencies(scons_tree_lines):
+    """Process tree of build dependencies into {node : set(child nodes)}.
+
+    Pruned subtrees, printed as [node], are resolved by reference to the node's first occurrence.
+    """
+    dependencies = {}
+    parents = []
+
+    for l in scons_tree_lines:
+        node_start = l.find("+-")
+        if node_start < 0 or l[:node_start].strip(" |"):
+            continue
+
+        node = l[node_start + 2:].strip()
+        if node.startswith("[") and node.endswith("]"):
+            node = node[1:-1]
+
+        depth = node_start // 2
+        del parents[depth:]
+
+        dependencies.setdefault(node, set())
+        if parents:
+            dependencies[parents[-1]].add(node)
+        parents.append(node)
+
+    return dependencies
+
+def get_bin_name(build_binary):
+    """Convert binary path to base name, strips off additional build parameters added to binary name."""
+    binary_basename = path.basename(build_binary)
+    if not binary_basename.find("."):
+        return binary_basename
+    else:
+        return binary_basename[:binary_basename.find(".")]
+
+def get_lib_name(build_library):
+    """Convert library path to base name."""
+    library_basename = path.basename(build_library)
+    return library_basename
@@ -1,31 +1,77 @@
 from buildbot.steps.shell import ShellCommand
-from buildbot.status.results import SUCCESS, FAILURE
-from buildbot.process.properties import Interpolate, Property
+from buildbot.process.buildstep import BuildStep
+from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, SKIPPED, Results
+from buildbot.process.properties import Interpolate, Property, renderer
 
+import os
+from os import path
+import shutil
 import re
+import json
 
-class UnitTest(ShellCommand):
-    """Execute rosetta unit tests and return success or failure."""
+def unit_test_command(build_mode = None, build_extras = None, jobs = None, verbose = False):
+    """Generate unit test command, build mode and extras are resolved from build properties if not given."""
+    command = ["test/run.py", "-d", "../database"]
 
-    def __init__(self, build_mode = None, build_extras = None, jobs=None, verbose=False, **kwargs):
+    if build_mode:
+        command.extend(["--mode" , build_mode])
+    else:
+        command.extend([Interpolate("%(prop:build_mode:#?|--mode|)s"), Interpolate("%(prop:build_mode)s")])
 
-        command = ["test/run.py", "-d", "../database"]
+    if build_extras:
+        command.extend(["--extras" , build_extras])
+    else:
+        command.extend([Interpolate("%(prop:build_extras:#?|--extras|)s"), Interpolate("%(prop:build_extras)s")])
 
-        if build_mode:
-            command.extend(["--mode" , build_mode])
-        else:
-            command.extend([Interpolate("%(prop:build_mode:#?|--mode|)s"), Interpolate("%(prop:build_mode)s")])
+    if jobs:
+        command.extend(["-j", jobs])
 
-        if build_extras:
-            command.extend(["--extras" , build_extras])
-        else:
-            command.extend([Interpolate("%(prop:build_extras:#?|--extras|)s"), Interpolate("%(prop:build_extras)s")])
+    if not verbose:
+        command.extend(["--mute", "all"])
+
+    return command
+
+def parse_unit_test_summary(lines):
+    """Extract unit test summary from unit test output lines.
 
-        if jobs:
-            command.extend(["-j", jobs])
+    Returns (summary, tests_failed), tests_failed is None if not reported.
+    """
+    test_summary = []
+    tests_failed = None
+    summary = False
 
-        if not verbose:
-            command.extend(["--mute", "all"])
+    for l in lines:
+        if l.find("Unit test summary") >= 0:
+            summary=True
+            continue
+
+        if l.find("End of Unit test summary") >= 0:
+            summary=False
+            break
+
+        if summary:
+            test_summary.append(l)
+
+            if re.search("number tests failed:\s*(\d+)", l):
+                tests_failed = int(re.search("number tests failed:\s*(\d+)", l).groups()[0])
+
+    return "".join(test_summary), tests_failed
+
+def evaluate_unit_test_log(lines):
+    """Evaluate unit test output lines, returning (result, summary)."""
+    test_summary, tests_failed = parse_unit_test_summary(lines)
+
+    if tests_failed != 0:
+        return FAILURE, test_summary
+    else:
+        return SUCCESS, test_summary
+
+class UnitTest(ShellCommand):
+    """Execute rosetta unit tests and return success or failure."""
+
+    def __init__(self, build_mode = None, build_extras = None, jobs=None, verbose=False, **kwargs):
+
+        command = unit_test_command(build_mode, build_extras, jobs, verbose)
 
         ShellCommand.__init__(self, command=command, **kwargs) 
 
@@ -36,27 +82,7 @@ class UnitTest(ShellCommand):
     def commandComplete(self, cmd):
 
         #Extract test summary
-        test_summary = []
-        tests_failed = None
-        summary = False
-
-        for l in self.getLog("stdio").readlines():
-            if l.find("Unit test summary") >= 0:
-                summary=True
-                continue
-
-            if l.find("End of Unit test summary") >= 0:
-                summary=False
-                break
-
-            if summary:
-                test_summary.append(l)
-
-                if re.search("number tests failed:\s*(\d+)", l):
-                    tests_failed = int(re.search("number tests failed:\s*(\d+)", l).groups()[0])
-
-        self.test_summary = "".join(test_summary)
-        self.tests_failed = tests_failed
+        self.test_summary, self.tests_failed = parse_unit_test_summary(self.getLog("stdio").readlines())
 
         if self.tests_failed != 0:
             self.result = FAILURE
@@ -72,22 +98,364 @@ class UnitTest(ShellCommand):
     def createSummary(self, log):
         self.addCompleteLog("test_summary", self.test_summary)
 
+@renderer
+def integration_full_run(props):
+    """Run all integration tests if impact selection is disabled, the build has no changed files, or every integration_full_run_interval builds."""
+    if not props.getProperty("integration_impact_selection"):
+        return True
+
+    if not props.getBuild().allFiles():
+        return True
+
+    return int(props.getProperty("buildnumber", 0)) % int(props.getProperty("integration_full_run_interval", 10)) == 0
+
+@renderer
+def build_changed_files(props):
+    return sorted(set(props.getBuild().allFiles()))
+
+@renderer
+def integration_impact_arguments(props):
+    """Integration test impact selection arguments, changed files or --full if integration_full_run.
+
+    Changed files are taken from the integration_changed_files property if set, eg. by the triggering build of a
+    test shard, otherwise from the build's changes.
+    """
+    if props.getProperty("integration_full_run", True):
+        return ["--full"]
+
+    changed_files = props.getProperty("integration_changed_files")
+    if changed_files is None:
+        changed_files = sorted(set(props.getBuild().allFiles()))
+
+    return ["--changed_files"] + list(changed_files)
+
+def integration_results_complete(step):
+    """Integration results are complete, and may be stored as reference results, unless impact selection ran a
+    subset or test shards failed to record integration results."""
+    return bool(step.build.getProperty("integration_full_run", True)) and bool(step.build.getProperty("integration_shards_complete", True))
+
+def integration_test_command(build_mode = None, build_extras = None, jobs = None, impact_selection = False, tests = None):
+    """Generate integration test command, build mode and extras are resolved from build properties if not given.
+
+    impact_selection - Run tests affected by the build's changed files via integration_test_impact.py,
+        unless integration_full_run property is set.
+    tests - Test names to run, all tests are run if not given. With impact_selection, affected tests of tests are run.
+    """
+    command = []
+
+    if impact_selection:
+        command.extend([
+            "python", "../../integration_test_impact.py",
+            integration_impact_arguments,
+            Interpolate("--index_directory=%(prop:builddir)s/integration_impact_index"),
+            Interpolate("--mode=%(prop:build_mode)s"),
+            Interpolate("--extras=%(prop:build_extras)s")])
+        # Selection is limited to the given tests
+        if tests:
+            command.extend(["--tests", tests])
+        command.append("--")
+
+    command.append("./integration.py")
+
+    if build_mode:
+        command.extend(["--mode" , build_mode])
+    else:
+        command.extend([Interpolate("%(prop:build_mode:#?|--mode|)s"), Interpolate("%(prop:build_mode)s")])
+
+    if build_extras:
+        command.extend(["--extras" , build_extras])
+    else:
+        command.extend([Interpolate("%(prop:build_extras:#?|--extras|)s"), Interpolate("%(prop:build_extras)s")])
+
+    if jobs:
+        command.extend(["-j", jobs])
+
+    if tests and not impact_selection:
+        command.append(tests)
+
+    return command
+
 class IntegrationTest(ShellCommand):
 
-    def __init__(self, build_mode = None, build_extras = None, jobs=None, **kwargs):
-        command = ["./integration.py"]
+    def __init__(self, build_mode = None, build_extras = None, jobs=None, impact_selection=False, tests=None, **kwargs):
+        command = integration_test_command(build_mode, build_extras, jobs, impact_selection, tests)
+
+        ShellCommand.__init__(self, command=command, **kwargs) 
+
+# Test sharding
+# Tests are partitioned between shard sub-builds by historical durations, the unit
+# test suite is scheduled as a single item and integration tests individually.
+# Shard results and test durations are stored on the master.
+unit_shard_item = "unit"
+integration_shard_prefix = "integration:"
+
+# Shard test steps are identified by step name in shard builds.
+shard_test_step_names = {"unit_test" : "unit", "integration_test" : "integration"}
+
+test_duration_directory = "test_durations"
+shard_result_directory = "shard_results"
+
+def master_file_name(name):
+    """Master-side file name for builder name."""
+    return re.sub("[^\w@.-]", "_", name)
+
+def test_duration_file(builder_name):
+    return path.join(test_duration_directory, master_file_name(builder_name) + ".json")
+
+def load_test_durations(builder_name):
+    """Load historical {shard item : seconds} of builder, empty if no history is recorded."""
+    duration_file = test_duration_file(builder_name)
+    if not path.exists(duration_file):
+        return {}
+
+    with open(duration_file) as duration_in:
+        return json.load(duration_in)
+
+def write_test_durations(builder_name, durations):
+    duration_file = test_duration_file(builder_name)
+    if not path.exists(test_duration_directory):
+        os.makedirs(test_duration_directory)
+
+    with open(duration_file + ".tmp", "w") as duration_out:
+        json.dump(durations, duration_out, indent=2, sort_keys=True)
+    os.rename(duration_file + ".tmp", duration_file)
 
-        if build_mode:
-            command.extend(["--mode" , build_mode])
+def shard_result_path(builder_name, build_number):
+    return path.join(shard_result_directory, master_file_name(builder_name), str(build_number))
+
+def estimate_durations(items, durations, shard_count = 1):
+    """Resolve {item : estimated seconds}.
+
+    Integration tests without history are estimated by the median known test duration,
+    the unit test suite without history is estimated as an even shard's share of integration tests.
+    """
+    known = sorted(durations[i] for i in items if i in durations and i != unit_shard_item)
+    default = known[len(known) // 2] if known else 1.0
+
+    estimates = dict((i, durations.get(i, default)) for i in items if i != unit_shard_item)
+    if unit_shard_item in items:
+        estimates[unit_shard_item] = durations.get(unit_shard_item, sum(estimates.values()) / shard_count or default)
+
+    return estimates
+
+def partition_shards(items, estimates, shard_count):
+    """Partition items into shard_count shards of balanced estimated duration.
+
+    Items are assigned longest first to the least loaded shard, returns list of shard item lists.
+    """
+    shards = [[] for s in range(shard_count)]
+    loads = [0.0] * shard_count
+
+    for item in sorted(items, key=lambda i: (-estimates[i], i)):
+        s = loads.index(min(loads))
+        shards[s].append(item)
+        loads[s] += estimates[item]
+
+    return shards
+
+def update_test_durations(durations, items, wall_time, smoothing = .5):
+    """Attribute measured wall time of items run in one step to items in proportion to their estimates, updating durations as moving average."""
+    estimates = estimate_durations(items, durations)
+    total = sum(estimates.values())
+
+    for item in items:
+        measured = wall_time * estimates[item] / total if total else wall_time / len(items)
+        if item in durations:
+            durations[item] = (1 - smoothing) * durations[item] + smoothing * measured
         else:
-            command.extend([Interpolate("%(prop:build_mode:#?|--mode|)s"), Interpolate("%(prop:build_mode)s")])
+            durations[item] = measured
+
+def integration_test_list(rc, stdout, stderr):
+    """Extract integration_tests property from integration test listing."""
+    return {"integration_tests" : sorted(stdout.split())}
+
+@renderer
+def test_shard_assignment(props):
+    """Partition unit and integration tests between test_shard_count shards by the builder's historical test durations."""
+    shard_count = int(props.getProperty("test_shard_count"))
+
+    items = [unit_shard_item] + [integration_shard_prefix + t for t in props.getProperty("integration_tests", [])]
+    estimates = estimate_durations(items, load_test_durations(props.getProperty("buildername")), shard_count)
+
+    return [
+        {
+            "unit" : unit_shard_item in shard,
+            "integration" : [i[len(integration_shard_prefix):] for i in shard if i.startswith(integration_shard_prefix)],
+            "estimated_time" : sum(estimates[i] for i in shard)
+        }
+        for shard in partition_shards(items, estimates, shard_count)]
+
+def shard_assignment(props):
+    """Test assignment of shard_index in test_shard_assignment, props - build or build properties."""
+    return props.getProperty("test_shard_assignment")[int(props.getProperty("shard_index"))]
+
+@renderer
+def shard_integration_tests(props):
+    return shard_assignment(props)["integration"]
+
+def shard_runs_unit_tests(step):
+    return shard_assignment(step.build)["unit"]
+
+def shard_runs_integration_tests(step):
+    return bool(shard_assignment(step.build)["integration"])
+
+def shard_missing_steps(shard_result):
+    """Shard step keys with assigned tests but no recorded result, eg. due to a failed shard build."""
+    assigned = {"unit" : shard_result["assignment"]["unit"], "integration" : bool(shard_result["assignment"]["integration"])}
+
+    return [
+        k for k in sorted(assigned)
+        if assigned[k] and shard_result["steps"].get(k, {}).get("result") in (None, SKIPPED)]
+
+@renderer
+def shard_integration_archive(props):
+    """Master path of the integration result archive of a shard build."""
+    return path.join(
+        shard_result_path(props.getProperty("parent_buildername"), props.getProperty("parent_buildnumber")),
+        "integration_%s.tar.gz" % props.getProperty("shard_index"))
+
+def shard_integration_download(shard_index):
+    """Master path of the integration result archive of shard_index, rendered in the triggering build."""
+    @renderer
+    def archive_path(props):
+        return path.join(
+            shard_result_path(props.getProperty("buildername"), props.getProperty("buildnumber")),
+            "integration_%s.tar.gz" % shard_index)
+    return archive_path
+
+def shard_integration_recorded(shard_index):
+    """doStepIf of the triggering build, shard_index recorded integration results, see MergeShardResults."""
+    def recorded(step):
+        return shard_index in step.build.getProperty("integration_shards", [])
+    return recorded
+
+class RecordShardResult(BuildStep):
+    """Record results and wall times of shard test steps on the master for MergeShardResults of the triggering build."""
+
+    name = "record"
+
+    def start(self):
+        shard_index = int(self.getProperty("shard_index"))
+
+        shard_result = {
+            "shard_index" : shard_index,
+            "slavename" : self.getProperty("slavename"),
+            "assignment" : shard_assignment(self.build),
+            "steps" : {}
+        }
 
-        if build_extras:
-            command.extend(["--extras" , build_extras])
+        for step_status in self.build.getStatus().getSteps():
+            step_key = shard_test_step_names.get(step_status.getName())
+            if not step_key or not step_status.isFinished():
+                continue
+
+            started, finished = step_status.getTimes()
+            test_summary = [l.getText() for l in step_status.getLogs() if l.getName() == "test_summary"]
+            shard_result["steps"][step_key] = {
+                "result" : step_status.getResults()[0],
+                "wall_time" : finished - started if started and finished else None,
+                "test_summary" : test_summary[0] if test_summary else ""
+            }
+
+        result_dir = shard_result_path(self.getProperty("parent_buildername"), self.getProperty("parent_buildnumber"))
+        if not path.exists(result_dir):
+            os.makedirs(result_dir)
+
+        with open(path.join(result_dir, "shard_%s.json" % shard_index), "w") as result_out:
+            json.dump(shard_result, result_out, indent=2, sort_keys=True)
+
+        self.addCompleteLog("shard_result", json.dumps(shard_result, indent=2, sort_keys=True))
+        self.step_status.setText(["record", "shard %s" % shard_index])
+        self.finished(SUCCESS)
+
+class MergeShardResults(BuildStep):
+    """Merge shard results recorded by triggered shard builds into a test summary and update historical test durations."""
+
+    name = "merge"
+
+    def start(self):
+        builder_name = self.getProperty("buildername")
+        shard_count = int(self.getProperty("test_shard_count"))
+        result_dir = shard_result_path(builder_name, self.getProperty("buildnumber"))
+
+        durations = load_test_durations(builder_name)
+        summary = []
+        failed = []
+        integration_shards = []
+        integration_complete = True
+
+        for shard_index in range(shard_count):
+            result_file = path.join(result_dir, "shard_%s.json" % shard_index)
+            if not path.exists(result_file):
+                failed.append("shard %s" % shard_index)
+                summary.append("shard %s: no result recorded" % shard_index)
+                integration_complete = False
+                continue
+
+            with open(result_file) as result_in:
+                shard_result = json.load(result_in)
+            os.remove(result_file)
+
+            assignment = shard_result["assignment"]
+            summary.append("shard %s: slave %s estimated %.0fs" % (shard_index, shard_result["slavename"], assignment["estimated_time"]))
+
+            missing_steps = shard_missing_steps(shard_result)
+            for step_key in missing_steps:
+                failed.append("shard %s %s" % (shard_index, step_key))
+                summary.append("  %s: no result recorded" % step_key)
+
+            if "integration" in missing_steps:
+                integration_complete = False
+            elif assignment["integration"]:
+                integration_shards.append(shard_index)
+
+            for step_key, step_result in sorted(shard_result["steps"].items()):
+                result = step_result["result"]
+                if result == SKIPPED:
+                    continue
+
+                if result not in (SUCCESS, WARNINGS):
+                    failed.append("shard %s %s" % (shard_index, step_key))
+
+                if step_key == "unit":
+                    items = [unit_shard_item]
+                else:
+                    items = [integration_shard_prefix + t for t in assignment["integration"]]
+
+                wall_time = step_result["wall_time"]
+                summary.append("  %s: %s %s tests %s" % (
+                    step_key, Results[result], len(items), "%.0fs" % wall_time if wall_time is not None else "-"))
+                if step_result["test_summary"]:
+                    summary.extend("    " + l for l in step_result["test_summary"].splitlines())
+
+                if wall_time and result in (SUCCESS, WARNINGS, FAILURE):
+                    update_test_durations(durations, items, wall_time)
+
+        write_test_durations(builder_name, durations)
+
+        # Integration results of shards are gathered by the triggering build, then removed by RemoveShardResults
+        self.setProperty("integration_shards", integration_shards, "MergeShardResults")
+        self.setProperty("integration_shards_complete", integration_complete, "MergeShardResults")
+
+        self.addCompleteLog("test_summary", "\n".join(summary) + "\n")
+
+        if failed:
+            self.step_status.setText(["merge", "%s shards" % shard_count, "failed:"] + failed)
+            self.step_status.setText2(["failed:"] + failed)
+            self.finished(FAILURE)
         else:
-            command.extend([Interpolate("%(prop:build_extras:#?|--extras|)s"), Interpolate("%(prop:build_extras)s")])
+            self.step_status.setText(["merge", "%s shards" % shard_count])
+            self.finished(SUCCESS)
 
-        if jobs:
-            command.extend(["-j", jobs])
+class RemoveShardResults(BuildStep):
+    """Remove master-side shard results of the triggering build after shard integration results are gathered."""
 
-        ShellCommand.__init__(self, command=command, **kwargs) 
+    name = "remove"
+
+    def start(self):
+        result_dir = shard_result_path(self.getProperty("buildername"), self.getProperty("buildnumber"))
+        if path.exists(result_dir):
+            shutil.rmtree(result_dir)
+
+        self.step_status.setText(["remove", "shard results"])
+        self.finished(SUCCESS)
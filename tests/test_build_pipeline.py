@@ -0,0 +1,117 @@
+import os
+import time
+import signal
+import subprocess
+
+import pytest
+
+from build_pipeline import run_pipeline, kill_stages, stage_command, validate_stages
+
+def _stage(name, script, **kwargs):
+    stage = {"name" : name, "command" : ["sh", "-c", script]}
+    stage.update(kwargs)
+    return stage
+
+def _log(log_dir, name):
+    return log_dir.join(name + ".log").read()
+
+def _process_alive(pid):
+    """Process exists and is not a zombie awaiting reaping by init."""
+    for _ in range(100):
+        try:
+            with open("/proc/%s/stat" % pid) as stat_file:
+                state = stat_file.read().rsplit(")", 1)[1].split()[0]
+        except IOError:
+            return False
+        if state == "Z":
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_stage_command_substitutes_jobs():
+    stage = {"name" : "build", "command" : ["scons", "-j{jobs}", "", "bin"], "core_share" : 0.25}
+
+    assert stage_command(stage, 24) == ["scons", "-j6", "bin"]
+    assert stage_command(stage, 1) == ["scons", "-j1", "bin"]
+
+def test_validate_stages_rejects_cycles():
+    with pytest.raises(ValueError):
+        validate_stages([_stage("a", "true", depends = ["b"]), _stage("b", "true", depends = ["a"])])
+
+    with pytest.raises(ValueError):
+        validate_stages([_stage("a", "true", depends = ["missing"])])
+
+def test_dependent_stages_run_in_order(tmpdir):
+    order = tmpdir.join("order").strpath
+    stages = [
+        _stage("unit", "echo unit >> %s" % order, depends = ["build"]),
+        _stage("build", "sleep 0.2; echo build >> %s" % order),
+        _stage("integration", "echo integration >> %s" % order, depends = ["build", "unit"]),
+    ]
+
+    results = run_pipeline(stages, 4, tmpdir.join("logs").strpath, poll_interval = 0.05)
+
+    assert dict((n, r["status"]) for n, r in results.items()) == {"build" : "success", "unit" : "success", "integration" : "success"}
+    assert open(order).read().split() == ["build", "unit", "integration"]
+    assert results["unit"]["start_time"] >= results["build"]["start_time"] + results["build"]["wall_time"] - 0.1
+
+def test_independent_stages_run_concurrently(tmpdir):
+    stages = [
+        _stage("a", "echo -j{jobs}; sleep 0.5", core_share = 0.5),
+        _stage("b", "echo -j{jobs}; sleep 0.5", core_share = 0.25),
+    ]
+
+    start = time.time()
+    results = run_pipeline(stages, 8, tmpdir.strpath, poll_interval = 0.05)
+
+    assert time.time() - start < 0.9
+    assert (results["a"]["jobs"], results["b"]["jobs"]) == (4, 2)
+    assert (_log(tmpdir, "a"), _log(tmpdir, "b")) == ("-j4\n", "-j2\n")
+
+def test_halt_on_failure_skips_dependents(tmpdir):
+    stages = [
+        _stage("build", "exit 2", halt_on_failure = True),
+        _stage("lint", "exit 1"),
+        _stage("unit", "true", depends = ["build"]),
+        _stage("integration", "true", depends = ["unit"]),
+        _stage("docs", "true", depends = ["lint"]),
+    ]
+
+    results = run_pipeline(stages, 1, tmpdir.strpath, poll_interval = 0.05)
+
+    assert (results["build"]["status"], results["build"]["returncode"]) == ("failure", 2)
+    assert results["unit"] == {"status" : "skipped", "halt_on_failure" : False, "failed_depends" : ["build"]}
+    assert results["integration"]["failed_depends"] == ["unit"]
+    assert results["lint"]["status"] == "failure"
+    assert results["docs"]["status"] == "success"
+
+def test_stage_timeout_without_output(tmpdir):
+    stages = [
+        _stage("hung", "echo started; sleep 30", timeout = 0.3),
+        _stage("after", "true", depends = ["hung"]),
+    ]
+
+    start = time.time()
+    results = run_pipeline(stages, 1, tmpdir.strpath, poll_interval = 0.05)
+
+    assert time.time() - start < 10
+    assert results["hung"]["status"] == "timeout"
+    assert results["after"]["status"] == "success"
+    assert _log(tmpdir, "hung") == "started\n"
+
+def test_kill_stages_kills_process_groups(tmpdir):
+    child_pid = tmpdir.join("child_pid").strpath
+    log_file = open(tmpdir.join("stage.log").strpath, "w")
+    stage_process = subprocess.Popen(
+            ["sh", "-c", "sleep 30 & echo $! > %s; wait" % child_pid], stdout=log_file, preexec_fn=os.setsid)
+
+    while not (os.path.exists(child_pid) and os.path.getsize(child_pid)):
+        time.sleep(0.05)
+
+    running = {"stage" : ({}, stage_process, log_file, log_file.name, time.time(), [0, time.time()])}
+    kill_stages(running)
+
+    assert running == {}
+    assert log_file.closed
+    assert stage_process.returncode == -signal.SIGKILL
+    assert not _process_alive(int(open(child_pid).read()))
@@ -0,0 +1,50 @@
+from buildbot_build_steps import sharded_test_factory, test_shard_factory, build_and_deploy_variants_factory
+from build_support import DeployBuild
+from test_support import IntegrationTest, integration_impact_arguments, shard_integration_tests
+
+def _steps(factory):
+    return [s.buildStep() for s in factory.steps]
+
+def _descriptions(factory):
+    return [
+        " ".join((getattr(s, "description", None) or []) + (getattr(s, "descriptionSuffix", None) or []))
+        for s in _steps(factory)]
+
+def test_sharded_factory_stores_integration_results():
+    sharded = _descriptions(sharded_test_factory(["shard_0", "shard_1"], build_bindings = False))
+
+    assert "digest integration" in sharded and "save integration" in sharded
+    assert sharded.index("extract shard 1 integration") < sharded.index("save integration")
+    assert "build bindings" not in sharded
+
+def test_sharded_factory_builds_bindings():
+    sharded = _descriptions(sharded_test_factory(["shard_0"], build_bindings = True))
+
+    assert "build bindings" in sharded and "test bindings" in sharded
+
+def test_shard_integration_impact_selection():
+    integration_steps = [s for s in _steps(test_shard_factory) if isinstance(s, IntegrationTest)]
+    assert len(integration_steps) == 1
+
+    command = integration_steps[0].command
+    assert command[:2] == ["python", "../../integration_test_impact.py"]
+    assert integration_impact_arguments in command
+
+    # Shard tests are candidates of impact selection, not appended to the integration command
+    assert command.index("--tests") + 1 == command.index(shard_integration_tests)
+    assert command.index(shard_integration_tests) < command.index("--") < command.index("./integration.py")
+    assert command[-1] != shard_integration_tests
+
+def test_variants_factory_builds_and_deploys_variants():
+    factory = build_and_deploy_variants_factory(["release::bin", "release:mpi:bin,apps"])
+
+    descriptions = _descriptions(factory)
+    assert descriptions.index("compiling release::bin") < descriptions.index("compiling release:mpi:bin,apps")
+
+    deploy_steps = [s for s in _steps(factory) if isinstance(s, DeployBuild)]
+    assert len(deploy_steps) == 1
+
+    command = deploy_steps[0].command.make_command(None)
+    assert command[command.index("--variant") + 1] == "release::bin"
+    assert command[command.index("--variant", command.index("--variant") + 1) + 1] == "release:mpi:bin,apps"
+    assert "--mode" not in command and "--object_store" in command
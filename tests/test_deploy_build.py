@@ -0,0 +1,253 @@
+import os
+from os import path
+import stat
+import threading
+import time
+import json
+import hashlib
+import tarfile
+
+import pytest
+
+from deploy_build import BuildObjectStore, archive_build_products, collect_object_store, drop_reclaimable_bytes, drop_object_references, find_build_drops, file_digest
+from deploy_build import DropArtifact, extract_artifact_member, decompress_frame
+import deploy_build
+
+def _write_file(file_path, content, mode = 0o644):
+    if not path.exists(path.dirname(file_path)):
+        os.makedirs(path.dirname(file_path))
+    with open(file_path, "w") as f:
+        f.write(content)
+    os.chmod(file_path, mode)
+    return file_path
+
+def _rosetta_root(root, database_files, binaries):
+    """Create rosetta root of { database relative path : content } and { binary name : content }, returning bin build paths."""
+    for f, content in database_files.items():
+        _write_file(root.join("database", f).strpath, content)
+
+    bins = []
+    for b, content in binaries.items():
+        bins.append("build/src/release/linux/%s.linuxgccrelease" % b)
+        _write_file(root.join("source", bins[-1]).strpath, content, 0o755)
+
+    return root.strpath, bins
+
+def _archive_drop(rosetta_root, bins, target_directory, revision, link_mode = "hardlink"):
+    drop_directory = path.join(target_directory, "release", "master", revision)
+    archive_build_products(rosetta_root, bins, [], drop_directory, BuildObjectStore(path.join(target_directory, ".objects"), link_mode))
+    return drop_directory
+
+def test_add_deduplicates_content(tmpdir):
+    store = BuildObjectStore(tmpdir.join(".objects").strpath)
+    first = _write_file(tmpdir.join("a", "rotamer.bin").strpath, "rotamers", 0o600)
+    second = _write_file(tmpdir.join("b", "rotamer.bin").strpath, "rotamers", 0o644)
+
+    digest = store.add(first)
+
+    assert store.add(second) == digest == file_digest(first)
+    assert (store.objects_added, store.bytes_added) == (1, len("rotamers"))
+    assert stat.S_IMODE(os.stat(store.object_path(digest)).st_mode) == 0o444
+
+def test_add_normalizes_executable_mode(tmpdir):
+    store = BuildObjectStore(tmpdir.join(".objects").strpath)
+    binary = _write_file(tmpdir.join("score").strpath, "binary", 0o700)
+
+    assert stat.S_IMODE(os.stat(store.object_path(store.add(binary))).st_mode) == 0o555
+
+def test_archive_counts_products_and_database_separately(tmpdir):
+    rosetta_root, bins = _rosetta_root(tmpdir.join("main"), {"scoring/weights/ref2015.wts" : "weights", "chemical/elements" : "elements"}, {"score" : "score"})
+
+    counters = archive_build_products(rosetta_root, bins, [], tmpdir.join("drop").strpath)
+
+    assert (counters["files"], counters["bytes"]) == (3, len("weights") + len("elements") + len("score"))
+    assert (counters["products"]["files"], counters["products"]["bytes"]) == (1, len("score"))
+    assert (counters["database"]["files"], counters["database"]["bytes"]) == (2, len("weights") + len("elements"))
+    assert all("wall_time" in counters[c] for c in ("products", "database"))
+
+def test_collect_removes_unreferenced_objects(tmpdir):
+    rosetta_root, bins = _rosetta_root(tmpdir.join("main"), {"scoring/weights/ref2015.wts" : "weights"}, {"score" : "score v1"})
+    target_directory = tmpdir.join("builds").strpath
+
+    old_drop = _archive_drop(rosetta_root, bins, target_directory, "abc123")
+    _write_file(path.join(rosetta_root, "source", bins[0]), "score v2", 0o755)
+    new_drop = _archive_drop(rosetta_root, bins, target_directory, "def456")
+
+    store = BuildObjectStore(path.join(target_directory, ".objects"))
+    old_score, new_score = file_digest(path.join(old_drop, "bin", "score")), file_digest(path.join(new_drop, "bin", "score"))
+    weights = file_digest(path.join(new_drop, "database", "scoring/weights/ref2015.wts"))
+
+    # Retained while referenced by any drop
+    assert collect_object_store(target_directory, min_age = 0) == 0
+
+    os.rename(old_drop, tmpdir.join("removed").strpath)
+    assert collect_object_store(target_directory, min_age = 0) == len("score v1")
+    assert not path.exists(store.object_path(old_score))
+    assert path.exists(store.object_path(new_score)) and path.exists(store.object_path(weights))
+
+def test_collect_retains_referenced_reflinked_objects(tmpdir):
+    # Reflinked or copied objects have a link count of 1 while referenced by drops
+    rosetta_root, bins = _rosetta_root(tmpdir.join("main"), {"chemical/element_sets/default" : "elements"}, {"relax" : "relax"})
+    target_directory = tmpdir.join("builds").strpath
+
+    drop = _archive_drop(rosetta_root, bins, target_directory, "abc123", link_mode = "reflink")
+    store = BuildObjectStore(path.join(target_directory, ".objects"))
+    relax = file_digest(path.join(drop, "bin", "relax"))
+    assert os.stat(store.object_path(relax)).st_nlink == 1
+
+    assert collect_object_store(target_directory, min_age = 0) == 0
+    assert path.exists(store.object_path(relax))
+
+def test_collect_excluded_by_deploy_lock(tmpdir):
+    target_directory = tmpdir.join("builds").strpath
+    store = BuildObjectStore(path.join(target_directory, ".objects"))
+    digest = store.add(_write_file(tmpdir.join("score").strpath, "score"))
+
+    collected = []
+    with store.lock():
+        collector = threading.Thread(target=lambda: collected.append(collect_object_store(target_directory, min_age = 0)))
+        collector.start()
+        time.sleep(.2)
+
+        # Object added by deploy, drop referencing the object not yet published
+        assert not collected
+        assert path.exists(store.object_path(digest))
+
+    collector.join()
+    assert collected == [len("score")]
+
+def test_collect_throttled_removal_outside_lock(tmpdir):
+    target_directory = tmpdir.join("builds").strpath
+    store = BuildObjectStore(path.join(target_directory, ".objects"))
+    digests = [store.add(_write_file(tmpdir.join("score_%s" % i).strpath, "score %s" % i)) for i in range(3)]
+
+    collected = []
+    collector = threading.Thread(target=lambda: collected.append(collect_object_store(target_directory, min_age = 0, files_per_second = 2)))
+    collector.start()
+    time.sleep(.3)
+
+    # Unreferenced objects are trashed under the lock, deploys proceed during throttled removal
+    start = time.time()
+    with store.lock():
+        assert time.time() - start < .2
+        assert not any(path.exists(store.object_path(d)) for d in digests)
+    assert collector.is_alive()
+
+    collector.join()
+    assert collected == [3 * len("score 0")]
+    assert os.listdir(path.join(target_directory, ".trash")) == []
+
+def test_reclaimable_bytes_exclude_retained_content(tmpdir):
+    rosetta_root, bins = _rosetta_root(tmpdir.join("main"), {"scoring/weights/ref2015.wts" : "weights"}, {"score" : "score v1"})
+    target_directory = tmpdir.join("builds").strpath
+
+    old_drop = _archive_drop(rosetta_root, bins, target_directory, "abc123", link_mode = "reflink")
+    _write_file(path.join(rosetta_root, "source", bins[0]), "score v2", 0o755)
+    new_drop = _archive_drop(rosetta_root, bins, target_directory, "def456", link_mode = "reflink")
+
+    drops, linked_paths = find_build_drops(target_directory)
+    retained_references = drop_object_references(d for d in drops if d.path == new_drop)
+
+    manifest_size = path.getsize(path.join(old_drop, "drop_file_manifest.json"))
+    assert drop_reclaimable_bytes(old_drop, retained_references, path.join(target_directory, ".objects")) == len("score v1") + manifest_size
+
+def _warmup_drop(drop_directory, binaries, cache = ""):
+    """Drop with database cache of content and { binary name : shell script } warm-up binaries."""
+    _write_file(path.join(drop_directory, "database", "rotamer", "cache.bin"), cache)
+    for b, script in binaries.items():
+        _write_file(path.join(drop_directory, "bin", b), "#!/bin/sh\n" + script, 0o755)
+    return drop_directory
+
+def test_warmup_requires_caches(tmpdir):
+    drop_directory = _warmup_drop(tmpdir.join("drop").strpath, {
+        "score_jd2" : "exit 0\n",
+        "rosetta_scripts" : "echo fresh > %s\n" % tmpdir.join("drop", "database", "rotamer", "cache.bin"),
+        "fixbb" : "exit 1\n",
+    })
+
+    manifest = deploy_build.warm_build_database(tmpdir.strpath, drop_directory, cache_patterns = ["rotamer/*.bin"])
+
+    assert manifest["attempts"] == [("score_jd2", 0), ("rosetta_scripts", 0)]
+    assert list(manifest["files"]) == ["rotamer/cache.bin"]
+
+def test_warmup_reuses_archived_caches(tmpdir):
+    drop_directory = _warmup_drop(tmpdir.join("drop").strpath, {"score_jd2" : "exit 0\n"}, cache = "archived")
+
+    manifest = deploy_build.warm_build_database(tmpdir.strpath, drop_directory, cache_patterns = ["rotamer/*.bin"])
+
+    assert manifest["attempts"] == [("score_jd2", 0)]
+    assert manifest["files"] == {"rotamer/cache.bin" : file_digest(path.join(drop_directory, "database", "rotamer", "cache.bin"))}
+
+def test_warmup_fails_without_caches(tmpdir):
+    drop_directory = _warmup_drop(tmpdir.join("drop").strpath, {"score_jd2" : "exit 0\n", "relax" : "exit 1\n"}, cache = "archived")
+    os.remove(path.join(drop_directory, "database", "rotamer", "cache.bin"))
+
+    with pytest.raises(deploy_build.DatabaseWarmupError):
+        deploy_build.warm_build_database(tmpdir.strpath, drop_directory, cache_patterns = ["rotamer/*.bin"])
+
+    # Empty caches are left by interrupted generation
+    _warmup_drop(drop_directory, {})
+    with pytest.raises(deploy_build.DatabaseWarmupError):
+        deploy_build.warm_build_database(tmpdir.strpath, drop_directory, cache_patterns = ["rotamer/*.bin"])
+
+def test_warmup_skipped_without_warmup_binaries(tmpdir):
+    drop_directory = _warmup_drop(tmpdir.join("drop").strpath, {"fixbb" : "exit 1\n"})
+    assert deploy_build.warm_build_database(tmpdir.strpath, drop_directory) is None
+
+    lib_drop = tmpdir.join("lib_drop").strpath
+    _write_file(path.join(lib_drop, "database", "scoring", "ref2015.wts"), "weights")
+    assert deploy_build.warm_build_database(tmpdir.strpath, lib_drop) is None
+
+def _artifact_drop(drop_directory):
+    """Drop with database files spanning compression frames, hardlinked files and a bin link."""
+    files = {
+        "bin/score" : "\x7fELF" + "".join(chr(i % 256) for i in range(5000)),
+        "database/scoring/weights/ref2015.wts" : "METHOD_WEIGHTS ref 0.592 0.354\n" * 200,
+        "database/rotamer/bbdep02.May.sortlib" : "ALA 0 -180 1 0 0 0\n" * 500,
+    }
+    for f, content in files.items():
+        _write_file(path.join(drop_directory, f), content)
+
+    os.link(path.join(drop_directory, "database/scoring/weights/ref2015.wts"), path.join(drop_directory, "database/scoring/weights/ref2015_copy.wts"))
+    files["database/scoring/weights/ref2015_copy.wts"] = files["database/scoring/weights/ref2015.wts"]
+    os.symlink("score", path.join(drop_directory, "bin/score.linuxgccrelease"))
+
+    return files
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_artifact_round_trip(tmpdir, compression):
+    if compression == "zstd" and deploy_build.zstandard is None:
+        pytest.skip("zstandard module not available")
+
+    drop_directory = tmpdir.join("drop").strpath
+    files = _artifact_drop(drop_directory)
+
+    artifact = DropArtifact(drop_directory, compression, frame_size = 1024)
+    artifact.add(path.join(drop_directory, "bin/score"))
+    artifact.add_missing(drop_directory)
+    artifact.close(dict(branch = "master", revision = "abc123"))
+
+    with open(artifact.index_path) as index_file:
+        index = json.load(index_file)
+    assert len(index["frames"]) > 1
+
+    for f, content in files.items():
+        assert extract_artifact_member(artifact.artifact_path, f) == content
+
+    manifest = json.loads(extract_artifact_member(artifact.artifact_path, DropArtifact.manifest_member))
+    assert manifest["revision"] == "abc123"
+    assert manifest["files"] == dict((f, hashlib.sha1(content).hexdigest()) for f, content in files.items())
+
+    # Concatenated frames form a complete tar stream
+    with open(artifact.artifact_path, "rb") as artifact_file:
+        tar_path = tmpdir.join("drop.tar").strpath
+        with open(tar_path, "wb") as tar_file:
+            for offset, size, compressed_offset, compressed_size in index["frames"]:
+                artifact_file.seek(compressed_offset)
+                tar_file.write(decompress_frame(artifact_file.read(compressed_size), compression))
+
+    with tarfile.open(tar_path) as tar:
+        members = dict((m.name, m) for m in tar.getmembers())
+        assert members["bin/score.linuxgccrelease"].issym()
+        assert all(members[f].isreg() for f in files)
+        assert tar.extractfile("database/scoring/weights/ref2015_copy.wts").read() == files["database/scoring/weights/ref2015_copy.wts"]
@@ -0,0 +1,73 @@
+from integration_test_impact import DependencyIndex, integration_test_binaries, select_integration_tests
+
+rosetta_scripts_command = """cd %(workdir)s
+
+[ -x %(bin)s/rosetta_scripts.%(binext)s ] || exit 1
+%(bin)s/rosetta_scripts.%(binext)s %(additional_flags)s @flags -database %(database)s \\
+    -testing:INTEGRATION_TEST 2>&1 \\
+    | egrep -vf ../../ignore_list \\
+    > log
+
+test "${PIPESTATUS[0]}" != '0' && exit 1 || true  # Check if the first executable in pipe line return error and exit with error code if so
+"""
+
+score_command = """cd %(workdir)s
+
+%(bin)s/score_jd2.%(binext)s %(additional_flags)s -database %(database)s -testing:INTEGRATION_TEST -in:file:s input.pdb 2>&1 > log
+"""
+
+def _index():
+    """Index of rosetta_scripts and score_jd2 binaries over core and protocols sources."""
+    nodes = [
+        "build/src/release/linux/rosetta_scripts.linuxgccrelease",
+        "build/src/release/linux/score_jd2.linuxgccrelease",
+        "src/apps/public/rosetta_scripts/rosetta_scripts.cc",
+        "src/apps/public/score_jd2.cc",
+        "src/core/pose/Pose.cc",
+        "src/protocols/moves/Mover.cc",
+    ]
+    children = [[2, 4, 5], [3, 4], [], [], [], []]
+    return DependencyIndex(nodes, children, {"rosetta_scripts" : 0, "score_jd2" : 1})
+
+def _tests_directory(tmpdir):
+    tmpdir.join("scripts", "command").write(rosetta_scripts_command, ensure=True)
+    tmpdir.join("score", "command").write(score_command, ensure=True)
+    tmpdir.join("unresolved", "command").write("cd %(workdir)s\n./run.sh\n", ensure=True)
+    tmpdir.join("README").write("not a test")
+    return tmpdir.strpath
+
+def test_command_file_binaries(tmpdir):
+    assert integration_test_binaries(_tests_directory(tmpdir)) == {
+        "scripts" : set(["rosetta_scripts"]),
+        "score" : set(["score_jd2"]),
+        "unresolved" : set(),
+    }
+
+def test_select_affected_tests(tmpdir):
+    test_binaries = integration_test_binaries(_tests_directory(tmpdir))
+
+    selected, reason = select_integration_tests(["source/src/protocols/moves/Mover.cc"], test_binaries, _index())
+    assert selected == ["scripts", "unresolved"]
+
+    selected, reason = select_integration_tests(["source/src/core/pose/Pose.cc"], test_binaries, _index())
+    assert selected == ["score", "scripts", "unresolved"]
+
+    selected, reason = select_integration_tests(
+        ["source/test/core/pose/PoseTests.cxxtest.hh", "tests/integration/tests/score/flags"], test_binaries, _index())
+    assert selected == ["score", "unresolved"]
+
+def test_unattributed_changes_select_all_tests(tmpdir):
+    test_binaries = integration_test_binaries(_tests_directory(tmpdir))
+
+    assert select_integration_tests([], test_binaries, _index())[0] is None
+    assert select_integration_tests(["database/scoring/weights/ref2015.wts"], test_binaries, _index())[0] is None
+    assert select_integration_tests(["source/src/protocols.src.settings"], test_binaries, _index())[0] is None
+
+def test_unindexed_source_changes_select_all_tests(tmpdir):
+    test_binaries = integration_test_binaries(_tests_directory(tmpdir))
+
+    selected, reason = select_integration_tests(
+        ["source/src/protocols/moves/Mover.cc", "source/src/protocols/moves/NewMover.cc"], test_binaries, _index())
+
+    assert selected is None
+    assert "src/protocols/moves/NewMover.cc" in reason
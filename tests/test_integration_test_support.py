@@ -0,0 +1,208 @@
+import difflib
+import json
+
+from integration_test_support import ResultSubstitution, IntegrationConfig, IntegrationRunParameters
+from integration_test_support import streaming_unified_diff
+from integration_test_support import numeric_fields_equivalent, tokenize_numeric_fields
+from integration_test_support import IntegrationAnalysis
+from integration_test_support import ResultDigestManifest
+
+def test_substitution_prefers_longest_value():
+    substitution = ResultSubstitution({"/work/main" : "minidir", "/work/main/database" : "database"})
+
+    assert substitution.substitute("-database /work/main/database -in /work/main/input.pdb") == \
+        "-database database -in minidir/input.pdb"
+
+def test_substitution_is_single_pass():
+    # Placeholders are not re-substituted when they match another value
+    substitution = ResultSubstitution({"bin" : "database", "database" : "minidir"})
+
+    assert substitution.substitute("bin database") == "database minidir"
+
+def test_substitution_escapes_literal_values():
+    substitution = ResultSubstitution({"build/release.linux" : "bin"})
+
+    assert substitution.substitute("build/release.linux build/releaseXlinux") == "bin build/releaseXlinux"
+
+def test_substitution_ignores_empty_values():
+    substitution = ResultSubstitution({"" : "database"})
+
+    assert substitution.pattern is None
+    assert substitution.substitute("unchanged") == "unchanged"
+    assert list(substitution.substitute_lines(["a\n", "b\n"])) == ["a\n", "b\n"]
+
+def test_substitution_lines():
+    substitution = ResultSubstitution({"/ref/database" : "database"})
+
+    assert list(substitution.substitute_lines(["path /ref/database/a\n", "none\n"])) == ["path database/a\n", "none\n"]
+
+def test_config_result_substitutions():
+    config = IntegrationConfig(common_patterns = {"branch_directory" : ("build_dir/branch_a", "build_dir/branch_b")})
+    run_parameters = IntegrationRunParameters(
+        {"database" : "/ref/database", "bin" : "/ref/bin", "minidir" : "/ref"},
+        {"database" : "/new/database", "bin" : "/new/bin", "minidir" : "/new"})
+
+    ref_substitution, new_substitution = config.result_substitutions(run_parameters)
+
+    assert ref_substitution.substitute("/ref/bin/score.linuxgccrelease /ref/database build_dir/branch_a") == \
+        "bin/score.linuxgccrelease database branch_directory"
+    assert new_substitution.substitute("/new/bin/score.linuxgccrelease /new/database build_dir/branch_b") == \
+        "bin/score.linuxgccrelease database branch_directory"
+
+def _result_lines(count, changed = {}, inserted = {}):
+    """Numbered result lines with replaced line values and inserted lines before line numbers."""
+    lines = []
+    for i in range(count):
+        lines.extend(inserted.get(i, []))
+        lines.append(changed.get(i, "line %s\n" % i))
+    return lines
+
+def test_streaming_diff_identical():
+    lines = _result_lines(1000)
+    stats = {}
+
+    assert streaming_unified_diff(lines, list(lines), "ref", "new", 64, 10, stats=stats) == []
+    assert stats == dict(hunks = 0, ref_changed = 0, new_changed = 0)
+
+def test_streaming_diff_matches_unified_diff_within_chunk():
+    ref_lines = _result_lines(200)
+    new_lines = _result_lines(200, changed = {10 : "changed 10\n", 150 : "changed 150\n"})
+
+    assert streaming_unified_diff(ref_lines, new_lines, "ref", "new", 1024, 10) == list(difflib.unified_diff(ref_lines, new_lines, "ref", "new", n=3))
+
+def test_streaming_diff_realigns_across_chunks():
+    # Insertions shorter than a chunk are realigned, later chunks report no changes
+    ref_lines = _result_lines(1000, changed = {900 : "changed 900\n"})
+    new_lines = _result_lines(1000, inserted = {50 : ["inserted a\n", "inserted b\n"]})
+    stats = {}
+
+    diff = streaming_unified_diff(ref_lines, new_lines, "ref", "new", 64, 10, stats=stats)
+
+    assert stats == dict(hunks = 2, ref_changed = 1, new_changed = 3)
+    assert diff[:2] == ["--- ref\n", "+++ new\n"]
+    assert "@@ -48,6 +48,8 @@\n" in diff
+    assert "+inserted a\n" in diff and "+inserted b\n" in diff
+    assert "-changed 900\n" in diff and "+line 900\n" in diff
+    assert diff == list(difflib.unified_diff(ref_lines, new_lines, "ref", "new", n=3))
+
+def test_streaming_diff_truncates_hunks():
+    ref_lines = _result_lines(1000)
+    new_lines = _result_lines(1000, changed = dict((i, "changed %s\n" % i) for i in range(0, 1000, 20)))
+    stats = {}
+
+    diff = streaming_unified_diff(ref_lines, new_lines, "ref", "new", 128, 5, stats=stats)
+
+    assert stats == dict(hunks = 50, ref_changed = 50, new_changed = 50)
+    assert len([l for l in diff if l.startswith("@@")]) == 5
+    assert diff[-1] == "# Diff truncated, first 5 of 50 hunks shown. 50 ref lines and 50 new lines differ.\n"
+
+def test_streaming_diff_terminates_lines():
+    diff = streaming_unified_diff(["a\n", "b"], ["a\n", "c"], "ref", "new", 16, 10)
+
+    assert diff == ["--- ref\n", "+++ new\n", "@@ -1,2 +1,2 @@\n", " a\n", "-b\n", "+c\n"]
+
+ref_pdb_lines = [
+    "ATOM      1  N   SER A   1      -8.901   4.127  -0.555  1.00  0.00           N  \n",
+    "ATOM      2  CA  SER A   1      -8.608   3.135  -1.618  1.00  0.00           C  \n",
+    "HETATM 1234  ZN  ZN  B 101      12.000  -3.500   7.250  1.00 20.00          ZN  \n",
+    "TER\n",
+]
+
+new_pdb_lines = [
+    "ATOM      1  N   SER A   1      -8.902   4.127  -0.555  1.00  0.00           N  \n",
+    "ATOM      2  CA  SER A   1      -8.608   3.136  -1.618  1.00  0.00           C  \n",
+    "HETATM 1234  ZN  ZN  B 101      12.000  -3.500   7.250  1.00 20.00          ZN  \n",
+    "TER\n",
+]
+
+ref_score_lines = [
+    "SEQUENCE: \n",
+    "SCORE: total_score fa_atr fa_rep description\n",
+    "SCORE: -245.123 -512.450 48.200 1ubq_0001\n",
+]
+
+def test_tokenize_pdb_coordinates():
+    skeleton, values = tokenize_numeric_fields(ref_pdb_lines[0])
+
+    assert values == [-8.901, 4.127, -0.555, 1.0, 0.0]
+    assert skeleton == ref_pdb_lines[0][:30] + ref_pdb_lines[0][66:]
+
+def test_tokenize_whitespace_fields():
+    assert tokenize_numeric_fields(ref_score_lines[2]) == ("SCORE: # # # 1ubq_0001", [-245.123, -512.45, 48.2])
+
+def test_pdb_within_tolerance():
+    assert numeric_fields_equivalent(ref_pdb_lines, new_pdb_lines, atol = 2e-3)
+    assert not numeric_fields_equivalent(ref_pdb_lines, new_pdb_lines, atol = 5e-4)
+
+def test_relative_tolerance():
+    new_score_lines = ref_score_lines[:2] + ["SCORE: -245.125 -512.460 48.201 1ubq_0001\n"]
+
+    assert numeric_fields_equivalent(ref_score_lines, new_score_lines, rtol = 1e-4)
+    assert not numeric_fields_equivalent(ref_score_lines, new_score_lines, rtol = 1e-6)
+
+def test_text_differences_not_equivalent():
+    new_score_lines = ref_score_lines[:2] + ["SCORE: -245.123 -512.450 48.200 1ubq_0002\n"]
+    assert not numeric_fields_equivalent(ref_score_lines, new_score_lines, atol = 1)
+
+    new_pdb_lines = [ref_pdb_lines[0].replace("SER", "THR")] + ref_pdb_lines[1:]
+    assert not numeric_fields_equivalent(ref_pdb_lines, new_pdb_lines, atol = 1)
+
+def test_line_count_differences_not_equivalent():
+    assert not numeric_fields_equivalent(ref_score_lines, ref_score_lines[:2], atol = 1)
+    assert not numeric_fields_equivalent(ref_score_lines[:2], ref_score_lines, atol = 1)
+
+def test_values_compared_across_chunks():
+    ref_lines = ["%s %s\n" % (i, i * .5) for i in range(1000)]
+    new_lines = list(ref_lines)
+    new_lines[10] = "10 5.1\n"
+
+    assert not numeric_fields_equivalent(ref_lines, new_lines, atol = 1e-3, chunk_values = 64)
+    assert numeric_fields_equivalent(ref_lines, new_lines, atol = .2, chunk_values = 64)
+
+def _write_result_directory(result_dir, parameters, results):
+    """Write test_parameters.json and { test : { result_file : content } } into result_dir."""
+    result_dir.join("test_parameters.json").write(json.dumps(parameters), ensure=True)
+    for test, files in results.items():
+        for f, content in files.items():
+            result_dir.join(test, f).write(content, ensure=True)
+
+def test_analysis_resumed_only_with_unchanged_config(tmpdir):
+    ref_dir, new_dir, outdir = tmpdir.join("ref"), tmpdir.join("new"), tmpdir.join("out")
+    _write_result_directory(ref_dir, {"database" : "/ref/database"}, {
+        "score" : {"score.sc" : "SCORE: -245.123 1ubq_0001\n"},
+        "docking" : {"log" : "database /ref/database\n"}})
+    _write_result_directory(new_dir, {"database" : "/new/database"}, {
+        "score" : {"score.sc" : "SCORE: -245.124 1ubq_0001\n"},
+        "docking" : {"log" : "database /new/database\n"}})
+
+    analysis = IntegrationAnalysis(str(ref_dir), str(new_dir))
+    assert analysis.test_results["docking"].passed
+    assert analysis.test_results["score"].diff_files == ["score.sc"]
+    analysis.write_test_report(str(outdir))
+
+    resumed = IntegrationAnalysis(str(ref_dir), str(new_dir), checkpoint = IntegrationAnalysis.load_checkpoint(str(outdir)))
+    assert sorted(resumed.resumed_tests) == ["docking", "score"]
+
+    tolerance_config = IntegrationConfig(numeric_tolerances = {"*.sc" : dict(atol=1e-2, rtol=0)})
+    reanalyzed = IntegrationAnalysis(str(ref_dir), str(new_dir), tolerance_config, checkpoint = IntegrationAnalysis.load_checkpoint(str(outdir)))
+    assert reanalyzed.resumed_tests == {}
+    assert reanalyzed.test_results["score"].passed
+
+    substitution_config = IntegrationConfig(sub_test_parameters = [])
+    reanalyzed = IntegrationAnalysis(str(ref_dir), str(new_dir), substitution_config, checkpoint = IntegrationAnalysis.load_checkpoint(str(outdir)))
+    assert reanalyzed.resumed_tests == {}
+    assert reanalyzed.test_results["docking"].diff_files == ["log"]
+
+def test_digest_manifest_requires_matching_algorithm(tmpdir):
+    substitution = ResultSubstitution({"/ref/database" : "database"})
+    test_digests = {"docking" : {"log" : [10, 1.0, "abc"]}}
+    ResultDigestManifest(str(tmpdir), substitution.replacements, test_digests).write()
+
+    manifest = ResultDigestManifest.from_result_directory(str(tmpdir), substitution)
+    assert manifest.test_digests == test_digests
+
+    assert ResultDigestManifest.from_result_directory(str(tmpdir), ResultSubstitution({"/ref/bin" : "bin"})) is None
+
+    manifest_file = tmpdir.join(ResultDigestManifest.manifest_filename)
+    manifest_file.write(json.dumps(dict(json.loads(manifest_file.read()), digest = "blake2b")))
+    assert ResultDigestManifest.from_result_directory(str(tmpdir), substitution) is None
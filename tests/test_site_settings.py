@@ -0,0 +1,28 @@
+import os
+from os import path
+
+site_settings_path = path.join(path.dirname(path.dirname(path.abspath(__file__))), "site.settings")
+
+def _site_settings(monkeypatch, environment):
+    for k in list(os.environ):
+        if k.startswith("CCACHE_"):
+            monkeypatch.delenv(k)
+    for k, v in environment.items():
+        monkeypatch.setenv(k, v)
+
+    site_globals = {}
+    with open(site_settings_path) as settings_file:
+        exec(settings_file.read(), site_globals)
+    return site_globals["settings"]["site"]
+
+def test_compiler_cache_variables_forwarded(monkeypatch):
+    site = _site_settings(monkeypatch, {"CCACHE_DIR" : "/work/ccache", "CCACHE_BASEDIR" : "/work/builder", "CCACHE_NOHASHDIR" : "1"})
+
+    assert site["overrides"]["ENV"] == {
+        "CCACHE_DIR" : "/work/ccache", "CCACHE_BASEDIR" : "/work/builder", "CCACHE_NOHASHDIR" : "1", "PATH" : os.environ["PATH"]}
+
+def test_environment_unchanged_without_compiler_cache(monkeypatch):
+    site = _site_settings(monkeypatch, {})
+
+    assert "ENV" not in site["overrides"]
+    assert site["prepends"]["program_path"] == os.environ["PATH"].split(":")
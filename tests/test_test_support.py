@@ -0,0 +1,67 @@
+import pytest
+
+from buildbot.status.results import SUCCESS, FAILURE, SKIPPED
+
+from test_support import estimate_durations, partition_shards, update_test_durations, shard_missing_steps
+from test_support import unit_shard_item, integration_shard_prefix
+
+def _integration(*tests):
+    return [integration_shard_prefix + t for t in tests]
+
+def test_partition_balances_longest_first():
+    estimates = {"a" : 10.0, "b" : 7.0, "c" : 5.0, "d" : 4.0, "e" : 3.0, "f" : 1.0}
+
+    shards = partition_shards(sorted(estimates), estimates, 2)
+
+    assert shards == [["a", "d", "f"], ["b", "c", "e"]]
+    assert [sum(estimates[i] for i in s) for s in shards] == [15.0, 15.0]
+
+def test_partition_assigns_every_item_once():
+    items = _integration(*("test_%s" % i for i in range(20))) + [unit_shard_item]
+    estimates = estimate_durations(items, {}, 3)
+
+    shards = partition_shards(items, estimates, 3)
+
+    assert sorted(sum(shards, [])) == sorted(items)
+    assert all(shards)
+
+def test_partition_more_shards_than_items():
+    assert partition_shards(["a"], {"a" : 1.0}, 3) == [["a"], [], []]
+
+def test_estimate_durations_defaults():
+    durations = {integration_shard_prefix + "a" : 2.0, integration_shard_prefix + "b" : 4.0, integration_shard_prefix + "c" : 9.0}
+    items = _integration("a", "b", "c", "new") + [unit_shard_item]
+
+    estimates = estimate_durations(items, durations, shard_count = 2)
+
+    # Unknown tests estimated by median, unit suite by an even shard's share of integration tests
+    assert estimates[integration_shard_prefix + "new"] == 4.0
+    assert estimates[unit_shard_item] == pytest.approx((2.0 + 4.0 + 9.0 + 4.0) / 2)
+
+def test_update_durations_splits_wall_time_by_estimate():
+    durations = {integration_shard_prefix + "a" : 10.0, integration_shard_prefix + "b" : 30.0}
+
+    update_test_durations(durations, _integration("a", "b"), 80.0, smoothing = .5)
+
+    assert durations == {
+        integration_shard_prefix + "a" : pytest.approx(.5 * 10.0 + .5 * 20.0),
+        integration_shard_prefix + "b" : pytest.approx(.5 * 30.0 + .5 * 60.0)}
+
+def test_update_durations_records_new_items():
+    durations = {}
+
+    update_test_durations(durations, [unit_shard_item], 120.0)
+    update_test_durations(durations, _integration("a", "b"), 10.0)
+
+    assert durations == {unit_shard_item : 120.0, integration_shard_prefix + "a" : 5.0, integration_shard_prefix + "b" : 5.0}
+
+def _shard_result(assigned_unit, assigned_integration, **steps):
+    return {"assignment" : {"unit" : assigned_unit, "integration" : assigned_integration}, "steps" : dict((k, {"result" : r}) for k, r in steps.items())}
+
+def test_shard_missing_steps():
+    assert shard_missing_steps(_shard_result(True, ["a"], unit = SUCCESS, integration = FAILURE)) == []
+    assert shard_missing_steps(_shard_result(False, ["a"], integration = SUCCESS)) == []
+
+    # Shard build failed before running tests
+    assert shard_missing_steps(_shard_result(True, ["a"])) == ["integration", "unit"]
+    assert shard_missing_steps(_shard_result(True, [], unit = SKIPPED)) == ["unit"]